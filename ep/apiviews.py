@@ -1,9 +1,9 @@
 import datetime
+import itertools
 import json
 import logging
 
-from django.contrib.auth.models import Group
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
@@ -12,12 +12,18 @@ from djcelery.models import PeriodicTask
 from rest_framework import mixins
 from rest_framework import permissions
 from rest_framework import status, generics
+from rest_framework.exceptions import ValidationError
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
-from ep.models import Site, Node, DeviceParameter, Gateway, Tariff, Device, StateChangeEvent
+from ep.groups import get_group_names
+from ep.models import Site, Node, DeviceParameter, Gateway, Tariff, Device, StateChangeEvent, DPMeasurements
 from ep.serializers import SiteSerializer, NodeSerializer, DeviceStateMeasurementSerializer, DeviceParameterSerializer, \
     TariffSerializer, GatewaySerializer, DeviceSerializer
+from ep.pagination import MeasurementCursorPagination
+from ep.response_cache import CachedResponseMixin
+from ep.renderers import NDJSONRenderer, stream_json_list, ColumnarRenderer, COLUMNAR_RENDERER_CLASSES, CSVRenderer
 from ep.tasks import change_device_state
 
 __author__ = 'schien'
@@ -32,8 +38,32 @@ ebe_group = 'EBE'
 def is_in_group(user, group_name):
     """
     Takes a user and a group name, and returns `True` if the user is in that group.
+
+    Memberships are cached, see :func:`ep.groups.get_group_names`.
+    """
+    return group_name in get_group_names(user)
+
+
+def parse_date_range(query_params):
+    """
+    Read the `start_date` (or `after`) and `end_date` query parameters. The start defaults to 30 days ago.
+
+    :return: tuple of start and end datetime, the end is None if not given
     """
-    return Group.objects.get(name=group_name).user_set.filter(id=user.id).exists()
+    # start_date is an ISO String. I.e. "2016-02-10T12:10:26.213186Z"
+    # @todo test
+    start_datetime_param = query_params.get('start_date', (timezone.now() - datetime.timedelta(days=30)).isoformat())
+    start_datetime_param = query_params.get('after', start_datetime_param)
+    start_date = parse_datetime(start_datetime_param)
+    if start_date is None:
+        raise ValidationError('start_date must be an ISO formatted date time.')
+
+    end_date = None
+    if 'end_date' in query_params:
+        end_date = parse_datetime(query_params['end_date'])
+        if end_date is None:
+            raise ValidationError('end_date must be an ISO formatted date time.')
+    return start_date, end_date
 
 
 class HasGroupPermission(permissions.BasePermission):
@@ -61,10 +91,25 @@ class MeasurementList(mixins.ListModelMixin, generics.GenericAPIView):
     - device_parameter_id (int): id of the device parameter to get the measurements for
     - query param `start_date` (ISO String, e.g. `2016-02-10T12:10:26Z` ), optional:
         start date of the duration. Default 30 days from today.
+    - query param `end_date` (ISO String), optional: end date of the duration. Default now.
+    - query param `interval` (InfluxDB duration, e.g. `15m`, `1h`, `1d`), optional:
+        aggregate the measurements into intervals of this length. Default no aggregation.
+    - query param `agg` (one of `mean`, `min`, `max`, `last`, `sum`, `count`), optional:
+        the aggregation applied per interval. Default `mean`.
+    - query param `limit` (int), optional: return pages of at most this many measurements. The response then is an
+        object with the measurements in `results` and the link to the next (older) page in `next`.
+    - query param `before` (ISO String), optional: only measurements before this time. Used as pagination cursor.
+    - query param `after` (ISO String), optional: synonym for `start_date`.
+    - query param `stream` (bool), optional: stream the measurements as they are read from the database.
+        Responses in `format=ndjson` (newline delimited JSON) are always streamed.
+    - query param `format` (or the `Accept` header), optional: `columnar` (`application/vnd.iodicus.columnar+json`)
+        or, if msgpack is installed, `msgpack` (`application/x-msgpack`) return the measurements as parallel `time`
+        (milliseconds since the epoch) and `value` arrays, e.g.
+        `{time: [1463582812950, 1463582810943], value: [0, 255]}`. Columnar responses are not streamed.
 
     Returns:
 
-    - List of measurements as `time`, `value` pairs
+    - List of measurements as `time`, `value` pairs. With an `interval`, `time` is the start of the interval.
 
     Example:
 
@@ -83,28 +128,69 @@ class MeasurementList(mixins.ListModelMixin, generics.GenericAPIView):
 
     serializer_class = DeviceStateMeasurementSerializer
     permission_classes = [HasGroupPermission]
+    pagination_class = MeasurementCursorPagination
+    renderer_classes = list(api_settings.DEFAULT_RENDERER_CLASSES) + [NDJSONRenderer] + COLUMNAR_RENDERER_CLASSES
 
     required_groups = {
         'GET': [uob_estates_group],
     }
 
+    def get_query_kwargs(self):
+        """
+        Translate the query parameters to arguments of :func:`TSMeasurements.all`
+        :return:
+        """
+        start_date, end_date = parse_date_range(self.request.query_params)
+
+        return {'start_date': start_date, 'end_date': end_date,
+                'interval': self.request.query_params.get('interval'), 'agg': self.request.query_params.get('agg'),
+                'before': self.request.query_params.get('before'),
+                'limit': self.paginator.get_query_limit(self.request)}
+
     def get_queryset(self):
         """
         Return a list of measurements for a particular device
         :return:
         """
         param_id = self.kwargs['device_parameter_id']
-        # start_date is an ISO String. I.e. "2016-02-10T12:10:26.213186Z"
-        # @todo test
-        start_datetime_param = self.request.query_params.get('start_date',
-                                                             (timezone.now() - datetime.timedelta(days=30)).isoformat())
-        start_date = parse_datetime(start_datetime_param)
+        device_param = DeviceParameter.objects.get(id=param_id)
+
+        try:
+            return device_param.measurements.all(**self.get_query_kwargs())
+        except ValueError as e:
+            raise ValidationError(str(e))
 
+    def stream(self, request):
+        """
+        Stream measurements straight from the chunked InfluxDB response, without holding the series in memory
+        :return:
+        """
+        param_id = self.kwargs['device_parameter_id']
         device_param = DeviceParameter.objects.get(id=param_id)
 
-        return device_param.measurements.all(start_date=start_date)
+        kwargs = self.get_query_kwargs()
+        # there are no pages when streaming, limit is just the number of measurements
+        kwargs['limit'] = self.paginator.get_limit(request)
+        try:
+            points = device_param.measurements.stream(**kwargs)
+            # start the query now, so that errors are raised before the response starts
+            first = next(points, None)
+        except ValueError as e:
+            raise ValidationError(str(e))
+        points = itertools.chain([first], points) if first is not None else iter([])
+
+        renderer = request.accepted_renderer
+        if isinstance(renderer, NDJSONRenderer):
+            return StreamingHttpResponse(renderer.stream(points), content_type=renderer.media_type)
+        return StreamingHttpResponse(stream_json_list(points), content_type='application/json')
 
     def get(self, request, *args, **kwargs):
+        if isinstance(request.accepted_renderer, ColumnarRenderer):
+            # the columns are built from the complete series
+            return self.list(request, *args, **kwargs)
+        if isinstance(request.accepted_renderer, NDJSONRenderer) or \
+                request.query_params.get('stream', '').lower() in ('1', 'true'):
+            return self.stream(request)
         return self.list(request, *args, **kwargs)
 
 
@@ -151,7 +237,140 @@ class MeasurementsLatest(generics.RetrieveAPIView):
         return latest
 
 
-class NodeList(mixins.ListModelMixin,
+class DeviceParameterSelectionMixin(object):
+    """
+    Selects the device parameters of a request from the query parameters `ids`, `site` or `device`.
+    """
+
+    def get_device_parameter_ids(self):
+        params = self.request.query_params
+        try:
+            if 'ids' in params:
+                return [int(i) for i in params['ids'].split(',') if i]
+            if 'site' in params:
+                return list(DeviceParameter.objects.filter(device__node__gateway__site=int(params['site']))
+                            .values_list('id', flat=True))
+            if 'device' in params:
+                return list(DeviceParameter.objects.filter(device=int(params['device'])).values_list('id', flat=True))
+        except ValueError:
+            raise ValidationError('Device parameter, site and device ids must be integers.')
+        raise ValidationError('One of the query parameters ids, site or device is required.')
+
+
+class MeasurementsLatestList(DeviceParameterSelectionMixin, mixins.ListModelMixin, generics.GenericAPIView):
+    """
+    Returns the latest measurement for many DeviceParameters at once.
+
+    Parameters (one of):
+
+    - query param `ids` (comma separated ints): ids of the device parameters
+    - query param `site` (int): id of a site, to get the latest measurements of all its device parameters
+    - query param `device` (int): id of a device, to get the latest measurements of all its device parameters
+
+    Returns:
+
+    - list of measurements as `device_parameter`, `time`, `value` triples. Device parameters without measurements
+      are omitted.
+
+    Example:
+
+        [
+          {
+            device_parameter: 241,
+            time: "2016-05-18T14:46:52.950287Z",
+            value: 0
+          },
+          {
+            device_parameter: 242,
+            time: "2016-05-18T14:46:50.943067Z",
+            value: 255
+          },
+        ]
+
+    """
+
+    serializer_class = DeviceStateMeasurementSerializer
+    permission_classes = [HasGroupPermission]
+
+    required_groups = {
+        'GET': [uob_estates_group],
+    }
+
+    def get_queryset(self):
+        """
+        Return the latest measurements of the requested device parameters, fetched with a single query
+        :return:
+        """
+        last_values = DPMeasurements.last_values(self.get_device_parameter_ids())
+
+        return [{'device_parameter': device_parameter_id, 'time': last_value.time, 'value': last_value.value}
+                for device_parameter_id, last_value in sorted(last_values.items())]
+
+    def get(self, request, *args, **kwargs):
+        return self.list(request, *args, **kwargs)
+
+
+class MeasurementExport(DeviceParameterSelectionMixin, generics.GenericAPIView):
+    """
+    Exports the measurements of many DeviceParameters as one table, aligned on a common time index. The measurements
+    are read with one query per `MEASUREMENT_EXPORT_WINDOW` seconds of the time range.
+
+    Parameters (one of):
+
+    - query param `ids` (comma separated ints): ids of the device parameters
+    - query param `site` (int): id of a site, to export all its device parameters
+    - query param `device` (int): id of a device, to export all its device parameters
+
+    Optional query parameters:
+
+    - `start_date`, `end_date`, `interval` and `agg` as for the measurements of a single device parameter
+    - `format` (or the `Accept` header): `csv` (default, streamed), `columnar` (JSON) or, if msgpack is installed,
+        `msgpack`. The columnar formats are limited to `MEASUREMENT_EXPORT_MAX_ROWS` rows.
+
+    Returns:
+
+    - a column `time` with the times in milliseconds since the epoch (ascending) and one column of values per device
+      parameter, headed by its id. Cells are empty (null) where a device parameter has no value at that time.
+
+    Example:
+
+        time,241,242
+        1463582810000,20.5,
+        1463582812950,21.0,255
+
+    """
+    permission_classes = [HasGroupPermission]
+    renderer_classes = [CSVRenderer] + COLUMNAR_RENDERER_CLASSES
+
+    required_groups = {
+        'GET': [uob_estates_group],
+    }
+
+    def get(self, request, *args, **kwargs):
+        device_parameter_ids = sorted(self.get_device_parameter_ids())
+        start_date, end_date = parse_date_range(request.query_params)
+        options = dict(start_date=start_date, end_date=end_date, interval=request.query_params.get('interval'),
+                       agg=request.query_params.get('agg'))
+
+        renderer = request.accepted_renderer
+        try:
+            if isinstance(renderer, CSVRenderer):
+                # streamed one time window at a time
+                rows = DPMeasurements.aligned_rows(device_parameter_ids, **options)
+            else:
+                columns = DPMeasurements.aligned_series(device_parameter_ids, **options)
+        except ValueError as e:
+            raise ValidationError(str(e))
+
+        if isinstance(renderer, CSVRenderer):
+            header = ['time'] + [str(i) for i in device_parameter_ids]
+            response = StreamingHttpResponse(renderer.stream_rows(header, rows), content_type=renderer.media_type)
+            response['Content-Disposition'] = 'attachment; filename="measurements.csv"'
+            return response
+        return Response(columns)
+
+
+class NodeList(CachedResponseMixin, mixins.ListModelMixin,
                generics.GenericAPIView):
     """
     Returns a list of all nodes ids.
@@ -207,7 +426,7 @@ class NodeList(mixins.ListModelMixin,
         return self.list(request, *args, **kwargs)
 
 
-class DeviceList(mixins.ListModelMixin,
+class DeviceList(CachedResponseMixin, mixins.ListModelMixin,
                  generics.GenericAPIView):
     """
     Returns details of all devices in a site.
@@ -276,11 +495,10 @@ class DeviceList(mixins.ListModelMixin,
         Return a list of measurements for a particular device
         :return:
         """
+        queryset = DeviceSerializer.setup_eager_loading(Device.objects.all())
         if 'pk' in self.kwargs:
-            site = Site.objects.get(pk=self.kwargs['pk'])
-            return Device.objects.filter(node__gateway__site=site)
-        else:
-            return Device.objects.all()
+            return queryset.filter(node__gateway__site_id=self.kwargs['pk'])
+        return queryset
 
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
@@ -340,7 +558,7 @@ class DeviceDetails(generics.RetrieveAPIView):
           }
 
     """
-    queryset = Device.objects.all()
+    queryset = DeviceSerializer.setup_eager_loading(Device.objects.all())
     serializer_class = DeviceSerializer
     permission_classes = [HasGroupPermission]
 
@@ -350,7 +568,7 @@ class DeviceDetails(generics.RetrieveAPIView):
     }
 
 
-class SiteList(mixins.ListModelMixin,
+class SiteList(CachedResponseMixin, mixins.ListModelMixin,
                generics.GenericAPIView):
     """
     Returns a list of all registered sites.
@@ -389,7 +607,7 @@ class SiteList(mixins.ListModelMixin,
         return self.list(request, *args, **kwargs)
 
 
-class GatewayList(mixins.ListModelMixin,
+class GatewayList(CachedResponseMixin, mixins.ListModelMixin,
                   generics.GenericAPIView):
     """
     Returns a list of all gateways for a site.
@@ -435,7 +653,7 @@ class GatewayList(mixins.ListModelMixin,
         return self.list(request, *args, **kwargs)
 
 
-class TariffList(mixins.ListModelMixin,
+class TariffList(CachedResponseMixin, mixins.ListModelMixin,
                  generics.GenericAPIView):
     """
     Returns a list of all known tariffs.
@@ -514,7 +732,7 @@ class SiteDetailsView(generics.RetrieveAPIView):
     }
 
 
-class TariffDetailsView(generics.RetrieveAPIView):
+class TariffDetailsView(CachedResponseMixin, generics.RetrieveAPIView):
     """
     Returns details for a single tariff.
 
@@ -0,0 +1,59 @@
+"""
+Cached group memberships of API users.
+
+The names of a user's groups are read with one query and kept on the user object for the rest of the request and in a
+process cache for `API_GROUP_CACHE_TTL` seconds. Changes of memberships and groups clear the process cache, see
+`ep.signals.handlers`. Other processes see the change once the TTL has passed.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+__author__ = 'schien'
+
+# user id -> (expiry time, frozenset of group names)
+_group_names = {}
+_lock = threading.Lock()
+
+
+def get_group_names(user):
+    """
+    :param user: a user, may be anonymous
+    :return: frozenset of the names of the user's groups
+    """
+    if not user.is_authenticated():
+        return frozenset()
+
+    # the request keeps its user object, so the names are resolved at most once per request
+    names = getattr(user, '_ep_group_names', None)
+    if names is not None:
+        return names
+
+    now = time.time()
+    with _lock:
+        cached = _group_names.get(user.id)
+    if cached is not None and cached[0] > now:
+        names = cached[1]
+    else:
+        names = frozenset(user.groups.values_list('name', flat=True))
+        if settings.API_GROUP_CACHE_TTL > 0:
+            with _lock:
+                _group_names[user.id] = (now + settings.API_GROUP_CACHE_TTL, names)
+
+    user._ep_group_names = names
+    return names
+
+
+def invalidate_group_names(user_ids=None):
+    """
+    Remove cached group memberships.
+
+    :param user_ids: ids of the users to remove, all users if None
+    """
+    with _lock:
+        if user_ids is None:
+            _group_names.clear()
+        else:
+            for user_id in user_ids:
+                _group_names.pop(user_id, None)
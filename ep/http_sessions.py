@@ -0,0 +1,120 @@
+"""
+Shared HTTP sessions for the vendor API clients.
+
+Each vendor gets one :class:`InstrumentedSession` per process, so that polling many nodes reuses keep-alive
+connections instead of opening a new (TLS) connection for every call. Pool size and timeouts are configured per vendor
+in `VENDOR_HTTP_SESSIONS`, falling back to the `default` entry.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+__author__ = 'schien'
+
+logger = logging.getLogger(__name__)
+
+# numeric path segments are ids, count them as one endpoint
+ID_SEGMENT_PATTERN = re.compile(r'/\d+(?=/|$)')
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.
+        self.max_time = 0.
+
+    def record(self, elapsed, error=False):
+        self.count += 1
+        self.errors += int(error)
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def as_dict(self):
+        return {'count': self.count, 'errors': self.errors, 'max_time': self.max_time,
+                'mean_time': self.total_time / self.count if self.count else 0.}
+
+
+class InstrumentedSession(requests.Session):
+    """
+    A session with a sized connection pool, default timeouts and gzip, that records the latency of each endpoint.
+    """
+
+    def __init__(self, vendor, connect_timeout=5., read_timeout=30., pool_size=10):
+        super().__init__()
+        self.vendor = vendor
+        self.timeout = (connect_timeout, read_timeout)
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+
+        self._stats = defaultdict(EndpointStats)
+        self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def endpoint(method, url):
+        return '{} {}'.format(method.upper(), ID_SEGMENT_PATTERN.sub('/{id}', urlsplit(url).path))
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        start = time.time()
+        error = True
+        try:
+            response = super().request(method, url, **kwargs)
+            error = response.status_code >= 400
+            return response
+        finally:
+            elapsed = time.time() - start
+            with self._stats_lock:
+                self._stats[self.endpoint(method, url)].record(elapsed, error)
+
+    def latency_stats(self):
+        """
+        :return: dict of endpoint (method and path) -> dict of count, errors, mean_time and max_time in seconds
+        """
+        with self._stats_lock:
+            return {endpoint: stats.as_dict() for endpoint, stats in self._stats.items()}
+
+    def log_latency_stats(self):
+        for endpoint, stats in sorted(self.latency_stats().items()):
+            logger.info('{vendor} {endpoint}: {count} calls, {errors} errors, mean {mean_time:.3f}s, '
+                        'max {max_time:.3f}s'.format(vendor=self.vendor, endpoint=endpoint, **stats),
+                        extra=dict(stats, vendor=self.vendor, endpoint=endpoint))
+
+
+_sessions = {}
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+
+
+def get_session(vendor):
+    """
+    Return the session of a vendor for the current process. Sessions are not shared with forked processes.
+    """
+    global _sessions, _sessions_pid
+
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            _sessions = {}
+            _sessions_pid = os.getpid()
+
+        if vendor not in _sessions:
+            config = dict(settings.VENDOR_HTTP_SESSIONS['default'])
+            config.update(settings.VENDOR_HTTP_SESSIONS.get(vendor, {}))
+            _sessions[vendor] = InstrumentedSession(vendor,
+                                                    connect_timeout=config['CONNECT_TIMEOUT'],
+                                                    read_timeout=config['READ_TIMEOUT'],
+                                                    pool_size=config['POOL_SIZE'])
+        return _sessions[vendor]
@@ -0,0 +1,51 @@
+import time
+from datetime import datetime, timedelta
+
+from django.core.management import BaseCommand
+from influxdb.line_protocol import make_lines
+
+from ep.timeseries import encode_point, series_key, to_epoch_ns
+
+__author__ = 'schien'
+
+
+class Command(BaseCommand):
+    help = 'Compare the CPU time of encoding points for write_points and with ep.timeseries.encode_point'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--points', type=int, default=100000, help='Number of points to encode')
+        parser.add_argument('--series', type=int, default=200, help='Number of device parameters the points belong to')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per encoder, the fastest counts')
+
+    def handle(self, *args, **options):
+        start = datetime(2016, 1, 1)
+        samples = [(i % options['series'], start + timedelta(seconds=i), i * 0.5) for i in range(options['points'])]
+
+        def dict_points():
+            # what TSMeasurements.add used to buffer, serialised the way write_points does it
+            points = [{"measurement": "device_parameters",
+                       "tags": {"dp": str(dp), "type": "CURRENT_TEMP", "trigger": "ON_DEVICE"},
+                       "time": timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                       "fields": {"value": float(value)}}
+                      for dp, timestamp, value in samples]
+            return make_lines({'points': points}).encode('utf-8')
+
+        def line_points():
+            lines = [encode_point(series_key("device_parameters", {"dp": str(dp), "type": "CURRENT_TEMP",
+                                                                   "trigger": "ON_DEVICE"}),
+                                  value, to_epoch_ns(timestamp))
+                     for dp, timestamp, value in samples]
+            return ('\n'.join(lines) + '\n').encode('utf-8')
+
+        results = {}
+        for name, encoder in (('write_points dicts', dict_points), ('encode_point', line_points)):
+            timings = []
+            for _ in range(options['repeat']):
+                started = time.process_time()
+                encoder()
+                timings.append(time.process_time() - started)
+            results[name] = min(timings)
+            self.stdout.write('{:<20} {:8.3f}s CPU, {:8.2f} us per point'.format(
+                name, results[name], results[name] / len(samples) * 1e6))
+
+        self.stdout.write('Speedup: {:.1f}x'.format(results['write_points dicts'] / results['encode_point']))
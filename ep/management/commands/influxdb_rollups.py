@@ -0,0 +1,134 @@
+import logging
+import math
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from ep.timeseries import create_client, get_rollup_tiers, rollup_measurements, parse_duration
+
+__author__ = 'schien'
+
+logger = logging.getLogger(__name__)
+
+# fields computed for every bucket of a rollup
+ROLLUP_FIELDS = ('mean', 'min', 'max', 'sum', 'count', 'last')
+
+
+def rollup_select(measurement, tag, tier, source_rp, database):
+    """
+    The SELECT INTO statement that aggregates the raw points of a measurement into a rollup.
+
+    :return: tuple of the SELECT INTO part and the GROUP BY clause, so that a WHERE clause can be put in between
+    """
+    fields = ', '.join('{agg}(value) AS "{agg}"'.format(agg=agg) for agg in ROLLUP_FIELDS)
+    select = 'SELECT {fields} INTO "{db}"."{rp}"."{m}" FROM "{db}"."{source_rp}"."{m}"'.format(
+        fields=fields, db=database, rp=tier.name, source_rp=source_rp, m=measurement)
+    group_by = 'GROUP BY time({interval}), "{tag}"'.format(interval=tier.interval, tag=tag)
+    return select, group_by
+
+
+def resample_clause(tier, lateness):
+    """
+    The RESAMPLE clause of the continuous query of a rollup. Each run recomputes the buckets that can still receive
+    points arriving up to `lateness` late, i.e. the last complete bucket plus enough buckets to cover the lateness.
+
+    :param lateness: an InfluxDB duration, e.g. `1h`
+    """
+    interval = parse_duration(tier.interval)
+    buckets = 1 + int(math.ceil(parse_duration(lateness) / interval))
+    return 'RESAMPLE EVERY {} FOR {}s'.format(tier.interval, buckets * interval)
+
+
+def backfill_windows(tier, oldest, now, window):
+    """
+    The time windows a backfill of a rollup is split into, so that no single query reads the whole raw history. Windows
+    are a multiple of the rollup interval and aligned to the epoch like its buckets, so that no bucket is split.
+
+    :param oldest: epoch seconds of the oldest raw point
+    :param now: epoch seconds of the end of the backfill
+    :param window: an InfluxDB duration, the minimum length of a window
+    :return: list of (start, end) epoch seconds, the start inclusive and the end exclusive
+    """
+    interval = parse_duration(tier.interval)
+    window = int(math.ceil(parse_duration(window) / interval)) * interval
+    duration = parse_duration(tier.duration)
+    start = max(oldest, now - duration) if duration else oldest
+    start -= start % window
+    return [(window_start, window_start + window) for window_start in range(start, now + 1, window)]
+
+
+class Command(BaseCommand):
+    help = 'Create the retention policies and continuous queries declared in INFLUX_RETENTION_POLICIES'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backfill', action='store_true', dest='backfill', default=False,
+                            help='Compute the rollups from the raw points already stored')
+
+    def handle(self, *args, **options):
+        database = settings.INFLUX_DB_NAME
+        client = create_client()
+
+        raw_rp = self.create_retention_policies(client, database)
+
+        existing_cqs = self.continuous_queries(client, database)
+        for measurement, tag in rollup_measurements().items():
+            for tier in get_rollup_tiers():
+                select, group_by = rollup_select(measurement, tag, tier, raw_rp, database)
+                cq_name = 'cq_{}_{}'.format(measurement, tier.name)
+                if cq_name in existing_cqs:
+                    client.query('DROP CONTINUOUS QUERY "{}" ON "{}"'.format(cq_name, database))
+                resample = resample_clause(tier, settings.INFLUX_ROLLUP_LATENESS)
+                client.query('CREATE CONTINUOUS QUERY "{name}" ON "{db}" {resample} BEGIN {select} {group_by} END'
+                             .format(name=cq_name, db=database, resample=resample, select=select, group_by=group_by))
+                logger.info('Created continuous query {}'.format(cq_name))
+
+                if options['backfill']:
+                    self.backfill(client, database, raw_rp, measurement, tier, select, group_by)
+
+    def backfill(self, client, database, raw_rp, measurement, tier, select, group_by):
+        """
+        Compute a rollup from the raw points already stored, one window of `INFLUX_ROLLUP_BACKFILL_WINDOW` at a time.
+        """
+        oldest = list(client.query('SELECT value FROM "{db}"."{rp}"."{m}" LIMIT 1'.format(
+            db=database, rp=raw_rp, m=measurement), epoch='s').get_points())
+        if not oldest:
+            logger.info('No raw points of {} to backfill into {}'.format(measurement, tier.name))
+            return
+
+        windows = backfill_windows(tier, oldest[0]['time'], int(time.time()), settings.INFLUX_ROLLUP_BACKFILL_WINDOW)
+        for i, (start, end) in enumerate(windows, 1):
+            try:
+                client.query('{} WHERE time >= {}s AND time < {}s {}'.format(select, start, end, group_by))
+            except Exception:
+                logger.exception('Backfilling {} into {} failed in window {} of {} ({}s to {}s)'.format(
+                    measurement, tier.name, i, len(windows), start, end))
+                raise
+            logger.info('Backfilled {} into {}: window {} of {}'.format(measurement, tier.name, i, len(windows)))
+
+    def create_retention_policies(self, client, database):
+        """
+        Create or alter the rollup policies. The default policy of the database, which receives the raw points, is left
+        as it is.
+
+        :return: the name of the default policy
+        """
+        policies = list(client.query('SHOW RETENTION POLICIES ON "{}"'.format(database)).get_points())
+        existing = {rp['name'] for rp in policies}
+        raw_rp = next(rp['name'] for rp in policies if rp['default'])
+        if raw_rp != settings.INFLUX_RETENTION_POLICIES[0]['name']:
+            logger.warn('Raw points are written to the default retention policy {}, not to {}'.format(
+                raw_rp, settings.INFLUX_RETENTION_POLICIES[0]['name']))
+
+        for rp in settings.INFLUX_RETENTION_POLICIES[1:]:
+            if rp['name'] in existing:
+                statement = 'ALTER RETENTION POLICY "{name}" ON "{db}" DURATION {duration}'
+            else:
+                statement = 'CREATE RETENTION POLICY "{name}" ON "{db}" DURATION {duration} REPLICATION 1'
+            client.query(statement.format(name=rp['name'], db=database, duration=rp['duration']))
+            logger.info('Set retention policy {} to {}'.format(rp['name'], rp['duration']))
+        return raw_rp
+
+    def continuous_queries(self, client, database):
+        result = client.query('SHOW CONTINUOUS QUERIES')
+        return {cq['name'] for cq in result.get_points(measurement=database)}
@@ -0,0 +1,419 @@
+"""
+Publishing to the IODICUS exchange.
+
+:class:`ChannelManager` owns the amqpstorm connection of a process. It reopens the connection with backoff when it is
+lost, declares the exchange once per connection and serialises the use of the channel between threads. Celery tasks
+and :class:`ChangeRecordPublisher` share the manager of their process, see :func:`get_channel_manager`.
+
+:class:`ChangeRecordPublisher` publishes change records from a background thread. Messages are collected for up to
+`IODICUS_PUBLISH_LINGER` seconds (or until `IODICUS_PUBLISH_MAX_BATCH` messages are waiting) and published as a batch
+in one transaction. A batch that fails is queued again. With `IODICUS_PUBLISH_COALESCE` several changes of the same key
+(e.g. device parameter) within a batch are merged into one message.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import amqpstorm
+import simplejson as json
+from django.conf import settings
+
+__author__ = 'schien'
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_PROPERTIES = {
+    'delivery_mode': 2,  # make message persistent
+    'content_type': 'application/json',
+}
+
+
+def coalesce_change_records(first, last):
+    """
+    Merge two change records of the same series: the change goes from the value before the first to the value of the
+    last record.
+    """
+    merged = dict(last)
+    if 'previous' in first:
+        merged['previous'] = first['previous']
+    return merged
+
+
+class ChannelManager(object):
+    """
+    A channel to the IODICUS exchange that is reopened when its connection is lost.
+
+    Opening the connection is retried up to `attempts` times, waiting `backoff` seconds after the first failure and
+    doubling the wait up to `max_backoff`. A publish that fails because the connection was lost is retried once on a
+    new connection.
+
+    - `confirm`: publish in transactions, so that the broker has accepted the messages when a publish returns. The
+      messages of a batch are committed at once rather than confirmed one by one.
+    """
+
+    def __init__(self, confirm=True, attempts=5, backoff=0.5, max_backoff=30.):
+        self.confirm = confirm
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._connection = None
+        self._channel = None
+        self._pid = None
+        # amqpstorm channels must not be used by several threads at once
+        self._lock = threading.RLock()
+
+        self.published_count = 0
+        self.failed_count = 0
+        self.reconnect_count = 0
+
+    def _is_open(self):
+        if self._channel is None or self._pid != os.getpid():
+            return False
+        return self._connection.is_open and self._channel.is_open
+
+    def _open(self):
+        connection = amqpstorm.Connection(settings.IODICUS_MESSAGING_HOST,
+                                          settings.IODICUS_MESSAGING_USER,
+                                          settings.IODICUS_MESSAGING_PASSWORD,
+                                          port=settings.IODICUS_MESSAGING_PORT,
+                                          ssl=settings.IODICUS_MESSAGING_SSL)
+        channel = connection.channel()
+        # the exchange is not durable, declare it again on a new connection in case the broker was restarted
+        channel.exchange.declare(exchange=settings.IODICUS_MESSAGING_EXCHANGE_NAME, exchange_type='fanout')
+        if self.confirm:
+            channel.tx.select()
+        return connection, channel
+
+    def _reset(self):
+        # a connection inherited from the parent process belongs to the parent, leave it alone
+        if self._connection is not None and self._pid == os.getpid():
+            try:
+                self._connection.close()
+            except Exception:
+                logger.debug('Closing a broken messaging connection failed', exc_info=True)
+        self._connection = None
+        self._channel = None
+
+    def _get_channel(self):
+        """
+        :return: the open channel, reconnecting if necessary
+        """
+        with self._lock:
+            if self._is_open():
+                return self._channel
+
+            reconnect = self._pid == os.getpid()
+            self._reset()
+            wait = self.backoff
+            for attempt in range(1, self.attempts + 1):
+                try:
+                    self._connection, self._channel = self._open()
+                    break
+                except amqpstorm.AMQPError:
+                    if attempt == self.attempts:
+                        raise
+                    logger.warn('Connecting to the messaging broker failed (attempt {}), retrying in {}s'.format(
+                        attempt, wait))
+                    time.sleep(wait)
+                    wait = min(wait * 2, self.max_backoff)
+
+            self._pid = os.getpid()
+            if reconnect:
+                self.reconnect_count += 1
+                logger.info('Reconnected to the messaging broker')
+            return self._channel
+
+    def publish(self, body, properties=None):
+        """
+        Publish a message to the IODICUS exchange.
+
+        :param body: the message, a string
+        :param properties: message properties, persistent JSON messages by default
+        :return: True
+        :raises amqpstorm.AMQPError: if the broker can not be reached or rejected the message
+        """
+        self.publish_batch([body], properties)
+        return True
+
+    def publish_batch(self, bodies, properties=None):
+        """
+        Publish messages to the IODICUS exchange. With `confirm` the messages are committed in one transaction, either
+        all or none of them are published.
+
+        :param bodies: the messages, strings
+        :param properties: message properties, persistent JSON messages by default
+        :raises amqpstorm.AMQPError: if the broker can not be reached or rejected the messages
+        """
+        properties = properties or MESSAGE_PROPERTIES
+        with self._lock:
+            for retry in (False, True):
+                try:
+                    channel = self._get_channel()
+                    for body in bodies:
+                        channel.basic.publish(body=body, routing_key='',
+                                              exchange=settings.IODICUS_MESSAGING_EXCHANGE_NAME,
+                                              properties=properties)
+                    if self.confirm:
+                        channel.tx.commit()
+                    break
+                except amqpstorm.AMQPConnectionError:
+                    # the connection was lost, e.g. because the broker restarted. The transaction is discarded with it.
+                    self._reset()
+                    if retry:
+                        self.failed_count += len(bodies)
+                        raise
+                except amqpstorm.AMQPError:
+                    # drop the channel, so that the messages of the failed transaction are not committed later
+                    self._reset()
+                    self.failed_count += len(bodies)
+                    raise
+
+            self.published_count += len(bodies)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'published': self.published_count,
+                'failed': self.failed_count,
+                'reconnects': self.reconnect_count,
+            }
+
+    def close(self):
+        with self._lock:
+            self._reset()
+
+
+class ChangeRecordPublisher(object):
+    """
+    Publishes messages (JSON serialisable dicts) to the IODICUS exchange in micro batches, through a
+    :class:`ChannelManager`.
+
+    - `linger`: seconds the first message of a batch waits for more messages
+    - `max_batch`: number of waiting messages that triggers a publish before the linger has passed
+    - `coalesce`: merge messages with the same key while they wait, see :func:`coalesce_change_records`
+    """
+
+    def __init__(self, channel_manager, linger=0.05, max_batch=100, coalesce=False):
+        self.channel_manager = channel_manager
+        self.linger = linger
+        self.max_batch = max_batch
+        self.coalesce = coalesce
+
+        # key -> message, keys of messages that are not coalesced are unique
+        self._pending = OrderedDict()
+        # seconds to wait before a failed batch is published again
+        self.retry_wait = channel_manager.backoff
+        self._oldest = None
+        self._in_flight = 0
+        self._sequence = 0
+        # number of callers waiting in flush, the linger is skipped while there are any
+        self._flushing = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+        self.submitted_count = 0
+        self.coalesced_count = 0
+        self.published_count = 0
+        self.failed_count = 0
+        self.batch_count = 0
+
+    def publish(self, message, key=None):
+        """
+        Queue a message for publishing.
+
+        :param message: a JSON serialisable dict
+        :param key: messages with the same key are merged if coalescing is enabled
+        """
+        with self._condition:
+            self._sequence += 1
+            if not self.coalesce or key is None:
+                key = (None, self._sequence)
+
+            if key in self._pending:
+                self._pending[key] = coalesce_change_records(self._pending[key], message)
+                self.coalesced_count += 1
+            else:
+                self._pending[key] = message
+            self.submitted_count += 1
+
+            if self._oldest is None:
+                self._oldest = time.time()
+            self._ensure_thread()
+            self._condition.notify_all()
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='iodicus-publisher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _next_batch(self):
+        """
+        Wait for the linger of the oldest message to pass, or for a full batch.
+
+        :return: list of (key, message) or None if the publisher was stopped and nothing is pending
+        """
+        with self._condition:
+            while True:
+                if self._pending:
+                    wait = self._oldest + self.linger - time.time()
+                    if wait <= 0 or len(self._pending) >= self.max_batch or self._flushing or self._stopped:
+                        break
+                    self._condition.wait(wait)
+                elif self._stopped:
+                    return None
+                else:
+                    self._condition.wait()
+
+            batch = []
+            while self._pending and len(batch) < self.max_batch:
+                batch.append(self._pending.popitem(last=False))
+            self._oldest = time.time() if self._pending else None
+            self._in_flight = len(batch)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                published = self._publish_batch(batch)
+            finally:
+                with self._condition:
+                    self._in_flight = 0
+                    self._condition.notify_all()
+            if not published:
+                with self._condition:
+                    if not self._stopped:
+                        self._condition.wait(self.retry_wait)
+
+    def _publish_batch(self, batch):
+        """
+        :param batch: list of (key, message)
+        :return: False if the batch failed and was queued again
+        """
+        try:
+            self.channel_manager.publish_batch([json.dumps(message) for _, message in batch])
+        except Exception:
+            with self._condition:
+                self.failed_count += len(batch)
+                if self._stopped:
+                    logger.exception('Publishing change records failed, {} messages lost'.format(len(batch)))
+                    return True
+                logger.exception('Publishing change records failed, {} messages queued again'.format(len(batch)))
+                self._requeue(batch)
+            return False
+
+        with self._condition:
+            self.published_count += len(batch)
+            self.batch_count += 1
+        logger.debug('Published {} change records'.format(len(batch)))
+        return True
+
+    def _requeue(self, batch):
+        """
+        Put the messages of a failed batch in front of the pending messages. Must be called holding the condition.
+        """
+        pending = OrderedDict(batch)
+        for key, message in self._pending.items():
+            if key in pending:
+                pending[key] = coalesce_change_records(pending[key], message)
+            else:
+                pending[key] = message
+        self._pending = pending
+        self._oldest = time.time()
+
+    def flush(self, timeout=10.):
+        """
+        Publish all queued messages now and wait until they are published.
+
+        :return: False if the timeout passed first
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            self._flushing += 1
+            try:
+                if self._pending:
+                    self._ensure_thread()
+                    self._condition.notify_all()
+                while self._pending or self._in_flight:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                return True
+            finally:
+                self._flushing -= 1
+
+    def stats(self):
+        with self._condition:
+            return {
+                'pending': len(self._pending),
+                'submitted': self.submitted_count,
+                'coalesced': self.coalesced_count,
+                'published': self.published_count,
+                'failed': self.failed_count,
+                'batches': self.batch_count,
+            }
+
+    def close(self, timeout=10.):
+        """
+        Publish the queued messages and stop the publisher thread.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+_channel_manager = None
+_channel_manager_pid = None
+_publisher = None
+_publisher_pid = None
+_lock = threading.Lock()
+
+
+def get_channel_manager():
+    """
+    Return the channel manager of the current process. Connections are not shared with forked processes (e.g. celery
+    prefork workers), threads of a process share the manager.
+    """
+    global _channel_manager, _channel_manager_pid
+
+    if _channel_manager is None or _channel_manager_pid != os.getpid():
+        with _lock:
+            if _channel_manager is None or _channel_manager_pid != os.getpid():
+                _channel_manager = ChannelManager(confirm=settings.IODICUS_PUBLISH_CONFIRM,
+                                                  attempts=settings.IODICUS_MESSAGING_CONNECT_ATTEMPTS,
+                                                  backoff=settings.IODICUS_MESSAGING_BACKOFF,
+                                                  max_backoff=settings.IODICUS_MESSAGING_MAX_BACKOFF)
+                _channel_manager_pid = os.getpid()
+                atexit.register(_channel_manager.close)
+    return _channel_manager
+
+
+def get_publisher():
+    """
+    Return the change record publisher of the current process. Connections are not shared with forked processes.
+    """
+    global _publisher, _publisher_pid
+
+    channel_manager = get_channel_manager()
+    if _publisher is None or _publisher_pid != os.getpid():
+        with _lock:
+            if _publisher is None or _publisher_pid != os.getpid():
+                _publisher = ChangeRecordPublisher(channel_manager,
+                                                   linger=settings.IODICUS_PUBLISH_LINGER,
+                                                   max_batch=settings.IODICUS_PUBLISH_MAX_BATCH,
+                                                   coalesce=settings.IODICUS_PUBLISH_COALESCE)
+                _publisher_pid = os.getpid()
+                atexit.register(_publisher.close)
+    return _publisher
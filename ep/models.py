@@ -1,20 +1,27 @@
 import logging
+import math
+import os
+import re
+from collections import OrderedDict
 from decimal import Decimal
 from datetime import datetime
 
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 
-import ep
 import requests
-import simplejson as json
 from django.conf import settings
+from django.core.cache import caches
 from django.db import models
-from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from influxdb import InfluxDBClient
 from weekday_field.fields import WeekdayField
 
+from ep.messaging import get_publisher
+from ep.timeseries import get_write_buffer, flush_writes, LastValueCache, LastValue, \
+    iter_query_points, rollup_measurements, select_rollup_tier, ROLLUP_AGGREGATIONS, encode_point, series_key, \
+    to_epoch_ns, SelectQuery, run_query, parse_duration
+
 logger = logging.getLogger(__name__)
 
 
@@ -298,6 +305,12 @@ class ScheduleDeviceParameterGroup(models.Model):
 session = requests.Session()
 
 
+def ts_client():
+    return InfluxDBClient(settings.INFLUXDB_HOST, settings.INFLUXDB_PORT, settings.INFLUXDB_USER,
+                          settings.INFLUXDB_PASSWORD, settings.INFLUX_DB_NAME, session=session,
+                          timeout=settings.INFLUXDB_TIMEOUT)
+
+
 class TSMeasurements(object):
     MEASUREMENT_NAME = 'TS'
     DEFAULT_TAG_NAME = None
@@ -308,8 +321,7 @@ class TSMeasurements(object):
         self.DEFAULT_TAG_NAME = tag_name
         self.DEFAULT_TAG_VALUE = tag_value
 
-        self.client = InfluxDBClient(settings.INFLUXDB_HOST, settings.INFLUXDB_PORT, settings.INFLUXDB_USER,
-                                     settings.INFLUXDB_PASSWORD, settings.INFLUX_DB_NAME, session=session)
+        self.client = ts_client()
 
     @staticmethod
     def time():
@@ -317,80 +329,70 @@ class TSMeasurements(object):
 
     def add(self, time=None, value=None, tags=None):
         """
-        :time: a datetime
+        :time: a datetime, ISO string or int of nanoseconds since the epoch. Defaults to now.
         :value: a measurement value
         :tags: a dictionary of additional tags to include
         """
 
         if time is None:
-            time = self.time()
-
-        if type(time) is datetime:
-            time = time.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-        json_body = [
-            {
-                "measurement": "{}".format(self.MEASUREMENT_NAME),
-                "tags": tags,
-                "time": time,
-                "fields": {
-                    "value": float(value)
-                }
-            }
-        ]
-
-        logger.debug("Writing to TS DB", extra=json_body[0])
-        self.client.write_points(json_body)
-
-    def count(self, tag_name=None, tag_value=None):
+            time = datetime.utcnow()
+
+        get_write_buffer().add(encode_point(series_key(self.MEASUREMENT_NAME, tags), value, to_epoch_ns(time)))
+
+    def query(self, query):
+        """
+        Run a query against the TS DB. Points still buffered by this process are written first so that they are
+        visible to the query.
+        """
+        flush_writes()
+        return self.client.query(query)
+
+    def run(self, query):
+        """
+        Run a :class:`ep.timeseries.SelectQuery`, see :func:`ep.timeseries.run_query`.
+        """
+        return run_query(self.client, query)
+
+    def select(self, *expressions, tag_name=None, tag_value=None, retention_policy=None):
+        """
+        :return: a :class:`ep.timeseries.SelectQuery` of this measurement, restricted to the series of the tag
+        """
         tag_name = tag_name or self.DEFAULT_TAG_NAME
         tag_value = tag_value or self.DEFAULT_TAG_VALUE
 
+        query = SelectQuery(self.MEASUREMENT_NAME, retention_policy).select(*expressions)
         if tag_name and tag_value:
-            query = "SELECT count(value) FROM {measurement_name} WHERE {tag_name} = '{tag_value}'".format(
-                measurement_name=self.MEASUREMENT_NAME, tag_value=int(tag_value),
-                tag_name=tag_name)
-        else:
-            query = "SELECT count(value) FROM {}".format(self.MEASUREMENT_NAME)
-        result = list(self.client.query(query).get_points())
+            query.where_tag(tag_name, int(tag_value))
+        return query
+
+    def count(self, tag_name=None, tag_value=None, start_date=None, end_date=None):
+        query = self.select('count(value)', tag_name=tag_name, tag_value=tag_value).time_range(start_date, end_date)
+        result = list(self.run(query).get_points())
 
         if result:
             return result[0]['count']
         else:
             return 0
 
-    def exists(self, tag_name=None, tag_value=None):
+    def exists(self, tag_name=None, tag_value=None, start_date=None, end_date=None):
         """
-        Returns true if measurement exists
+        Returns true if measurement exists. Probes for a single point rather than counting the series.
         :param tag_name:
         :param tag_value:
+        :param start_date: only consider points after this UTC datetime
+        :param end_date: only consider points up to this UTC datetime
         :return:
         """
-        tag_name = tag_name or self.DEFAULT_TAG_NAME
-        tag_value = tag_value or self.DEFAULT_TAG_VALUE
-
-        if tag_name and tag_value:
-            query = "SELECT count(value) FROM {measurement_name} WHERE {tag_name} = '{tag_value}'".format(
-                measurement_name=self.MEASUREMENT_NAME, tag_value=int(tag_value),
-                tag_name=tag_name)
-        else:
-            query = "SELECT count(value) FROM {}".format(self.MEASUREMENT_NAME)
-        result = list(self.client.query(query).get_points())
-
-        if result and result[0]['count'] > 0:
-            return True
-        else:
-            return False
+        query = self.select('value', tag_name=tag_name, tag_value=tag_value).time_range(start_date, end_date).limit(1)
+        return bool(list(self.run(query).get_points()))
 
     def latest(self, tag_name=None, tag_value=None):
         tag_name = tag_name or self.DEFAULT_TAG_NAME
         tag_value = tag_value or self.DEFAULT_TAG_VALUE
 
         if tag_name and tag_value:
-            query = "SELECT * FROM {measurement_name} WHERE {tag_name} = '{tag_value}' order by time desc limit 1".format(
-                measurement_name=self.MEASUREMENT_NAME, tag_value=int(tag_value),
-                tag_name=tag_name)
-            result = list(self.client.query(query).get_points())
+            query = self.select(tag_name=tag_name, tag_value=tag_value).order_by_time_desc().limit(1)
+            result = list(self.run(query).get_points())
             if result:
                 latest = result[0]
                 # populate regular value key
@@ -398,43 +400,227 @@ class TSMeasurements(object):
                 return latest
         return None
 
-    def all(self, tag_name=None, tag_value=None, start_date=None):
+    AGGREGATIONS = ('mean', 'min', 'max', 'last', 'sum', 'count')
+    INTERVAL_PATTERN = re.compile(r'^[1-9][0-9]*(ms|s|m|h|d|w)$')
+
+    def rollup_tier(self, interval, start_date):
         """
-        :start_date: an UTC datetime
-        @todo cast return values to Decimal for internal consistency
+        The rollup to aggregate from, see :func:`ep.timeseries.select_rollup_tier`. Rollups lag behind the raw points
+        by up to one rollup interval.
+
+        :return: a :class:`ep.timeseries.RollupTier` or None to aggregate the raw points
         """
-        tag_name = tag_name or self.DEFAULT_TAG_NAME
-        tag_value = tag_value or self.DEFAULT_TAG_VALUE
+        if not settings.INFLUX_ROLLUPS_ENABLED or self.MEASUREMENT_NAME not in rollup_measurements():
+            return None
+        return select_rollup_tier(interval, start_date)
 
-        query = "SELECT value FROM {}".format(self.MEASUREMENT_NAME)
+    def all_query(self, tag_name=None, tag_value=None, start_date=None, end_date=None, interval=None, agg=None,
+                  before=None, limit=None):
+        """
+        Build the :class:`ep.timeseries.SelectQuery` for :func:`all` and :func:`stream`. Raises a ValueError for
+        invalid arguments.
+        """
+        if agg is not None and interval is None:
+            raise ValueError('An aggregation requires an interval')
+
+        if interval is not None:
+            agg = agg or 'mean'
+            if agg not in self.AGGREGATIONS:
+                raise ValueError('Unsupported aggregation {}'.format(agg))
+            if not self.INTERVAL_PATTERN.match(interval):
+                raise ValueError('Invalid interval {}'.format(interval))
+            if not start_date:
+                raise ValueError('An interval requires a start date')
+            tier = self.rollup_tier(interval, start_date)
+            if tier is None:
+                query = self.select('{agg}(value) AS value'.format(agg=agg), tag_name=tag_name, tag_value=tag_value)
+            else:
+                query = self.select('{} AS value'.format(ROLLUP_AGGREGATIONS[agg]),
+                                    tag_name=tag_name, tag_value=tag_value, retention_policy=tier.name)
+            query.group_by_time(interval)
+        else:
+            query = self.select('value', tag_name=tag_name, tag_value=tag_value)
 
-        with_where = False
-        if tag_name and tag_value:
-            with_where = True
-            query += " WHERE {tag_name}='{tag_value}'".format(
-                tag_value=int(tag_value), tag_name=tag_name)
+        query.time_range(start_date, end_date)
+        if before:
+            # cursors are kept as returned by InfluxDB, they have nanosecond precision
+            query.where_time('<', before)
 
-        if start_date:
-            if with_where:
-                query += " AND "
-            else:
-                query += " WHERE "
-            query += "time > '{}'".format(start_date.replace(tzinfo=timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f"))
-        query += " order by time desc"
-        result = self.client.query(query)
+        query.order_by_time_desc()
+        if limit is not None:
+            query.limit(limit)
+        return query
+
+    def all(self, tag_name=None, tag_value=None, start_date=None, end_date=None, interval=None, agg=None,
+            before=None, limit=None):
+        """
+        :start_date: an UTC datetime
+        :end_date: an UTC datetime, inclusive
+        :interval: an InfluxDB duration (e.g. `15m`). If given, values are aggregated into buckets of this size
+        :agg: the aggregation applied per interval, one of `AGGREGATIONS`. Default `mean`.
+        :before: an UTC datetime or a time string as returned by InfluxDB, exclusive. Use as a pagination cursor.
+        :limit: the maximum number of values to return
+        @todo cast return values to Decimal for internal consistency
+        """
+        query = self.all_query(tag_name, tag_value, start_date, end_date, interval, agg, before, limit)
+        result = self.run(query)
 
         return result.get_points()
 
+    def stream(self, chunk_size=10000, **kwargs):
+        """
+        Like :func:`all`, but the values are read from InfluxDB in chunks while the returned generator is consumed.
+        """
+        return iter_query_points(self.client, self.all_query(**kwargs), chunk_size=chunk_size)
+
 
 class DPMeasurements(TSMeasurements):
     device_parameter = None
     INFLUX_DEVICE_PARAMETER_MEASUREMENT_NAME = 'device_parameters%s' % settings.INFLUX_MEASUREMENT_SUFFIX
     TAG = 'dp'
 
+    _last_value_cache = None
+    _last_value_cache_pid = None
+
     def __init__(self, device_parameter=None):
         self.device_parameter = device_parameter
         super().__init__(self.INFLUX_DEVICE_PARAMETER_MEASUREMENT_NAME, self.TAG, self.device_parameter.id)
 
+    @classmethod
+    def last_values(cls, device_parameter_ids=None):
+        """
+        Fetch the most recent value of many device parameters with a single query.
+
+        :param device_parameter_ids: ids of the device parameters, all device parameters if None
+        :return: dict of device parameter id -> :class:`LastValue`
+        """
+        query = SelectQuery(cls.INFLUX_DEVICE_PARAMETER_MEASUREMENT_NAME).select('last(value)').group_by_tags(cls.TAG)
+        if device_parameter_ids is not None:
+            if not device_parameter_ids:
+                return {}
+            query.where_tag_in(cls.TAG, [int(i) for i in device_parameter_ids])
+
+        result = run_query(ts_client(), query)
+
+        values = {}
+        for (_, tags), points in result.items():
+            for point in points:
+                values[int(tags[cls.TAG])] = LastValue(parse_datetime(point['time']), Decimal(str(point['last'])))
+        return values
+
+    @classmethod
+    def all_series(cls, device_parameter_ids, start_date=None, end_date=None, interval=None, agg=None, limit=None):
+        """
+        Fetch the values of many device parameters with a single query, grouped by device parameter. The arguments are
+        those of :func:`TSMeasurements.all`, `limit` applies to each device parameter.
+
+        :return: dict of device parameter id -> list of points, most recent first
+        """
+        if not device_parameter_ids:
+            return {}
+
+        measurements = TSMeasurements(cls.INFLUX_DEVICE_PARAMETER_MEASUREMENT_NAME)
+        query = cls.all_series_query(device_parameter_ids, start_date, end_date, interval, agg, limit)
+
+        return {int(tags[cls.TAG]): list(points) for (_, tags), points in measurements.run(query).items()}
+
+    @classmethod
+    def all_series_query(cls, device_parameter_ids, start_date=None, end_date=None, interval=None, agg=None,
+                         limit=None):
+        """
+        Build the :class:`ep.timeseries.SelectQuery` for :func:`all_series`. Raises a ValueError for invalid arguments.
+        """
+        measurements = TSMeasurements(cls.INFLUX_DEVICE_PARAMETER_MEASUREMENT_NAME)
+        query = measurements.all_query(start_date=start_date, end_date=end_date, interval=interval, agg=agg,
+                                       limit=limit)
+        return query.where_tag_in(cls.TAG, [int(i) for i in device_parameter_ids]).group_by_tags(cls.TAG)
+
+    @classmethod
+    def aligned_rows(cls, device_parameter_ids, start_date=None, end_date=None, interval=None, agg=None, window=None,
+                     chunk_size=10000):
+        """
+        Fetch the values of many device parameters aligned on a common time index. The time range is read one window
+        at a time, so that only the points of a window are held in memory. Raises a ValueError for invalid arguments.
+
+        :param start_date: the start of the time range, required
+        :param window: seconds per query, `MEASUREMENT_EXPORT_WINDOW` by default. Rounded up to a multiple of the
+            interval, so that no aggregation bucket is split between windows.
+        :return: iterator of rows, lists of the time (milliseconds since the epoch, ascending) followed by the values
+            of the device parameters in the order of `device_parameter_ids`. Values missing at a time are None.
+        """
+        if not start_date:
+            raise ValueError('An export requires a start date')
+        device_parameter_ids = [int(i) for i in device_parameter_ids]
+        if not device_parameter_ids:
+            return iter([])
+        # validate the arguments before the first row is requested
+        cls.all_series_query(device_parameter_ids, start_date=start_date, end_date=end_date, interval=interval, agg=agg)
+
+        window = window or settings.MEASUREMENT_EXPORT_WINDOW
+        step = parse_duration(interval) if interval else None
+        if step:
+            window = int(math.ceil(window / step)) * step
+        # windows are aligned to the epoch, like the buckets of InfluxDB
+        first = to_epoch_ns(start_date) // 10 ** 9
+        first -= first % window
+        last = to_epoch_ns(end_date or datetime.utcnow()) // 10 ** 9
+
+        def rows():
+            for window_start in range(first, last + 1, window):
+                query = cls.all_series_query(device_parameter_ids, start_date=start_date, end_date=end_date,
+                                             interval=interval, agg=agg) \
+                    .where_time('>=', datetime.utcfromtimestamp(window_start)) \
+                    .where_time('<', datetime.utcfromtimestamp(window_start + window))
+                # time -> device parameter id -> value
+                values = {}
+                for point in iter_query_points(ts_client(), query, chunk_size=chunk_size, epoch='ms'):
+                    values.setdefault(point['time'], {})[int(point[cls.TAG])] = point['value']
+                for row_time in sorted(values):
+                    yield [row_time] + [values[row_time].get(i) for i in device_parameter_ids]
+
+        return rows()
+
+    @classmethod
+    def aligned_series(cls, device_parameter_ids, max_rows=None, **kwargs):
+        """
+        The rows of :func:`aligned_rows` as columns. The table is held in memory, so it is limited to `max_rows`
+        (`MEASUREMENT_EXPORT_MAX_ROWS` by default) rows. Raises a ValueError for invalid arguments or larger tables.
+
+        :return: OrderedDict with the column `time` and one column of values per device parameter, keyed by the id as
+            string
+        """
+        max_rows = max_rows or settings.MEASUREMENT_EXPORT_MAX_ROWS
+        device_parameter_ids = [int(i) for i in device_parameter_ids]
+        columns = OrderedDict([('time', [])])
+        columns.update((str(i), []) for i in device_parameter_ids)
+
+        for count, row in enumerate(cls.aligned_rows(device_parameter_ids, **kwargs), 1):
+            if count > max_rows:
+                raise ValueError('The export has more than {} rows, narrow the time range or use a larger interval'
+                                 .format(max_rows))
+            for column, value in zip(columns.values(), row):
+                column.append(value)
+        return columns
+
+    @classmethod
+    def last_value_cache(cls) -> LastValueCache:
+        """
+        The last value cache of the current process, see :class:`ep.timeseries.LastValueCache`. Its values are shared
+        with the other processes through the cache `LAST_VALUE_CACHE`, unless that is None.
+        """
+        if cls._last_value_cache is None or cls._last_value_cache_pid != os.getpid():
+            store = caches[settings.LAST_VALUE_CACHE] if settings.LAST_VALUE_CACHE else None
+            DPMeasurements._last_value_cache = LastValueCache(cls.last_values, store=store)
+            DPMeasurements._last_value_cache_pid = os.getpid()
+        return cls._last_value_cache
+
+    def last_value(self) -> LastValue:
+        """
+        The most recent value of this device parameter, usually without querying the TS DB.
+        Unlike :func:`latest` this returns a :class:`LastValue` with an aware `time` datetime and a Decimal `value`.
+        """
+        return self.last_value_cache().get(int(self.device_parameter.id))
+
     def add(self, time=None, value=None, trigger=StateChangeEvent.ON_DEVICE, extra_tags=None):
         tags = {
             self.TAG: "{}".format(int(self.device_parameter.id)),
@@ -445,11 +631,12 @@ class DPMeasurements(TSMeasurements):
         if extra_tags is not None:
             tags.update(extra_tags)
 
-        latest = self.latest()
+        latest = self.last_value()
         super().add(time, value, tags)
+        self.last_value_cache().update(int(self.device_parameter.id), time or self.time(), value)
 
         # @todo check with Critical...
-        latest_value = latest['value'] if latest else None
+        latest_value = latest.value if latest else None
         if not latest or latest_value != value:
             site = self.device_parameter.device.node.gateway.site.name
             logger.debug('Device parameter state change',
@@ -467,7 +654,7 @@ class DPMeasurements(TSMeasurements):
                 "Broadcasting measured device state change for device parameter {}".format(self.device_parameter.id),
                 extra=message)
 
-            ep.tasks.send_msg.delay(json.dumps(message))
+            get_publisher().publish(message, key=self.device_parameter.id)
 
 
 class GCSMeasurements(TSMeasurements):
@@ -0,0 +1,60 @@
+from collections import OrderedDict
+
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+__author__ = 'schien'
+
+
+class MeasurementCursorPagination(BasePagination):
+    """
+    Cursor pagination for measurement series, keyed on the measurement timestamp.
+
+    Pagination is only applied if the request has a `limit` query parameter, otherwise the full series is returned
+    as before. The `next` link carries a `before` cursor with the time of the last (oldest) measurement of the page.
+    The view is expected to query `limit + 1` measurements (see :func:`get_query_limit`) so that the paginator can tell
+    whether there is a next page.
+    """
+    limit_query_param = 'limit'
+    cursor_query_param = 'before'
+    max_limit = 100000
+
+    def get_limit(self, request):
+        if self.limit_query_param not in request.query_params:
+            return None
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except ValueError:
+            raise ValidationError('limit must be an integer.')
+        if limit <= 0:
+            raise ValidationError('limit must be positive.')
+        return min(limit, self.max_limit)
+
+    def get_query_limit(self, request):
+        limit = self.get_limit(request)
+        return limit + 1 if limit is not None else None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+
+        self.request = request
+        page = list(queryset)
+        self.has_next = len(page) > self.limit
+        page = page[:self.limit]
+        self.cursor = page[-1]['time'] if page else None
+        return page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
@@ -0,0 +1,155 @@
+import csv
+import io
+from collections import OrderedDict
+
+import simplejson as json
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from ep.timeseries import to_epoch_ms
+
+# MessagePack is optional, the msgpack format is only offered if it is installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__author__ = 'schien'
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Renders a list as newline delimited JSON, one element per line.
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if not isinstance(data, (list, tuple)):
+            data = [data]
+        return b''.join(self.render_line(item) for item in data)
+
+    @staticmethod
+    def render_line(item):
+        return (json.dumps(item, cls=JSONEncoder) + '\n').encode('utf-8')
+
+    def stream(self, items):
+        for item in items:
+            yield self.render_line(item)
+
+
+def stream_json_list(items):
+    """
+    Yield a JSON array chunk by chunk, one element at a time.
+    """
+    yield b'['
+    first = True
+    for item in items:
+        yield (json.dumps(item, cls=JSONEncoder) if first else ',' + json.dumps(item, cls=JSONEncoder)).encode('utf-8')
+        first = False
+    yield b']'
+
+
+def to_columns(measurements):
+    """
+    Turn a list of measurements into parallel arrays of times in milliseconds since the epoch and values, e.g.
+    `[{'time': '2016-05-18T14:46:52.950287872Z', 'value': 0}]` becomes `{'time': [1463582812950], 'value': [0]}`.
+    """
+    times = []
+    values = []
+    for measurement in measurements:
+        times.append(to_epoch_ms(measurement['time']))
+        values.append(measurement['value'])
+    return OrderedDict([('time', times), ('value', values)])
+
+
+def to_columnar(data):
+    """
+    The columnar form of a measurement list or a page of measurements. Pages keep their other keys (e.g. `next`) next
+    to the columns.
+    """
+    if isinstance(data, dict) and 'results' in data:
+        columnar = OrderedDict((key, value) for key, value in data.items() if key != 'results')
+        columnar.update(to_columns(data['results']))
+        return columnar
+    if isinstance(data, (list, tuple)):
+        return to_columns(data)
+    # errors and other details are rendered unchanged
+    return data
+
+
+class ColumnarRenderer(BaseRenderer):
+    """
+    Base class of renderers that return measurements as parallel `time` (epoch milliseconds) and `value` arrays.
+    """
+
+
+class ColumnarJSONRenderer(ColumnarRenderer):
+    media_type = 'application/vnd.iodicus.columnar+json'
+    format = 'columnar'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return json.dumps(to_columnar(data), cls=JSONEncoder).encode('utf-8')
+
+
+class MessagePackRenderer(ColumnarRenderer):
+    media_type = 'application/x-msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(to_columnar(data), use_bin_type=True)
+
+
+class CSVRenderer(BaseRenderer):
+    """
+    Renders a table given as columns, e.g. `{'time': [1463582810000, 1463582812950], '12': [20.5, None]}`, as CSV with
+    a header row. Values that are not lists (e.g. the details of an error) are rendered as a single row.
+    """
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+    rows_per_chunk = 1000
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return b''.join(self.stream(data))
+
+    def stream(self, columns):
+        """
+        Yield the CSV chunk by chunk.
+        """
+        if not isinstance(columns, dict):
+            columns = {'detail': columns}
+        columns = OrderedDict((key, value if isinstance(value, (list, tuple)) else [value])
+                              for key, value in columns.items())
+        return self.stream_rows(columns.keys(), zip(*columns.values()))
+
+    def stream_rows(self, header, rows):
+        """
+        Yield the CSV of a header and an iterable of rows chunk by chunk, consuming the rows as the chunks are sent.
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(header)
+        for i, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if i % self.rows_per_chunk == 0:
+                yield buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode('utf-8')
+
+
+# the columnar renderers available in this installation
+COLUMNAR_RENDERER_CLASSES = [ColumnarJSONRenderer] + ([MessagePackRenderer] if msgpack is not None else [])
@@ -0,0 +1,102 @@
+"""
+Response cache of the metadata API (sites, gateways, nodes, devices and tariffs).
+
+The serialised data of a response is cached under the request path and the current metadata generation. The
+generation is a counter in the cache that is incremented whenever one of the `METADATA_MODELS` is saved or deleted
+(see `ep.signals.handlers`), which invalidates all cached responses at once. Code that changes them without sending
+signals (e.g. `bulk_create`) calls :func:`bump_generation` itself. Responses carry an ETag derived from the
+generation, so that a client repeating a request with `If-None-Match` gets a `304 Not Modified` without the database
+or the cache entry being read.
+"""
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework import status
+from rest_framework.response import Response
+
+from ep.models import Site, Gateway, Node, Device, DeviceParameter, DeviceType, DeviceParameterType, Tariff, Band, \
+    TariffBandProperty
+
+__author__ = 'schien'
+
+logger = logging.getLogger(__name__)
+
+# models the cached responses are built from
+METADATA_MODELS = (Site, Gateway, Node, Device, DeviceParameter, DeviceType, DeviceParameterType, Tariff, Band,
+                   TariffBandProperty)
+
+GENERATION_KEY = 'api_metadata_generation'
+
+
+def get_cache():
+    return caches[settings.API_RESPONSE_CACHE]
+
+
+def get_generation():
+    """
+    :return: the current metadata generation
+    """
+    cache = get_cache()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # start from the clock, so that a generation lost by an eviction or a restart of the cache is not reused
+        cache.add(GENERATION_KEY, int(time.time() * 1000), None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_generation():
+    """
+    Invalidate all cached responses.
+    """
+    cache = get_cache()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        # the key is missing, the next read starts a new generation
+        pass
+
+
+class CachedResponseMixin(object):
+    """
+    Caches the responses of `GET` requests to list and retrieve views.
+
+    Authentication and permissions are checked before the cache is read, only the serialised data is cached so that the
+    response can be rendered in any of the view's formats.
+    """
+
+    def get_response_cache_key(self, request, generation):
+        path = hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest()
+        return 'api_response:{}:{}'.format(generation, path)
+
+    def get_etag(self, request, generation):
+        return '"{}-{}"'.format(generation, hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest()[:16])
+
+    def cached_response(self, request, handler, *args, **kwargs):
+        generation = get_generation()
+        etag = self.get_etag(request, generation)
+
+        if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        cache = get_cache()
+        key = self.get_response_cache_key(request, generation)
+        data = cache.get(key)
+        if data is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            data = response.data
+            cache.set(key, data, settings.API_RESPONSE_CACHE_TIMEOUT)
+        else:
+            logger.debug('Serving {} from the response cache'.format(request.path))
+        return Response(data, headers={'ETag': etag})
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(request, super().retrieve, *args, **kwargs)
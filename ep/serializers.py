@@ -1,3 +1,4 @@
+from django.db.models import Prefetch
 from rest_framework import serializers
 
 from ep.models import Node, DeviceParameter, Site, Tariff, Band, TariffBandProperty, Gateway, \
@@ -63,6 +64,15 @@ class DeviceSerializer(serializers.ModelSerializer):
             'precedence')
         depth = 0
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """
+        Load the relations the serializer follows with the devices, so that listing devices takes a constant number of
+        queries.
+        """
+        return queryset.select_related('type', 'node__gateway__site').prefetch_related(
+            Prefetch('parameters', queryset=DeviceParameter.objects.select_related('type')))
+
 
 class DeviceParameterSerializer(serializers.ModelSerializer):
     site = serializers.CharField(source='device.node.site.name', read_only=True)
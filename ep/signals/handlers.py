@@ -1,11 +1,14 @@
 import logging
 
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.contrib.auth.models import Group, User
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 
 import ep.models
+from ep.groups import invalidate_group_names
+from ep.response_cache import METADATA_MODELS, bump_generation
 
 logger = logging.getLogger(__name__)
 
@@ -20,3 +23,36 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
             Token.objects.create(user=instance)
         else:
             print('Token exists, skipping generation')
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_group_memberships(sender, instance=None, action=None, reverse=False, pk_set=None, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        # the groups of a user changed
+        invalidate_group_names([instance.pk])
+    elif pk_set is not None:
+        # users were added to or removed from a group
+        invalidate_group_names(pk_set)
+    else:
+        # a group was cleared
+        invalidate_group_names()
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def invalidate_group(sender, **kwargs):
+    # a renamed or deleted group changes the group names of its users
+    invalidate_group_names()
+
+
+def invalidate_metadata_responses(sender, **kwargs):
+    bump_generation()
+
+
+for model in METADATA_MODELS:
+    post_save.connect(invalidate_metadata_responses, sender=model, dispatch_uid='invalidate_responses_{}'.format(
+        model.__name__))
+    post_delete.connect(invalidate_metadata_responses, sender=model, dispatch_uid='invalidate_responses_{}'.format(
+        model.__name__))
@@ -1,13 +1,12 @@
 import logging
 from decimal import Decimal
 
-import amqpstorm
 import simplejson as json
 from celery import Task
 from celery import shared_task
-from django.conf import settings
 from django.utils import timezone
 
+from ep.messaging import get_channel_manager
 from ep.models import DeviceParameter, ScheduleDeviceParameterGroup, StateChangeEvent
 
 __author__ = 'schien'
@@ -22,41 +21,24 @@ class ErrorLoggingTask(Task):
 
 class IODICUS_AMQP_Task(Task):
     abstract = True
-    _channel = None
-    _connection = None
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         logger.error("IODICUS_AMQP_Task failed")
         logger.error(einfo)
 
     @property
-    def channel(self):
-        if self._channel is None:
-            self._connection = amqpstorm.Connection(settings.IODICUS_MESSAGING_HOST,
-                                                    settings.IODICUS_MESSAGING_USER,
-                                                    settings.IODICUS_MESSAGING_PASSWORD,
-                                                    port=settings.IODICUS_MESSAGING_PORT,
-                                                    ssl=settings.IODICUS_MESSAGING_SSL)
-
-            self._channel = self._connection.channel()
-
-            self._channel.exchange.declare(exchange=settings.IODICUS_MESSAGING_EXCHANGE_NAME, exchange_type='fanout')
-        return self._channel
+    def channel_manager(self):
+        """
+        The channel manager of the worker process, see :func:`ep.messaging.get_channel_manager`.
+        """
+        return get_channel_manager()
 
 
 @shared_task(base=IODICUS_AMQP_Task, bind=True)
 def send_msg(self, json_payload):
     logger.debug('Publishing new message %s' % json_payload)
 
-    self.channel.basic.publish(body=json_payload,
-                               # body
-                               routing_key='',  # routing key
-                               exchange=settings.IODICUS_MESSAGING_EXCHANGE_NAME,
-                               properties={
-                                   'delivery_mode': 2,  # make message persistent
-                                   'content_type': 'application/json',
-
-                               })
+    self.channel_manager.publish(json_payload)
 
 
 @shared_task(base=ErrorLoggingTask)
@@ -95,7 +77,7 @@ def change_device_state(device_parameter_id: int, target_value: Decimal, trigger
 
 @shared_task
 def health_log_task():
-    logger.info("celery worker alive")
+    logger.info("celery worker alive", extra=get_channel_manager().stats())
 
 
 @shared_task(base=ErrorLoggingTask, bind=True)
@@ -0,0 +1,27 @@
+from unittest.mock import patch, MagicMock
+
+from django.test import SimpleTestCase
+
+from ep.http_sessions import InstrumentedSession
+
+__author__ = 'schien'
+
+
+class InstrumentedSessionTestCase(SimpleTestCase):
+    def test_endpoint_ids_are_collapsed(self):
+        self.assertEqual(InstrumentedSession.endpoint('get', 'https://host/api/SITE/NodeStatus/12?x=1'),
+                         'GET /api/SITE/NodeStatus/{id}')
+
+    @patch('requests.Session.request')
+    def test_default_timeout_and_stats(self, request_mock):
+        request_mock.return_value = MagicMock(status_code=200)
+        session = InstrumentedSession('test', connect_timeout=1., read_timeout=2.)
+
+        session.get('https://host/nodes/1')
+        session.get('https://host/nodes/2', timeout=10)
+
+        self.assertEqual(request_mock.call_args_list[0][1]['timeout'], (1., 2.))
+        self.assertEqual(request_mock.call_args_list[1][1]['timeout'], 10)
+        stats = session.latency_stats()['GET /nodes/{id}']
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['errors'], 0)
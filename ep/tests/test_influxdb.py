@@ -10,6 +10,7 @@ from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from influxdb import InfluxDBClient
 
+from ep.messaging import get_publisher
 from ep.models import DPMeasurements, DeviceParameter, Gateway, GCSMeasurements, DeviceParameterType
 from ep.tests.static_factories import SiteFactory
 from ep_secure_importer.controllers.secure_client import secure_site_name, SecureClient
@@ -60,6 +61,8 @@ class EmptyDBTestCase(TestCase):
         EmptyDBTestCase.client.create_database(INFLUX_DB_NAME)
         EmptyDBTestCase.client.drop_database(INFLUX_DB_NAME)
         EmptyDBTestCase.client.create_database(INFLUX_DB_NAME)
+        # forget values cached from previous tests
+        DPMeasurements.last_value_cache().clear()
 
     def test_simple_DPMeasurements_add(self):
         t = DeviceParameterType(code="TEST")
@@ -144,6 +147,7 @@ class EmptyDBTestCase(TestCase):
         m.add(time=timezone.now(), value=EmptyDBTestCase.v)
         time.sleep(2.5)
         m.add(time=timezone.now(), value=EmptyDBTestCase.v + 1)
+        get_publisher().flush()
         self.assertEqual(receiver.call_count, 1)
         self.assertEqual(receiver.call_args[1]['exchange'], settings.IODICUS_MESSAGING_EXCHANGE_NAME)
 
@@ -158,6 +162,7 @@ class EmptyDBTestCase(TestCase):
         m.add(time=timezone.now(), value=EmptyDBTestCase.v)
         time.sleep(2.5)
         m.add(time=timezone.now(), value=EmptyDBTestCase.v + 1)
+        get_publisher().flush()
         self.assertEqual(mock.call_count, 1)
 
 
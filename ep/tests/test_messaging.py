@@ -0,0 +1,128 @@
+from unittest.mock import patch, MagicMock
+
+import amqpstorm
+import simplejson as json
+from django.test import SimpleTestCase, override_settings
+
+from ep.messaging import ChangeRecordPublisher, ChannelManager
+
+__author__ = 'schien'
+
+
+@override_settings(IODICUS_MESSAGING_HOST='localhost', IODICUS_MESSAGING_USER='guest',
+                   IODICUS_MESSAGING_PASSWORD='guest', IODICUS_MESSAGING_PORT=5672, IODICUS_MESSAGING_SSL=False,
+                   IODICUS_MESSAGING_EXCHANGE_NAME='test_events')
+@patch('ep.messaging.amqpstorm.Connection')
+class ChangeRecordPublisherTestCase(SimpleTestCase):
+    def published(self, connection):
+        publish = connection.return_value.channel.return_value.basic.publish
+        return [json.loads(call[1]['body']) for call in publish.call_args_list]
+
+    def test_publish_batch(self, connection):
+        publisher = ChangeRecordPublisher(ChannelManager(), linger=10.)
+        for i in range(3):
+            publisher.publish({'device_parameter': 1, 'previous': i, 'current': i + 1}, key=1)
+
+        self.assertTrue(publisher.flush())
+        self.assertEqual([message['current'] for message in self.published(connection)], [1, 2, 3])
+        self.assertEqual(publisher.stats()['batches'], 1)
+        # the batch is committed once rather than confirmed message by message
+        connection.return_value.channel.return_value.tx.select.assert_called_once_with()
+        connection.return_value.channel.return_value.tx.commit.assert_called_once_with()
+        publisher.close()
+
+    def test_coalesce(self, connection):
+        publisher = ChangeRecordPublisher(ChannelManager(), linger=10., coalesce=True)
+        for i in range(3):
+            publisher.publish({'device_parameter': 1, 'previous': i, 'current': i + 1}, key=1)
+        publisher.publish({'device_parameter': 2, 'previous': 0, 'current': 5}, key=2)
+
+        self.assertTrue(publisher.flush())
+        self.assertEqual(self.published(connection), [{'device_parameter': 1, 'previous': 0, 'current': 3},
+                                                       {'device_parameter': 2, 'previous': 0, 'current': 5}])
+        self.assertEqual(publisher.stats()['coalesced'], 2)
+        publisher.close()
+
+    def test_max_batch(self, connection):
+        publisher = ChangeRecordPublisher(ChannelManager(), linger=10., max_batch=2)
+        for i in range(5):
+            publisher.publish({'current': i})
+
+        self.assertTrue(publisher.flush())
+        self.assertEqual(len(self.published(connection)), 5)
+        self.assertEqual(publisher.stats()['batches'], 3)
+        publisher.close()
+
+    def test_failed_batch_is_requeued(self, connection):
+        commit = connection.return_value.channel.return_value.tx.commit
+        commit.side_effect = [amqpstorm.AMQPChannelError('closed'), None]
+        publisher = ChangeRecordPublisher(ChannelManager(), linger=10.)
+        publisher.retry_wait = 0
+
+        publisher.publish({'current': 1})
+        publisher.publish({'current': 2})
+        self.assertTrue(publisher.flush())
+
+        self.assertEqual([message['current'] for message in self.published(connection)], [1, 2, 1, 2])
+        self.assertEqual(publisher.stats()['failed'], 2)
+        self.assertEqual(publisher.stats()['published'], 2)
+        self.assertEqual(publisher.stats()['batches'], 1)
+        publisher.close()
+
+    def test_requeued_batch_is_coalesced(self, connection):
+        publisher = ChangeRecordPublisher(ChannelManager(), linger=10., coalesce=True)
+        publisher._pending[1] = {'device_parameter': 1, 'previous': 1, 'current': 2}
+
+        publisher._requeue([(1, {'device_parameter': 1, 'previous': 0, 'current': 1})])
+
+        self.assertEqual(list(publisher._pending.values()), [{'device_parameter': 1, 'previous': 0, 'current': 2}])
+
+
+@override_settings(IODICUS_MESSAGING_HOST='localhost', IODICUS_MESSAGING_USER='guest',
+                   IODICUS_MESSAGING_PASSWORD='guest', IODICUS_MESSAGING_PORT=5672, IODICUS_MESSAGING_SSL=False,
+                   IODICUS_MESSAGING_EXCHANGE_NAME='test_events')
+@patch('ep.messaging.amqpstorm.Connection')
+class ChannelManagerTestCase(SimpleTestCase):
+    def test_exchange_declared_once(self, connection):
+        manager = ChannelManager()
+        manager.publish('{}')
+        manager.publish('{}')
+
+        self.assertEqual(connection.call_count, 1)
+        connection.return_value.channel.return_value.exchange.declare.assert_called_once_with(
+            exchange='test_events', exchange_type='fanout')
+        self.assertEqual(manager.stats(), {'published': 2, 'failed': 0, 'reconnects': 0})
+
+    def test_reconnect_after_lost_connection(self, connection):
+        publish = connection.return_value.channel.return_value.basic.publish
+        publish.side_effect = [True, amqpstorm.AMQPConnectionError('connection lost'), True]
+        manager = ChannelManager()
+
+        manager.publish('{}')
+        # the lost connection is detected and the message is published on a new connection
+        self.assertTrue(manager.publish('{}'))
+
+        self.assertEqual(connection.call_count, 2)
+        self.assertEqual(manager.stats(), {'published': 2, 'failed': 0, 'reconnects': 1})
+
+    def test_closed_connection_is_reopened(self, connection):
+        manager = ChannelManager()
+        manager.publish('{}')
+        connection.return_value.is_open = False
+        manager.publish('{}')
+
+        self.assertEqual(connection.call_count, 2)
+        self.assertEqual(manager.stats()['reconnects'], 1)
+
+    @patch('ep.messaging.time.sleep')
+    def test_connect_backoff(self, sleep, connection):
+        connection.side_effect = [amqpstorm.AMQPConnectionError('refused')] * 3 + [MagicMock()]
+        manager = ChannelManager(attempts=4, backoff=1., max_backoff=3.)
+
+        self.assertTrue(manager.publish('{}'))
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [1., 2., 3.])
+
+        connection.side_effect = amqpstorm.AMQPConnectionError('refused')
+        manager = ChannelManager(attempts=2)
+        with self.assertRaises(amqpstorm.AMQPConnectionError):
+            manager.publish('{}')
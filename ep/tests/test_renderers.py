@@ -0,0 +1,48 @@
+import simplejson as json
+from django.test import SimpleTestCase
+
+from ep.renderers import ColumnarJSONRenderer, MessagePackRenderer, CSVRenderer, to_columnar, msgpack
+
+__author__ = 'schien'
+
+measurements = [{'time': '2016-05-18T14:46:52.950287872Z', 'value': 0},
+                {'time': '2016-05-18T14:46:50Z', 'value': 255.5}]
+
+
+class ColumnarRendererTestCase(SimpleTestCase):
+    def test_list(self):
+        self.assertEqual(to_columnar(measurements), {'time': [1463582812950, 1463582810000], 'value': [0, 255.5]})
+
+    def test_page(self):
+        columnar = to_columnar({'next': 'http://testserver/next', 'results': measurements})
+        self.assertEqual(list(columnar.keys()), ['next', 'time', 'value'])
+        self.assertEqual(columnar['time'], [1463582812950, 1463582810000])
+
+    def test_error_unchanged(self):
+        self.assertEqual(to_columnar({'detail': 'Not found.'}), {'detail': 'Not found.'})
+
+    def test_render_json(self):
+        rendered = ColumnarJSONRenderer().render(measurements)
+        self.assertEqual(json.loads(rendered.decode('utf-8')),
+                         {'time': [1463582812950, 1463582810000], 'value': [0, 255.5]})
+
+    def test_render_msgpack(self):
+        if msgpack is None:
+            self.skipTest('msgpack is not installed')
+        rendered = MessagePackRenderer().render(measurements)
+        self.assertEqual(msgpack.unpackb(rendered, raw=False),
+                         {'time': [1463582812950, 1463582810000], 'value': [0, 255.5]})
+
+
+class CSVRendererTestCase(SimpleTestCase):
+    def test_stream_in_chunks(self):
+        renderer = CSVRenderer()
+        renderer.rows_per_chunk = 2
+        chunks = list(renderer.stream({'time': [1, 2, 3], '12': [20.5, None, 1], '13': [None, 1, 2]}))
+
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(b''.join(chunks).decode('utf-8').splitlines(), ['time,12,13', '1,20.5,', '2,,1', '3,1,2'])
+
+    def test_render_error(self):
+        self.assertEqual(CSVRenderer().render({'detail': 'Not found.'}).decode('utf-8').splitlines(),
+                         ['detail', 'Not found.'])
@@ -2,22 +2,27 @@
 All of the tests here require that the DBs are available. That means, at least the PG and the influxdb containers
  must be running.
 """
+import json
 import logging
-from datetime import timezone, datetime
+from datetime import timezone, datetime, timedelta
 
 from decimal import Decimal
 from django.contrib.auth.models import User, Group
 from django.core.urlresolvers import reverse
+from django.core.cache import caches
+from django.db import connection
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from djcelery.models import PeriodicTask
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 
-from ep.apiviews import uob_estates_group
+from ep.apiviews import uob_estates_group, ebe_group, is_in_group
+from ep.groups import invalidate_group_names
 from ep.models import Device, Node, DeviceParameter, Site, Gateway, Tariff, \
-    ScheduleDeviceParameterGroup
+    ScheduleDeviceParameterGroup, DPMeasurements
 # from ep.tests.static_factories import SiteFactory, factory_devices
-from ep.tests.factories import SiteFactory, TariffFactory
+from ep.tests.factories import SiteFactory, TariffFactory, NodeFactory, DeviceFactory
 
 logger = logging.getLogger(__name__)
 
@@ -32,9 +37,11 @@ node_count = 3
 email = "test@example.com"
 
 
+# responses cached by one test would outlive the rollback of its data
 @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True,
                    CELERY_ALWAYS_EAGER=True,
-                   BROKER_BACKEND='memory')
+                   BROKER_BACKEND='memory',
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
 class BasicAPITestCase(TestCase):
     # fixtures = ['ep_test_data.json', ]
 
@@ -68,6 +75,62 @@ class BasicAPITestCase(TestCase):
         self.assertTrue(response.status_code == 200)
         self.assertTrue(len(response.data) >= measurement_count)
 
+    def test_get_device_measurements_aggregated(self):
+        """
+        Test that the API aggregates measurements into intervals
+        :return:
+        """
+        token = Token.objects.get(user__username=email)
+        device_param = DeviceParameter.objects.first()
+        device_param.measurements.add(time=datetime.now(), value=Decimal(1))
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        url = reverse('api:device_measurements', kwargs={'device_parameter_id': device_param.id})
+
+        response = client.get(url, {'interval': '1d', 'agg': 'max'}, format='json')
+
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(len(response.data) <= 31)
+
+        response = client.get(url, {'interval': '1d', 'agg': 'median; DROP DATABASE'}, format='json')
+        self.assertTrue(response.status_code == 400)
+
+    def test_get_device_measurements_paginated(self):
+        """
+        Test that the API pages through measurements with a time cursor and streams NDJSON
+        :return:
+        """
+        token = Token.objects.get(user__username=email)
+        device_param = DeviceParameter.objects.first()
+        for i in range(3):
+            device_param.measurements.add(time=datetime.now(timezone.utc) - timedelta(seconds=i), value=Decimal(i))
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        url = reverse('api:device_measurements', kwargs={'device_parameter_id': device_param.id})
+
+        response = client.get(url, {'limit': 2}, format='json')
+
+        self.assertTrue(response.status_code == 200)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNotNone(response.data['next'])
+
+        response = client.get(response.data['next'], format='json')
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(len(response.data['results']) >= 1)
+
+        response = client.get(url, {'format': 'ndjson'})
+        self.assertTrue(response.status_code == 200)
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertTrue(len(lines) >= 3)
+
+        response = client.get(url, {'format': 'columnar', 'limit': 2})
+        self.assertTrue(response.status_code == 200)
+        columns = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(len(columns['time']), 2)
+        self.assertEqual(len(columns['value']), 2)
+        self.assertTrue(all(isinstance(time, int) for time in columns['time']))
+        self.assertIsNotNone(columns['next'])
+
     def test_get_device_measurements_latest(self):
         """
         Basic test that the API returns a list of measurements
@@ -89,6 +152,66 @@ class BasicAPITestCase(TestCase):
         self.assertTrue(response.status_code == 200)
         self.assertTrue('value' in response.data)
 
+    def test_get_device_measurements_latest_for_site(self):
+        """
+        Test that the latest measurements of all device parameters of a site are returned in one call
+        :return:
+        """
+        token = Token.objects.get(user__username=email)
+        site = Site.objects.get(name=test_site)
+        device_params = DeviceParameter.objects.filter(device__node__gateway__site=site)
+        for device_param in device_params:
+            device_param.measurements.add(time=datetime.now(), value=Decimal(1))
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        url = reverse('api:device_measurements_latest_list')
+
+        response = client.get(url, {'site': site.id}, format='json')
+
+        self.assertTrue(response.status_code == 200)
+        self.assertEqual(len(response.data), len(device_params))
+        self.assertTrue(all('value' in measurement for measurement in response.data))
+
+        response = client.get(url, format='json')
+        self.assertTrue(response.status_code == 400)
+
+    def test_export_measurements(self):
+        """
+        Test that the API exports the measurements of a site as one table
+        """
+        token = Token.objects.get(user__username=email)
+        site = Site.objects.get(name=test_site)
+        device_params = list(DeviceParameter.objects.filter(device__node__gateway__site=site).order_by('id'))
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        device_params[0].measurements.add(time=now - timedelta(seconds=2), value=Decimal(1))
+        device_params[-1].measurements.add(time=now - timedelta(seconds=1), value=Decimal(2))
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        url = reverse('api:device_measurements_export')
+
+        response = client.get(url, {'site': site.id})
+        self.assertTrue(response.status_code == 200)
+        rows = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(rows[0].split(','), ['time'] + [str(dp.id) for dp in device_params])
+        self.assertTrue(len(rows) >= 3)
+
+        response = client.get(url, {'site': site.id, 'format': 'columnar'})
+        self.assertTrue(response.status_code == 200)
+        columns = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(columns['time'], sorted(columns['time']))
+        self.assertTrue(all(len(columns[str(dp.id)]) == len(columns['time']) for dp in device_params))
+
+        response = client.get(url, {'site': site.id, 'interval': '1d', 'agg': 'median; DROP DATABASE'})
+        self.assertTrue(response.status_code == 400)
+
+        # the time range is read one window at a time
+        ids = [dp.id for dp in device_params]
+        start_date = now - timedelta(seconds=10)
+        self.assertEqual(list(DPMeasurements.aligned_rows(ids, start_date=start_date, window=1)),
+                         list(DPMeasurements.aligned_rows(ids, start_date=start_date)))
+        with self.assertRaises(ValueError):
+            DPMeasurements.aligned_series(ids, start_date=start_date, max_rows=1)
+
     def test_token_required(self):
         """
         Test a token is required to use the API
@@ -105,6 +228,24 @@ class BasicAPITestCase(TestCase):
         print(response.status_code)
         self.assertTrue(response.status_code == 401)
 
+    def test_group_memberships_cached(self):
+        invalidate_group_names()
+        # the membership removed below is restored by the rollback, which sends no signal
+        self.addCleanup(invalidate_group_names)
+        user = User.objects.get(username=email)
+        with self.assertNumQueries(1):
+            self.assertTrue(is_in_group(user, uob_estates_group))
+            self.assertFalse(is_in_group(user, ebe_group))
+
+        # another request gets the memberships from the process cache
+        user = User.objects.get(username=email)
+        with self.assertNumQueries(0):
+            self.assertTrue(is_in_group(user, uob_estates_group))
+
+        Group.objects.get(name=uob_estates_group).user_set.remove(user)
+        user = User.objects.get(username=email)
+        self.assertFalse(is_in_group(user, uob_estates_group))
+
     def test_list_all_nodes(self):
         """
         Test
@@ -167,6 +308,31 @@ class BasicAPITestCase(TestCase):
         self.assertTrue(len(response.data) > 0)
         self.assertTrue(len(response.data) == i)
 
+    def test_list_devices_query_count(self):
+        """
+        Listing the devices of a site takes the same number of queries, whatever the size of the site
+        """
+        token = Token.objects.get(user__username=email)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+        small_site = SiteFactory.create()
+        large_site = SiteFactory.create()
+        gateway = large_site.gateways.first()
+        for _ in range(5):
+            node = NodeFactory.create(gateway=gateway, vendor=gateway.vendor)
+            DeviceFactory.create(node=node, vendor=gateway.vendor)
+
+        with CaptureQueriesContext(connection) as small_site_queries:
+            response = client.get(reverse('api:site_devices', kwargs={'pk': small_site.id}), format='json')
+        self.assertEqual(len(response.data), 1)
+
+        with self.assertNumQueries(len(small_site_queries)):
+            response = client.get(reverse('api:site_devices', kwargs={'pk': large_site.id}), format='json')
+        self.assertEqual(len(response.data), 11)
+        self.assertEqual(response.data[0]['site_id'], str(large_site.id))
+        self.assertEqual(len(response.data[0]['device_parameters']), 1)
+
     def test_list_empty_site(self):
         token = Token.objects.get(user__username=email)
         site = Site.objects.create(name='empty')
@@ -308,6 +474,55 @@ class BasicAPITestCase(TestCase):
         print(response.data)
         # self.assertTrue(response.data['name'] == 'default')
 
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                         'LOCATION': 'response-cache-tests'}})
+class ResponseCacheTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        SiteFactory.create(name=test_site)
+
+        user = User.objects.create(email=email, username=email)
+        g, _ = Group.objects.get_or_create(name=uob_estates_group)
+        g.user_set.add(user)
+
+    def setUp(self):
+        # objects created by other tests are removed by the rollback, which sends no signal
+        caches['default'].clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.get(user__username=email).key)
+
+    def site_queries(self, queries):
+        return [query for query in queries if '"ep_site"' in query['sql']]
+
+    def test_repeated_request_served_from_cache(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api:site_list'), format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.site_queries(queries))
+
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.client.get(reverse('api:site_list'), format='json')
+        self.assertEqual(cached.status_code, 200)
+        self.assertEqual(self.site_queries(queries), [])
+        self.assertEqual(cached.data, response.data)
+        self.assertEqual(cached['ETag'], response['ETag'])
+
+    def test_if_none_match(self):
+        response = self.client.get(reverse('api:site_list'), format='json')
+
+        response = self.client.get(reverse('api:site_list'), format='json', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_invalidated_by_change(self):
+        response = self.client.get(reverse('api:site_list'), format='json')
+
+        Site.objects.create(name='new site')
+        changed = self.client.get(reverse('api:site_list'), format='json', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+        self.assertEqual(len(changed.data), len(response.data) + 1)
+
+
 # class MessageTestCase(TestCase):
 #     @classmethod
 #     def setUpTestData(cls):
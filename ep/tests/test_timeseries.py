@@ -0,0 +1,249 @@
+import datetime
+import threading
+from decimal import Decimal
+from unittest import mock
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+from influxdb.exceptions import InfluxDBClientError
+
+from ep.management.commands.influxdb_rollups import resample_clause, backfill_windows
+from ep.timeseries import LastValueCache, LastValue, select_rollup_tier, series_key, write_lines, encode_point, \
+    to_epoch_ns, to_epoch_ms, WriteBuffer, SelectQuery, run_query, RollupTier, chunk_points
+
+__author__ = 'schien'
+
+
+class LastValueCacheTestCase(SimpleTestCase):
+    now = timezone.now()
+
+    def loader(self, keys=None):
+        self.load_count += 1
+        values = {1: LastValue(self.now, Decimal('20.5'))}
+        return {key: value for key, value in values.items() if keys is None or key in keys}
+
+    def setUp(self):
+        self.load_count = 0
+        self.cache = LastValueCache(self.loader)
+
+    def test_warm_on_first_access(self):
+        self.assertEqual(self.cache.get(1).value, Decimal('20.5'))
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.load_count, 1)
+
+    def test_update(self):
+        later = self.now + datetime.timedelta(seconds=10)
+        self.cache.update(1, later, 21.)
+        self.assertEqual(self.cache.get(1), LastValue(later, Decimal('21.0')))
+
+    def test_update_ignores_older_values(self):
+        self.cache.get(1)
+        self.cache.update(1, self.now - datetime.timedelta(days=1), 0)
+        self.assertEqual(self.cache.get(1).value, Decimal('20.5'))
+
+    def test_update_naive_and_string_times(self):
+        self.cache.update(2, datetime.datetime(2016, 5, 18, 14, 46, 52), 1)
+        self.cache.update(3, '2016-05-18T14:46:52Z', 1)
+        self.assertEqual(self.cache.get(2).time, self.cache.get(3).time)
+
+
+class SharedLastValueCacheTestCase(LastValueCacheTestCase):
+    """
+    The same behaviour with the values kept in a cache shared by processes.
+    """
+
+    def setUp(self):
+        self.load_count = 0
+        self.store = LocMemCache('last-value-tests', {})
+        self.store.clear()
+        self.cache = LastValueCache(self.loader, store=self.store)
+
+    def test_warm_on_first_access(self):
+        self.assertEqual(self.cache.get(1).value, Decimal('20.5'))
+        self.assertEqual(self.load_count, 1)
+        # served from the store from now on
+        self.cache.get(1)
+        self.assertEqual(self.load_count, 1)
+
+    def test_shared_between_processes(self):
+        other = LastValueCache(self.loader, store=self.store)
+        later = self.now + datetime.timedelta(seconds=10)
+
+        other.update(1, later, 21.)
+        self.assertEqual(self.cache.get(1), LastValue(later, Decimal('21.0')))
+
+    def test_warm_keeps_newer_values(self):
+        later = self.now + datetime.timedelta(seconds=10)
+        self.cache.update(1, later, 21.)
+        LastValueCache(self.loader, store=self.store).warm()
+        self.assertEqual(self.cache.get(1).value, Decimal('21.0'))
+
+
+@override_settings(INFLUX_RETENTION_POLICIES=[
+    {'name': 'autogen', 'interval': None, 'duration': 'INF'},
+    {'name': 'rollup_1m', 'interval': '1m', 'duration': '30d'},
+    {'name': 'rollup_15m', 'interval': '15m', 'duration': '365d'},
+    {'name': 'rollup_1h', 'interval': '1h', 'duration': 'INF'},
+])
+class SelectRollupTierTestCase(SimpleTestCase):
+    def test_coarsest_matching_interval(self):
+        start = timezone.now() - datetime.timedelta(days=1)
+        self.assertEqual(select_rollup_tier('30m', start).name, 'rollup_15m')
+        self.assertEqual(select_rollup_tier('2h', start).name, 'rollup_1h')
+        self.assertEqual(select_rollup_tier('90s', start), None)
+        self.assertEqual(select_rollup_tier('500ms', start), None)
+
+    def test_retention(self):
+        start = timezone.now() - datetime.timedelta(days=60)
+        self.assertEqual(select_rollup_tier('5m', start), None)
+        self.assertEqual(select_rollup_tier('15m', start).name, 'rollup_15m')
+        self.assertEqual(select_rollup_tier('15m', start - datetime.timedelta(days=365)), None)
+
+    def test_resample_covers_lateness(self):
+        self.assertEqual(resample_clause(RollupTier('rollup_15m', '15m', '365d'), '1h'), 'RESAMPLE EVERY 15m FOR 4500s')
+        self.assertEqual(resample_clause(RollupTier('rollup_1d', '1d', 'INF'), '1h'), 'RESAMPLE EVERY 1d FOR 172800s')
+
+    def test_backfill_windows(self):
+        day = 24 * 60 * 60
+        # from the oldest point, aligned to the buckets
+        self.assertEqual(backfill_windows(RollupTier('rollup_1h', '1h', 'INF'), day + 100, 3 * day + 100, '1d'),
+                         [(day, 2 * day), (2 * day, 3 * day), (3 * day, 4 * day)])
+        # not beyond the retention of the rollup, and at least one interval long
+        self.assertEqual(backfill_windows(RollupTier('rollup_1w', '1w', '14d'), 0, 30 * day, '1d'),
+                         [(14 * day, 21 * day), (21 * day, 28 * day), (28 * day, 35 * day)])
+
+
+class LineProtocolTestCase(SimpleTestCase):
+    def test_series_key_escapes_tags(self):
+        self.assertEqual(series_key('device_parameters', {'type': 'VOLTAGE (1 of 3)', 'dp': 12}),
+                         'device_parameters,dp=12,type=VOLTAGE\\ (1\\ of\\ 3)')
+        self.assertEqual(series_key('m', {'name': 'a,b=c'}), 'm,name=a\\,b\\=c')
+
+    def test_write_lines(self):
+        client = mock.Mock(_database='ep')
+        write_lines(client, ['m,dp=1 value=1.0 1000', 'm,dp=1 value=2.0 2000'])
+        client.request.assert_called_once_with('write', method='POST', params={'db': 'ep', 'precision': 'ms'},
+                                               data=b'm,dp=1 value=1.0 1000\nm,dp=1 value=2.0 2000\n',
+                                               expected_response_code=204)
+
+        client.reset_mock()
+        write_lines(client, [])
+        client.request.assert_not_called()
+
+    def test_to_epoch_ns(self):
+        expected = 1467799704 * 1000000000
+        self.assertEqual(to_epoch_ns(datetime.datetime(2016, 7, 6, 10, 8, 24, 500)), expected)
+        self.assertEqual(to_epoch_ns(datetime.datetime(2016, 7, 6, 10, 8, 24, tzinfo=timezone.utc)), expected)
+        self.assertEqual(to_epoch_ns('2016-07-06T10:08:24Z'), expected)
+        self.assertEqual(to_epoch_ns(expected + 1), expected + 1)
+        with self.assertRaises(ValueError):
+            to_epoch_ns('yesterday')
+
+    def test_to_epoch_ms(self):
+        self.assertEqual(to_epoch_ms('2016-07-06T10:08:24.950287872Z'), 1467799704950)
+        self.assertEqual(to_epoch_ms(datetime.datetime(2016, 7, 6, 10, 8, 24, 1500)), 1467799704001)
+        self.assertEqual(to_epoch_ms(1467799704950), 1467799704950)
+
+    def test_encode_point(self):
+        key = series_key('device_parameters', {'dp': '12', 'type': 'POWER', 'trigger': 'ON_DEVICE'})
+        self.assertEqual(encode_point(key, Decimal('21.5'), 1467799704000000000),
+                         'device_parameters,dp=12,trigger=ON_DEVICE,type=POWER value=21.5 1467799704000000000')
+        self.assertEqual(encode_point('m', True, 1), 'm value=1.0 1')
+
+    def test_write_buffer_writes_lines(self):
+        client = mock.Mock(_database='ep')
+        buffer = WriteBuffer(client, max_size=2)
+        buffer.add('m value=1.0 1')
+        client.request.assert_not_called()
+        buffer.add('m value=2.0 2')
+        client.request.assert_called_once_with('write', method='POST', params={'db': 'ep', 'precision': 'n'},
+                                               data=b'm value=1.0 1\nm value=2.0 2\n', expected_response_code=204)
+        buffer.close()
+
+    def test_failed_size_flush_is_not_raised(self):
+        client = mock.Mock(_database='ep')
+        client.request.side_effect = IOError('timed out')
+        buffer = WriteBuffer(client, max_size=1, max_age=60.)
+
+        buffer.add('m value=1.0 1')
+        # the failed write is left to the background flusher, adds do not retry it until the retry time
+        buffer.add('m value=2.0 2')
+        self.assertEqual(client.request.call_count, 1)
+        self.assertEqual(len(buffer), 2)
+
+        client.request.side_effect = None
+        self.assertEqual(buffer.flush(), 2)
+        buffer.close()
+
+    def test_points_buffered_during_write(self):
+        client = mock.Mock(_database='ep')
+        buffer = WriteBuffer(client, max_size=10)
+        added = []
+
+        def write(*args, **kwargs):
+            # another thread adding a point while the write is in progress is not blocked by it
+            adder = threading.Thread(target=buffer.add, args=('m value=3.0 3',))
+            adder.start()
+            adder.join(5.)
+            added.append(not adder.is_alive())
+
+        client.request.side_effect = write
+        buffer.add('m value=1.0 1')
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(added, [True])
+        self.assertEqual(len(buffer), 1)
+        client.request.side_effect = None
+        buffer.close()
+
+
+class SelectQueryTestCase(SimpleTestCase):
+    start = datetime.datetime(2016, 7, 1, tzinfo=timezone.utc)
+    end = datetime.datetime(2016, 7, 2, tzinfo=timezone.utc)
+
+    def test_bound_parameters(self):
+        query = SelectQuery('device_parameters').select('value').where_tag('dp', 12).time_range(self.start, self.end)
+        self.assertEqual(query.build(), (
+            'SELECT value FROM "device_parameters" WHERE "dp" = $p0 AND time > $p1 AND time <= $p2',
+            {'p0': '12', 'p1': '2016-07-01T00:00:00.000000Z', 'p2': '2016-07-02T00:00:00.000000Z'}))
+
+    def test_injection_is_bound(self):
+        statement, params = SelectQuery('m').where_tag('dp', "1' OR 1=1 --").build()
+        self.assertEqual(statement, 'SELECT * FROM "m" WHERE "dp" = $p0')
+        self.assertEqual(params, {'p0': "1' OR 1=1 --"})
+
+    def test_exists_probe(self):
+        statement, _ = SelectQuery('m').select('value').where_tag('dp', 1).limit(1).build()
+        self.assertEqual(statement, 'SELECT value FROM "m" WHERE "dp" = $p0 LIMIT 1')
+
+    def test_multi_series_aggregation(self):
+        query = SelectQuery('device_parameters', 'rollup_15m').select('sum("sum") / sum("count") AS value') \
+            .where_tag_in('dp', [1, 2, 3]).time_range(start=self.start).group_by_time('15m').group_by_tags('dp') \
+            .order_by_time_desc().limit(100)
+        self.assertEqual(query.build()[0],
+                         'SELECT sum("sum") / sum("count") AS value FROM "rollup_15m"."device_parameters" '
+                         'WHERE "dp" =~ /^(1|2|3)$/ AND time > $p0 GROUP BY time(15m), "dp" fill(none) ORDER BY time DESC LIMIT 100')
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            SelectQuery('m').where_tag_in('dp', [])
+        with self.assertRaises(ValueError):
+            SelectQuery('m').where_time('<', 'not a time')
+        with self.assertRaises(ValueError):
+            SelectQuery('m').where_time('=~', self.start)
+
+    @mock.patch('ep.timeseries.flush_writes')
+    def test_run_query(self, flush_mock):
+        client = mock.Mock()
+        run_query(client, SelectQuery('m').where_tag('dp', 1))
+        flush_mock.assert_called_once_with()
+        client.query.assert_called_once_with('SELECT * FROM "m" WHERE "dp" = $p0', params={'params': '{"p0": "1"}'},
+                                             epoch=None)
+
+    def test_chunk_points_merges_tags(self):
+        chunk = {'results': [{'series': [{'name': 'm', 'tags': {'dp': '1'}, 'columns': ['time', 'value'],
+                                          'values': [[1, 2.0], [2, 3.0]]}]}]}
+        self.assertEqual(list(chunk_points(chunk)), [{'time': 1, 'value': 2.0, 'dp': '1'},
+                                                     {'time': 2, 'value': 3.0, 'dp': '1'}])
+        with self.assertRaises(InfluxDBClientError):
+            list(chunk_points({'results': [{'error': 'timeout'}]}))
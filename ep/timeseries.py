@@ -0,0 +1,674 @@
+"""
+Low level helpers for the time series database.
+
+Points are encoded in the line protocol with :func:`encode_point` and handed to :class:`WriteBuffer`, which holds them
+in memory and writes them to InfluxDB as multi-point requests, either when the buffer is full, when the oldest point has
+waited longer than the configured maximum age, or when the process exits.
+
+:class:`LastValueCache` keeps the most recent value of each series, shared between processes through the Django cache,
+so that importers do not have to query InfluxDB before every write.
+
+Aggregations can be served from rollups that continuous queries compute into the retention policies declared in
+`INFLUX_RETENTION_POLICIES` (see the `influxdb_rollups` management command).
+"""
+import atexit
+import calendar
+import datetime
+import logging
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from decimal import Decimal
+from functools import lru_cache
+
+import simplejson as json
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
+
+__author__ = 'schien'
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBuffer(object):
+    """
+    Per process write-behind buffer for InfluxDB points.
+
+    - `max_size`: number of points that triggers a flush. A size of 1 (or less) writes every point immediately.
+    - `max_age`: seconds after which a non-empty buffer is flushed by a background thread.
+    - `max_pending`: upper bound of points kept for a retry when a write fails.
+    """
+
+    def __init__(self, client, max_size=500, max_age=1., max_pending=10000):
+        self.client = client
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_pending = max_pending
+
+        self._points = []
+        self._oldest = None
+        # guards the buffered points, never held during a write
+        self._lock = threading.RLock()
+        # serialises writes, so that a flush returns only after the points buffered before it are written
+        self._write_lock = threading.Lock()
+        # after a failed write, size triggered flushes are left to the background flusher until this time
+        self._retry_after = 0.
+        self._flusher = None
+        self._stopped = threading.Event()
+
+        self.written_count = 0
+        self.request_count = 0
+        self.dropped_count = 0
+
+    def add(self, point):
+        """
+        Add a single point encoded in the line protocol with nanosecond timestamps, see :func:`encode_point`.
+        """
+        self.extend([point])
+
+    def extend(self, points):
+        with self._lock:
+            if not self._points:
+                self._oldest = time.time()
+            self._points.extend(points)
+            full = len(self._points) >= self.max_size
+
+        if full and time.time() >= self._retry_after and self._write_lock.acquire(blocking=False):
+            # the points are buffered, a failed write is retried by the flusher and not raised to the caller
+            try:
+                self._write()
+            except Exception:
+                logger.exception('Writing {} buffered points failed, retrying in the background'.format(len(self)))
+            finally:
+                self._write_lock.release()
+        self._ensure_flusher()
+
+    def __len__(self):
+        return len(self._points)
+
+    def flush(self):
+        """
+        Write all buffered points in a single request.
+
+        On failure the points are kept for the next flush (up to `max_pending`) and the exception is re-raised.
+        """
+        with self._write_lock:
+            return self._write()
+
+    def _write(self):
+        # take the points out under the lock, so that other threads can buffer points while they are written
+        with self._lock:
+            if not self._points:
+                return 0
+            points = self._points
+            self._points = []
+            self._oldest = None
+
+        try:
+            write_lines(self.client, points, precision='n')
+        except Exception:
+            with self._lock:
+                self._requeue(points)
+                self._retry_after = time.time() + self.max_age
+            raise
+
+        with self._lock:
+            self.written_count += len(points)
+            self.request_count += 1
+        logger.debug('Flushed {} points to TS DB'.format(len(points)))
+        return len(points)
+
+    def _requeue(self, points):
+        points = points + self._points
+        overflow = len(points) - self.max_pending
+        if overflow > 0:
+            logger.error('Write buffer overflow, dropping {} oldest points'.format(overflow))
+            self.dropped_count += overflow
+            points = points[overflow:]
+        self._points = points
+        self._oldest = time.time()
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        self._flusher = threading.Thread(target=self._run_flusher, name='influx-write-buffer')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _run_flusher(self):
+        while not self._stopped.wait(self.max_age / 2.):
+            oldest = self._oldest
+            if oldest is None or time.time() - oldest < self.max_age:
+                continue
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Periodic flush of write buffer failed')
+
+    def close(self):
+        """
+        Stop the background flusher and write any remaining points.
+        """
+        self._stopped.set()
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Final flush of write buffer failed, {} points lost'.format(len(self._points)))
+
+
+_buffer = None
+_buffer_pid = None
+_buffer_lock = threading.Lock()
+
+
+def create_client():
+    return InfluxDBClient(settings.INFLUXDB_HOST, settings.INFLUXDB_PORT, settings.INFLUXDB_USER,
+                          settings.INFLUXDB_PASSWORD, settings.INFLUX_DB_NAME, timeout=settings.INFLUXDB_TIMEOUT)
+
+
+def get_write_buffer():
+    """
+    Return the write buffer of the current process.
+
+    A new buffer is created after a fork (e.g. in a celery prefork worker) so that points buffered in the parent are not
+    written twice.
+    """
+    global _buffer, _buffer_pid
+
+    if _buffer is None or _buffer_pid != os.getpid():
+        with _buffer_lock:
+            if _buffer is None or _buffer_pid != os.getpid():
+                _buffer = WriteBuffer(create_client(),
+                                      max_size=settings.INFLUX_WRITE_BUFFER_SIZE,
+                                      max_age=settings.INFLUX_WRITE_BUFFER_MAX_AGE,
+                                      max_pending=settings.INFLUX_WRITE_BUFFER_MAX_PENDING)
+                _buffer_pid = os.getpid()
+                atexit.register(_buffer.close)
+    return _buffer
+
+
+def flush_writes():
+    """
+    Write all points buffered in this process. Call before reading data back that was written in the same process.
+    """
+    if _buffer is not None and _buffer_pid == os.getpid():
+        _buffer.flush()
+
+
+def escape_key(value):
+    """
+    Escape a measurement name, tag key or tag value for the line protocol.
+    """
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+@lru_cache(maxsize=65536)
+def _series_key(measurement, tag_items):
+    return ','.join([escape_key(measurement)] + ['{}={}'.format(escape_key(key), escape_key(value))
+                                                 for key, value in tag_items])
+
+
+def series_key(measurement, tags):
+    """
+    The escaped tag set of a series is cached, the set of series written by a process (one per device parameter and
+    trigger) is small.
+
+    :return: the line protocol prefix of a series, e.g. 'device_parameters,dp=12,type=POWER'
+    """
+    return _series_key(measurement, tuple(sorted(tags.items())) if tags else ())
+
+
+def to_epoch_ns(value):
+    """
+    Convert a measurement time to nanoseconds since the epoch.
+
+    :param value: an int (taken to be nanoseconds already), a datetime (naive datetimes are taken to be UTC) or an ISO
+        string. Datetimes and strings are truncated to whole seconds, the precision measurements have always been
+        stored with.
+    """
+    if isinstance(value, int):
+        return value
+    utc = to_utc_datetime(value)
+    if utc is None:
+        raise ValueError('Can not interpret measurement time {!r}'.format(value))
+    return calendar.timegm(utc.utctimetuple()) * 1000000000
+
+
+def to_epoch_ms(value):
+    """
+    Convert a measurement time as returned by InfluxDB (an ISO string with up to nanosecond precision) or a datetime to
+    milliseconds since the epoch. Ints are taken to be milliseconds already.
+    """
+    if isinstance(value, int):
+        return value
+    utc = to_utc_datetime(value)
+    if utc is None:
+        raise ValueError('Can not interpret measurement time {!r}'.format(value))
+    return calendar.timegm(utc.utctimetuple()) * 1000 + utc.microsecond // 1000
+
+
+def encode_point(key, value, time):
+    """
+    :param key: the series, see :func:`series_key`
+    :param value: the value of the point's `value` field
+    :param time: the time of the point in the precision it is written with
+    :return: the point in the line protocol
+    """
+    return '{} value={!r} {}'.format(key, float(value), time)
+
+
+def write_lines(client, lines, precision='ms'):
+    """
+    Write points already encoded in the line protocol (e.g. 'device_parameters,dp=12 value=1.5 1467799704954') with a
+    single request, without the per point dictionary conversion of :func:`InfluxDBClient.write_points`.
+
+    :param precision: precision of the timestamps, one of 'n', 'u', 'ms', 's', 'm', 'h'
+    """
+    if not lines:
+        return
+    client.request('write', method='POST', params={'db': client._database, 'precision': precision},
+                   data=('\n'.join(lines) + '\n').encode('utf-8'), expected_response_code=204)
+
+
+def iter_query_points(client, query, chunk_size=10000, epoch=None):
+    """
+    Run a query in InfluxDB's chunked mode and yield the resulting points one by one as the chunks arrive, so that
+    arbitrarily large results can be processed in constant memory. Series tags are merged into each point.
+
+    :param client: an :class:`InfluxDBClient`
+    :param query: an InfluxQL string or a :class:`SelectQuery`
+    :param chunk_size: number of points InfluxDB puts into a chunk
+    :param epoch: return times as epoch in this precision (e.g. `ms`) instead of RFC3339 strings
+    """
+    flush_writes()
+
+    bind_params = {}
+    if isinstance(query, SelectQuery):
+        query, bind_params = query.build()
+
+    params = {'q': query, 'db': client._database, 'chunked': 'true', 'chunk_size': chunk_size}
+    if bind_params:
+        params['params'] = json.dumps(bind_params)
+    if epoch is not None:
+        params['epoch'] = epoch
+
+    response = client._session.get('{}/query'.format(client._baseurl), params=params,
+                                   auth=(client._username, client._password), headers=client._headers,
+                                   verify=client._verify_ssl, timeout=client._timeout, stream=True)
+    try:
+        if response.status_code != 200:
+            raise InfluxDBClientError(response.content, response.status_code)
+
+        for line in response.iter_lines():
+            if line:
+                yield from chunk_points(json.loads(line.decode('utf-8')))
+    finally:
+        response.close()
+
+
+def chunk_points(chunk):
+    """
+    :param chunk: a decoded chunk of a chunked query response
+    :return: generator of the points of the chunk, with the tags of their series merged in
+    :raises InfluxDBClientError: if the chunk reports an error
+    """
+    for result in chunk.get('results', []):
+        if 'error' in result:
+            raise InfluxDBClientError(result['error'])
+        for series in result.get('series', []):
+            columns = series['columns']
+            tags = series.get('tags') or {}
+            for values in series.get('values', []):
+                point = dict(zip(columns, values))
+                point.update(tags)
+                yield point
+
+
+def quote_identifier(name):
+    """
+    Quote a measurement, retention policy, field or tag name for InfluxQL.
+    """
+    return '"{}"'.format(str(name).replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def format_query_time(value):
+    """
+    :param value: a datetime (naive datetimes are taken to be UTC) or a time string as returned by InfluxDB, which is
+        kept as it is because it has nanosecond precision
+    :return: an RFC3339 string
+    """
+    if isinstance(value, str):
+        if parse_datetime(value) is None:
+            raise ValueError('Invalid time {}'.format(value))
+        return value
+    utc = to_utc_datetime(value)
+    if utc is None:
+        raise ValueError('Invalid time {!r}'.format(value))
+    return utc.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class SelectQuery(object):
+    """
+    Builder of InfluxQL SELECT statements. Tag values and times are passed to InfluxDB as bound parameters rather than
+    formatted into the statement, identifiers are quoted.
+
+        query = SelectQuery('device_parameters').select('value').where_tag('dp', 12).time_range(start, end).limit(10)
+        statement, params = query.build()
+    """
+    TIME_OPERATORS = ('>', '>=', '<', '<=')
+
+    def __init__(self, measurement, retention_policy=None):
+        self.source = quote_identifier(measurement)
+        if retention_policy is not None:
+            self.source = '{}.{}'.format(quote_identifier(retention_policy), self.source)
+        self.expressions = []
+        self.conditions = []
+        self.params = {}
+        self.group_by_interval = None
+        self.group_by_tag_names = []
+        self.fill = None
+        self.descending = False
+        self.limit_count = None
+
+    def bind(self, value):
+        """
+        :return: the placeholder of a new bound parameter
+        """
+        name = 'p{}'.format(len(self.params))
+        self.params[name] = value
+        return '$' + name
+
+    def select(self, *expressions):
+        """
+        :param expressions: InfluxQL field expressions, e.g. 'value' or 'mean(value) AS value'
+        """
+        self.expressions.extend(expressions)
+        return self
+
+    def where_tag(self, tag_name, tag_value):
+        self.conditions.append('{} = {}'.format(quote_identifier(tag_name), self.bind(str(tag_value))))
+        return self
+
+    def where_tag_in(self, tag_name, tag_values):
+        """
+        Match any of several tag values, e.g. to query many device parameters at once.
+        InfluxDB can not bind regular expressions, the values are escaped into the statement.
+        """
+        tag_values = [str(tag_value) for tag_value in tag_values]
+        if not tag_values:
+            raise ValueError('No tag values given')
+        if len(tag_values) == 1:
+            return self.where_tag(tag_name, tag_values[0])
+        pattern = '|'.join(re.escape(tag_value).replace('/', '\\/') for tag_value in tag_values)
+        self.conditions.append('{} =~ /^({})$/'.format(quote_identifier(tag_name), pattern))
+        return self
+
+    def where_time(self, operator, value):
+        if operator not in self.TIME_OPERATORS:
+            raise ValueError('Unsupported time operator {}'.format(operator))
+        self.conditions.append('time {} {}'.format(operator, self.bind(format_query_time(value))))
+        return self
+
+    def time_range(self, start=None, end=None):
+        """
+        Restrict the query to start < time <= end. Either bound may be None.
+        """
+        if start:
+            self.where_time('>', start)
+        if end:
+            self.where_time('<=', end)
+        return self
+
+    def group_by_time(self, interval, fill='none'):
+        self.group_by_interval = interval
+        self.fill = fill
+        return self
+
+    def group_by_tags(self, *tag_names):
+        """
+        Return a series per value of the tags, e.g. one per device parameter.
+        """
+        self.group_by_tag_names.extend(tag_names)
+        return self
+
+    def order_by_time_desc(self):
+        self.descending = True
+        return self
+
+    def limit(self, count):
+        """
+        Limit the number of points, per series if grouped by tags.
+        """
+        self.limit_count = int(count)
+        return self
+
+    def build(self):
+        """
+        :return: the statement and the dict of bound parameters
+        """
+        statement = 'SELECT {} FROM {}'.format(', '.join(self.expressions) or '*', self.source)
+        if self.conditions:
+            statement += ' WHERE ' + ' AND '.join(self.conditions)
+
+        group_by = []
+        if self.group_by_interval is not None:
+            group_by.append('time({})'.format(self.group_by_interval))
+        group_by.extend(quote_identifier(tag_name) for tag_name in self.group_by_tag_names)
+        if group_by:
+            statement += ' GROUP BY ' + ', '.join(group_by)
+        if self.fill is not None:
+            statement += ' fill({})'.format(self.fill)
+
+        if self.descending:
+            statement += ' ORDER BY time DESC'
+        if self.limit_count is not None:
+            statement += ' LIMIT {}'.format(self.limit_count)
+        return statement, dict(self.params)
+
+
+def run_query(client, query, epoch=None):
+    """
+    Run a :class:`SelectQuery`. Points still buffered by this process are written first so that they are visible to the
+    query.
+
+    :return: an :class:`influxdb.resultset.ResultSet`
+    """
+    statement, params = query.build()
+    flush_writes()
+    return client.query(statement, params={'params': json.dumps(params)} if params else None, epoch=epoch)
+
+
+LastValue = namedtuple('LastValue', ['time', 'value'])
+
+
+def to_utc_datetime(value):
+    """
+    Convert a measurement time (datetime or ISO string) to an aware UTC datetime. Naive datetimes are taken to be UTC.
+
+    :return: the datetime or None if the value can not be interpreted
+    """
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if not isinstance(value, datetime.datetime):
+        return None
+    if timezone.is_naive(value):
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+class LastValueCache(object):
+    """
+    Map of series key (e.g. device parameter id) to its most recent :class:`LastValue`.
+
+    With a `store` (a Django cache shared by all processes, e.g. memcached) the values written by any process are seen
+    by all of them: updates are written to the store and reads are served from it. Series missing from the store are
+    loaded with `loader` and added to it. The check that an update is newer than the stored value is not atomic,
+    concurrent writes of the same series from several processes may leave the older value.
+
+    Without a store the values are kept per process. The cache is then warmed with a single bulk query on first access
+    and kept current with every write made through this process, writes from other processes are only seen after a
+    call to :func:`warm`.
+    """
+
+    def __init__(self, loader, store=None, prefix='last_value'):
+        """
+        :param loader: callable returning a dict of key -> :class:`LastValue`, for the given keys or all keys if None
+        :param store: a Django cache, optional
+        :param prefix: prefix of the keys in the store
+        """
+        self._loader = loader
+        self._store = store
+        self._prefix = prefix
+        self._values = {}
+        # keys this process has seen, removed from the store by :func:`clear`
+        self._keys = set()
+        self._warm = False
+        self._lock = threading.Lock()
+
+    def _store_key(self, key):
+        return '{}:{}'.format(self._prefix, key)
+
+    def warm(self):
+        values = self._loader(None)
+        if self._store is not None:
+            stored = self._store.get_many([self._store_key(key) for key in values])
+            self._store.set_many({self._store_key(key): last_value for key, last_value in values.items()
+                                  if self._is_newer(stored.get(self._store_key(key)), last_value)}, None)
+        with self._lock:
+            self._keys.update(values)
+            for key, last_value in values.items():
+                self._set_if_newer(key, last_value)
+            self._warm = True
+        logger.info('Warmed last value cache with {} series'.format(len(values)))
+
+    def get(self, key):
+        """
+        :return: the :class:`LastValue` for the key or None if no value is known
+        """
+        if self._store is None:
+            if not self._warm:
+                self.warm()
+            return self._values.get(key)
+
+        last_value = self._store.get(self._store_key(key))
+        if last_value is None:
+            last_value = self._loader([key]).get(key)
+            if last_value is not None:
+                # unless another process stored a value in the meantime
+                self._store.add(self._store_key(key), last_value, None)
+            self._keys.add(key)
+        return last_value
+
+    def update(self, key, time, value):
+        """
+        Record a written value. Values older than the known value (e.g. from a backfill) are ignored.
+        """
+        time = to_utc_datetime(time)
+        if time is None:
+            return
+        if not isinstance(value, Decimal):
+            value = Decimal(str(value))
+        last_value = LastValue(time, value)
+
+        if self._store is not None:
+            if self._is_newer(self._store.get(self._store_key(key)), last_value):
+                self._store.set(self._store_key(key), last_value, None)
+            self._keys.add(key)
+            return
+        with self._lock:
+            self._set_if_newer(key, last_value)
+
+    @staticmethod
+    def _is_newer(known, last_value):
+        return known is None or known.time <= last_value.time
+
+    def _set_if_newer(self, key, last_value):
+        if self._is_newer(self._values.get(key), last_value):
+            self._values[key] = last_value
+
+    def clear(self):
+        """
+        Forget the values. Values of the store are removed for the keys this process has seen.
+        """
+        with self._lock:
+            if self._store is not None:
+                self._store.delete_many([self._store_key(key) for key in self._keys])
+            self._keys = set()
+            self._values = {}
+            self._warm = False
+
+
+RollupTier = namedtuple('RollupTier', ['name', 'interval', 'duration'])
+
+# aggregation requested from the API -> expression over the fields of a rollup. The buckets of a rollup hold different
+# numbers of points, so the mean is computed from their sums and counts rather than as the mean of their means.
+ROLLUP_AGGREGATIONS = {
+    'mean': 'sum("sum") / sum("count")',
+    'min': 'min("min")',
+    'max': 'max("max")',
+    'sum': 'sum("sum")',
+    'count': 'sum("count")',
+    'last': 'last("last")',
+}
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+
+
+def parse_duration(duration):
+    """
+    Convert an InfluxDB duration (e.g. `15m`) to seconds.
+
+    :return: the seconds, None for an infinite duration (`INF`) or a duration below a second
+    """
+    if duration is None or duration.upper() == 'INF' or duration.endswith('ms') or duration.endswith('u'):
+        return None
+    return int(duration[:-1]) * DURATION_UNITS[duration[-1]]
+
+
+def get_rollup_tiers():
+    """
+    The rollup tiers declared in `INFLUX_RETENTION_POLICIES`, without the raw policy.
+    """
+    return [RollupTier(rp['name'], rp['interval'], rp['duration'])
+            for rp in settings.INFLUX_RETENTION_POLICIES[1:]]
+
+
+def rollup_measurements():
+    """
+    :return: dict of the name of each rolled up measurement to the tag that identifies its series
+    """
+    return {name + settings.INFLUX_MEASUREMENT_SUFFIX: tag
+            for name, tag in settings.INFLUX_ROLLUP_MEASUREMENTS.items()}
+
+
+def select_rollup_tier(interval, start_date):
+    """
+    Select the coarsest rollup that can answer an aggregation over `interval` buckets starting at `start_date`.
+
+    A rollup qualifies if the requested interval is a multiple of its own interval and it retains data back to the
+    start date. Without a start date only rollups kept forever qualify.
+
+    :return: a :class:`RollupTier` or None if the raw points have to be used
+    """
+    interval_seconds = parse_duration(interval)
+    if interval_seconds is None:
+        return None
+
+    start_date = to_utc_datetime(start_date)
+    age = None if start_date is None else (timezone.now() - start_date).total_seconds()
+    selected = None
+    for tier in get_rollup_tiers():
+        tier_seconds = parse_duration(tier.interval)
+        retention = parse_duration(tier.duration)
+        if interval_seconds % tier_seconds != 0:
+            continue
+        if retention is not None and (age is None or retention < age):
+            continue
+        if selected is None or parse_duration(selected.interval) < tier_seconds:
+            selected = tier
+    return selected
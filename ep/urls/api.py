@@ -4,7 +4,7 @@ from rest_framework.urlpatterns import format_suffix_patterns
 
 from ep.apiviews import MeasurementList, SiteList, SiteDetailsView, DeviceParameterDetailsView, NodeList, TariffList, \
     TariffDetailsView, get_device_parameter_schedule, GatewayList, DeviceList, DeviceDetails, \
-    MeasurementsLatest
+    MeasurementsLatest, MeasurementsLatestList, MeasurementExport
 
 __author__ = 'schien'
 
@@ -14,6 +14,10 @@ urlpatterns = [
         name='device_measurements'),
     url(r'^device_parameter/(?P<pk>[0-9]+)/measurements/latest$', cache_page(0)(MeasurementsLatest.as_view()),
         name='device_measurements_latest'),
+    url(r'^device_parameter/measurements/latest$', never_cache(MeasurementsLatestList.as_view()),
+        name='device_measurements_latest_list'),
+    url(r'^device_parameter/measurements/export$', never_cache(MeasurementExport.as_view()),
+        name='device_measurements_export'),
     url(r'^device_parameter/(?P<pk>[0-9]+)$', DeviceParameterDetailsView.as_view(), name='dp_details'),
 
     url(r'^site$', SiteList.as_view(), name='site_list'),
@@ -1,10 +1,13 @@
+import hashlib
 import re
+from datetime import datetime
 
-import requests
 import simplejson as json
 
+from ep.http_sessions import get_session
 from ep.models import Site, Gateway, Node, NodeProperty, Device, DeviceParameter, DeviceParameterType, DPMeasurements, \
     Vendor, DeviceType
+from ep.timeseries import create_client, encode_point, series_key, write_lines
 
 import logging
 
@@ -17,6 +20,14 @@ rayleigh_vendor_name = 'rayleigh'
 rayleigh_gateway_id = 'rayleigh'
 rayleigh_devicetype_name = 'RAYLEIGH'
 rayleigh_devicetype_description = 'Rayleigh Connect Sensor'
+# NodeProperty of a device holding the time (ms from Jan. 1st 1970) of the most recent stored reading
+readings_high_water_mark_key = 'readings_hwm'
+# NodeProperty of a device holding the hash of its sensor metadata
+sensors_hash_key = 'sensors_hash'
+# fields of a sensor that change with its readings, rather than its metadata
+sensor_volatile_fields = {'last_value', 'last_call', 'last_call_delta'}
+# maximum number of readings written with one request
+readings_write_chunk_size = 50000
 
 sensor_type_map = {
     'kwh': {'code': 'POWER', 'description': 'Energy', 'unit': 'kWh'},
@@ -50,6 +61,9 @@ class RayleighClient(object):
         self.host = host
 
         self.headers = {'Accept': 'application/json'}
+        self.ts_client = create_client()
+        # Node id -> sensor series, see get_sensor_series
+        self._sensor_series = {}
 
         self.rayleigh_site, created = Site.objects.get_or_create(name=rayleigh_site_name)
         if created:
@@ -84,7 +98,7 @@ class RayleighClient(object):
         )
 
         logger.debug('Calling Rayleigh Connect API at URL {}'.format(url))
-        req = requests.get(url, headers=self.headers)
+        req = get_session(rayleigh_vendor_name).get(url, headers=self.headers)
 
         if not req.status_code == 200:
             logger.warn('Rayleigh Connect API call returned with status {}'.format(req.status_code))
@@ -174,7 +188,7 @@ class RayleighClient(object):
         return device_id, param
 
     @staticmethod
-    def add_sensor_device(type_code, type_description, sensor_type, sensor_device, value=None):
+    def add_sensor_device(type_code, type_description, sensor_type, sensor_device):
         sensor_device_type, created = DeviceParameterType.objects.get_or_create(
             code=type_code,
             description=type_description
@@ -190,25 +204,68 @@ class RayleighClient(object):
         if created:
             logger.debug('Created DeviceParameter: {}'.format(device_param))
 
-        if value is not None:
-            DPMeasurements(device_param).add(DPMeasurements.time(), value)
+    @staticmethod
+    def sensor_metadata_hash(sensors):
+        """
+        Hash the metadata of the sensors of a device, leaving out the fields that change with every reading
 
-    def retrieve_sensors(self, device):
+        :param sensors: a dict of Rayleigh sensors, keyed by sensor key
+        :return: a hex digest
         """
-        Retrieve a list of sensors from a specified device and store them in the meta database
+        metadata = {sensor_key: {field: value for field, value in sensor.items() if field not in sensor_volatile_fields}
+                    for sensor_key, sensor in sensors.items()}
+        return hashlib.sha1(json.dumps(metadata, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def fetch_sensors(self, device):
+        """
+        Retrieve the sensors of a specified device
 
-        An example sensor is a particular PV panel
         :param device: A Node object describing a Rayleigh Device
+        :return: a dict of Rayleigh sensors, keyed by sensor key, or None if the call failed
         """
         device_id = device.external_id
         path = 'devices/' + device_id
         res, req = self.consumer_api_call(path=path)
         if res is None:
             logger.warn('Something went wrong, aborting')
-            return
+            return None
+
+        return res[device_id]
+
+    def retrieve_sensors(self, device):
+        """
+        Retrieve a list of sensors from a specified device and store them in the meta database
+
+        The sensors are only stored if their metadata changed since the last call, see :func:`sensor_metadata_hash`.
 
+        An example sensor is a particular PV panel
+        :param device: A Node object describing a Rayleigh Device
+        :return: a dict of Rayleigh sensors, keyed by sensor key, or None if the call failed
+        """
+        sensors = self.fetch_sensors(device)
+        if sensors is None:
+            return None
+
+        metadata_hash = self.sensor_metadata_hash(sensors)
+        prop = device.properties.filter(key=sensors_hash_key).first()
+        if prop is not None and prop.value == metadata_hash:
+            logger.debug('Sensor metadata of device {} unchanged'.format(device.external_id))
+            return sensors
+
+        self.sync_sensors(device, sensors)
+        self._sensor_series.pop(device.id, None)
+        NodeProperty.objects.update_or_create(node=device, key=sensors_hash_key, defaults={'value': metadata_hash})
+        return sensors
+
+    def sync_sensors(self, device, sensors):
+        """
+        Store the sensors of a device in the meta database: a Device for each sensor and a DeviceParameter for each
+        parameter (and phase) of a sensor
+
+        :param device: A Node object describing a Rayleigh Device
+        :param sensors: a dict of Rayleigh sensors, keyed by sensor key
+        """
         params = {}
-        sensors = res[device_id]
 
         # @todo - Create Devices for temperature
         # Caveat: is this a Device or a DeviceParameter? If the latter, for what Device?
@@ -250,55 +307,178 @@ class RayleighClient(object):
 
         # Create any DeviceParameters (sensor parameters) for the sensor Devices
         for sensor_key in params.keys():
-            sensor_param = sensors[sensor_key]
             sensor_id, param = self.extract_id_and_param(sensor_key)
 
             sensor_device = Device.objects.filter(
                 node=device,
                 vendor=self.rayleigh_vendor,
                 external_id=sensor_id
-            ).get()
+            ).first()
 
             if sensor_device is None:
                 logger.error('Could not find matching sensor for parameter {}'.format(sensor_key))
-            else:
-                if param in sensor_type_map:
-                    sensor_type = sensor_type_map[param]
+            elif param in sensor_type_map:
+                sensor_type = sensor_type_map[param]
+
+                # Does the parameter need splitting?
+                if 'split' in sensor_type:
+                    n = sensor_type['split']
+                    logger.debug('Sensor parameter is divided into {} parts'.format(n))
+
+                    for i in range(n):
+                        addendum = ' ({} of {})'.format(i + 1, n)
+                        self.add_sensor_device(sensor_type['code'] + addendum, sensor_type['description'] + addendum,
+                                               sensor_type, sensor_device)
+                else:
+                    self.add_sensor_device(sensor_type['code'], sensor_type['description'], sensor_type,
+                                           sensor_device)
 
-                    # Does the parameter need splitting?
-                    if 'split' in sensor_type:
-                        # Adjusted for 0-indexing
-                        n = sensor_type['split'] - 1
+    @staticmethod
+    def sensor_type_codes(sensor_type):
+        """
+        :param sensor_type: an entry of `sensor_type_map`
+        :return: the DeviceParameterType codes of the sensor type, one per phase for split types
+        """
+        if 'split' not in sensor_type:
+            return [sensor_type['code']]
+        n = sensor_type['split']
+        return ['{} ({} of {})'.format(sensor_type['code'], i + 1, n) for i in range(n)]
 
-                        # Re-adjusted for clarity
-                        logger.debug('Sensor parameter is divided into {} parts'.format(n+1))
+    @staticmethod
+    def get_sensor_parameter_map(device):
+        """
+        Map the sensor keys of a device's readings to the DeviceParameters created by :func:`retrieve_sensors`
 
-                        # Re-adjusted for inclusive range
-                        for i in range(0, n+1):
-                            addendum = ' ({} of {})'.format(i+1, n+1)
-                            type_code = sensor_type['code'] + addendum
-                            type_description = sensor_type['description'] + addendum
+        :param device: a Node object describing a Rayleigh Device
+        :return: a dict of sensor key (e.g. 'e1.v3p') -> list of DeviceParameters, one per phase
+        """
+        device_parameters = {
+            (device_parameter.device.external_id, device_parameter.type.code): device_parameter
+            for device_parameter in DeviceParameter.objects.filter(device__node=device).select_related('device', 'type')
+        }
+
+        parameter_map = {}
+        for sensor_id in {sensor_id for sensor_id, _ in device_parameters}:
+            for param, sensor_type in sensor_type_map.items():
+                phases = [device_parameters.get((sensor_id, code))
+                          for code in RayleighClient.sensor_type_codes(sensor_type)]
+                if None not in phases:
+                    parameter_map['{}.{}'.format(sensor_id, param)] = phases
+        return parameter_map
 
-                            logger.debug('Using type_code {} and type_description {}'.format(type_code, type_description))
+    @staticmethod
+    def get_readings_high_water_mark(device):
+        """
+        :param device: a Node object describing a Rayleigh Device
+        :return: the time of the most recent stored reading of the device in ms from Jan. 1st 1970, or None
+        """
+        prop = device.properties.filter(key=readings_high_water_mark_key).first()
+        return int(prop.value) if prop is not None else None
 
-                            value = None
-                            if 'last_value' in sensor_param:
-                                value = sensor_param['last_value']
-                                if type(value) is list:
-                                    value = value[i]
+    @staticmethod
+    def set_readings_high_water_mark(device, time):
+        NodeProperty.objects.update_or_create(node=device, key=readings_high_water_mark_key,
+                                              defaults={'value': str(time)})
 
-                            self.add_sensor_device(type_code, type_description, sensor_type, sensor_device,
-                                                   value)
+    def fetch_sensor_readings(self, device, sensors, start, end):
+        """
+        Retrieve archival data for a specified list of sensors from a single device
 
-                    else:
-                        value = None
-                        if 'last_value' in sensor_param:
-                            value = sensor_param['last_value']
+        :param device: a Node object describing a Rayleigh Device
+        :param sensors: a dict of Rayleigh sensors, keyed by sensor key
+        :param start: a timestamp for the beginning of the required data, in ms from Jan. 1st 1970
+        :param end: a timestamp for the end of the required data, in ms from Jan. 1st 1970
+        :return: a dict of sensor key -> list of [time, value] readings, or None if the call failed
+        """
+        device_id = device.external_id
+        path = 'data/' + device_id + ':(' + make_csv(sensors) + ')'
+        extra = '&from={}&to={}'.format(start, end)
 
-                        self.add_sensor_device(sensor_type['code'], sensor_type['description'], sensor_type, sensor_device,
-                                               value)
+        res, req = self.consumer_api_call(path=path, extra=extra)
+        if res is None:
+            logger.warn('Something went wrong, aborting')
+            return None
 
-        return sensors
+        return res[device_id]
+
+    def get_sensor_series(self, device):
+        """
+        The series of the sensors of a device, cached until the sensor metadata of the device changes
+
+        :param device: a Node object describing a Rayleigh Device
+        :return: a dict of sensor key -> list of (device parameter id, line protocol series key), one per phase
+        """
+        series = self._sensor_series.get(device.id)
+        if series is None:
+            series = {
+                sensor_key: [(device_parameter.id,
+                              series_key(DPMeasurements.INFLUX_DEVICE_PARAMETER_MEASUREMENT_NAME,
+                                         {DPMeasurements.TAG: device_parameter.id, 'type': device_parameter.type.code}))
+                             for device_parameter in device_parameters]
+                for sensor_key, device_parameters in self.get_sensor_parameter_map(device).items()
+            }
+            self._sensor_series[device.id] = series
+        return series
+
+    @staticmethod
+    def encode_readings(series, readings):
+        """
+        Encode the readings of a sensor in the line protocol, with the times in ms
+
+        :param series: the list of (device parameter id, series key) of the sensor, one per phase
+        :param readings: a list of [time, value] readings. For split sensor types value is a list with one value for
+            each phase.
+        :return: the lines and a dict of device parameter id -> the most recent (time, value)
+        """
+        lines = []
+        last_values = {}
+        for phase, (device_parameter_id, key) in enumerate(series):
+            if len(series) > 1:
+                values = [(time, value[phase] if value is not None else None) for time, value in readings]
+            else:
+                values = readings
+            values = [(int(time), float(value)) for time, value in values if value is not None]
+            if not values:
+                continue
+
+            lines.extend([encode_point(key, value, time) for time, value in values])
+            last_values[device_parameter_id] = max(values)
+        return lines, last_values
+
+    def store_sensor_readings(self, device, readings):
+        """
+        Write the readings of a device to the time series database
+
+        The readings of all sensors are written in requests of up to `readings_write_chunk_size` points, so a day of
+        1-minute readings is a single request.
+
+        :param device: a Node object describing a Rayleigh Device
+        :param readings: a dict of sensor key -> list of [time, value] readings, as returned by
+            :func:`fetch_sensor_readings`
+        :return: the number of points written and the time of the most recent reading (None if there were none)
+        """
+        series = self.get_sensor_series(device)
+
+        lines = []
+        last_values = {}
+        for sensor_key, sensor_readings in readings.items():
+            if sensor_key not in series:
+                continue
+            sensor_lines, sensor_last_values = self.encode_readings(series[sensor_key], sensor_readings)
+            lines.extend(sensor_lines)
+            last_values.update(sensor_last_values)
+
+        for i in range(0, len(lines), readings_write_chunk_size):
+            write_lines(self.ts_client, lines[i:i + readings_write_chunk_size], precision='ms')
+        if lines:
+            logger.debug('Wrote {} readings of device {}'.format(len(lines), device.external_id))
+
+        cache = DPMeasurements.last_value_cache()
+        for device_parameter_id, (time, value) in last_values.items():
+            cache.update(device_parameter_id, datetime.utcfromtimestamp(time / 1000.), value)
+
+        latest = max(time for time, value in last_values.values()) if last_values else None
+        return len(lines), latest
 
     def retrieve_sensor_readings(self, device, sensors, start, end):
         """
@@ -308,35 +488,35 @@ class RayleighClient(object):
         An example reading is the energy generated in kwh
 
         :param device: a Node object describing a Rayleigh Device
-        :param sensors: a list of Devices describing Rayleigh sensors
+        :param sensors: a dict of Rayleigh sensors, keyed by sensor key
         :param start: a timestamp for the beginning of the required data, in ms from Jan. 1st 1970
         :param end: a timestamp for the end of the required data, in ms from Jan. 1st 1970
+        :return: the readings, see :func:`fetch_sensor_readings`
         """
-        device_id = device.external_id
-        path = 'data/' + device_id + ':(' + make_csv(sensors) + ')'
-        extra = '&from=' + start + '&to=' + end
+        readings = self.fetch_sensor_readings(device, sensors, start, end)
+        if readings is not None:
+            self.store_sensor_readings(device, readings)
+        return readings
 
-        res, req = self.consumer_api_call(path=path, extra=extra)
-        if res is None:
-            logger.warn('Something went wrong, aborting')
-            return
-
-        sensors = res[device_id]
-        for sensor_id in sensors.keys():
-            readings = sensors[sensor_id]
+    def import_new_sensor_readings(self, device, sensors, end, default_start):
+        """
+        Retrieve and store the readings of a device that are newer than its high-water mark, then advance the mark to
+        the most recent reading
 
-            sensor_devices = Device.objects.filter(
-                node=device,
-                external_id=sensor_id
-            )
-            if len(sensor_devices) == 0:
-                continue
+        :param device: a Node object describing a Rayleigh Device
+        :param sensors: a dict of Rayleigh sensors, keyed by sensor key
+        :param end: a timestamp for the end of the required data, in ms from Jan. 1st 1970
+        :param default_start: the beginning of the required data if the device has no high-water mark yet
+        :return: the number of points written
+        """
+        high_water_mark = self.get_readings_high_water_mark(device)
+        start = high_water_mark + 1 if high_water_mark is not None else default_start
 
-            sensor_device = sensor_devices.get()
-            for reading in readings:
-                time = reading[0]
-                value = reading[1]
-                logger.debug('Adding sensor reading for {sensor}: {time} {value}'.format(sensor=sensor_id, time=time, value=value))
-                DPMeasurements(sensor_device).add(time, value)
+        readings = self.fetch_sensor_readings(device, sensors, start, end)
+        if readings is None:
+            return 0
 
-        return sensors
+        count, latest = self.store_sensor_readings(device, readings)
+        if latest is not None and (high_water_mark is None or latest > high_water_mark):
+            self.set_readings_high_water_mark(device, latest)
+        return count
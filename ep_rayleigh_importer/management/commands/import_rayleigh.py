@@ -1,9 +1,11 @@
 import asyncio
 import logging
 import time
-from django.conf import settings
+from concurrent.futures import ThreadPoolExecutor
 
+from django.conf import settings
 from django.core.management import BaseCommand
+from django.db import close_old_connections
 
 from ep.models import Node
 from ep_rayleigh_importer.controllers.rayleigh_client import RayleighClient
@@ -25,7 +27,11 @@ class Command(BaseCommand):
             settings.RAYLEIGH_HOST
         )
 
-        self.last_checked_time = self.ms_from_unix_epoch()
+        # devices without a high-water mark are read from the start of the importer on
+        self.start_time = self.ms_from_unix_epoch()
+
+        # the blocking API calls run on a bounded pool, so that the devices of a poll are imported concurrently
+        self.executor = ThreadPoolExecutor(max_workers=settings.RAYLEIGH_IMPORT_WORKERS)
 
         loop = asyncio.get_event_loop()
         self.tasks = [
@@ -38,35 +44,54 @@ class Command(BaseCommand):
             loop.run_until_complete(asyncio.wait(self.tasks))
         except KeyboardInterrupt:
             pass
+        finally:
+            self.executor.shutdown()
 
     DEVICE_IMPORT_FREQUENCY = 60 * 60
     SENSOR_IMPORT_FREQUENCY = 60 * 5
 
-    last_checked_time = None
+    start_time = None
 
     @staticmethod
     def ms_from_unix_epoch():
-        return str(int(round(time.time() * 1000)))
+        return int(round(time.time() * 1000))
 
     def get_devices(self):
         return Node.objects.filter(gateway=self.client.rayleigh_gw)
 
     async def device_importer(self):
+        loop = asyncio.get_event_loop()
         while True:
             logger.info('Checking Rayleigh for new devices')
-            self.client.retrieve_devices()
+            await loop.run_in_executor(self.executor, self.client.retrieve_devices)
             await asyncio.sleep(self.DEVICE_IMPORT_FREQUENCY)
 
     async def sensor_importer(self):
+        loop = asyncio.get_event_loop()
         while True:
             now = self.ms_from_unix_epoch()
             logger.info('Checking Rayleigh for sensor readings')
-            devices = self.get_devices()
+            devices = list(self.get_devices())
 
-            for device in devices:
-                logger.info('Retrieving sensors from device {}'.format(device))
-                sensors = self.client.retrieve_sensors(device)
-
-                self.client.retrieve_sensor_readings(device, sensors, self.last_checked_time, now)
-            self.last_checked_time = now
+            counts = await asyncio.gather(*[loop.run_in_executor(self.executor, self.import_device, device, now)
+                                            for device in devices])
+            logger.info('Imported {} readings of {} devices'.format(sum(counts), len(devices)))
             await asyncio.sleep(self.SENSOR_IMPORT_FREQUENCY)
+
+    def import_device(self, device, now):
+        """
+        Import the sensors and new readings of a device. Runs on the executor.
+
+        :return: the number of points written
+        """
+        try:
+            logger.info('Retrieving sensors from device {}'.format(device))
+            sensors = self.client.retrieve_sensors(device)
+            if sensors is None:
+                return 0
+            return self.client.import_new_sensor_readings(device, sensors, now, self.start_time)
+        except Exception:
+            logger.exception('Importing readings of device {} failed'.format(device))
+            return 0
+        finally:
+            close_old_connections()
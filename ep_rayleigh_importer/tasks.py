@@ -1,7 +1,9 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from celery import shared_task
 from django.conf import settings
+from django.db import close_old_connections
 from ep.tasks import ErrorLoggingTask
 from ep.models import Node
 
@@ -90,7 +92,15 @@ def import_historical(start: int, end: int):
     """
     client = make_rayleigh_client()
     import_devices(client)
-    devices = get_devices(client)
-    for device in devices:
-        sensors = import_sensors_from_device(client, device)
-        client.retrieve_sensor_readings(device, sensors, start, end)
+
+    def import_device(device):
+        try:
+            sensors = import_sensors_from_device(client, device)
+            if sensors is not None:
+                client.retrieve_sensor_readings(device, sensors, start, end)
+        finally:
+            close_old_connections()
+
+    with ThreadPoolExecutor(max_workers=settings.RAYLEIGH_IMPORT_WORKERS) as executor:
+        # list() re-raises the first exception of a device
+        list(executor.map(import_device, get_devices(client)))
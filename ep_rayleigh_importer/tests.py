@@ -1,8 +1,9 @@
+import copy
 import logging
 from unittest.mock import patch
 
 from django.test import TestCase
-from ep.models import Node, Device, DeviceParameter
+from ep.models import Node, Device, DeviceParameter, DPMeasurements
 import json
 
 from .controllers.rayleigh_client import default_rayleigh_api_host, RayleighClient
@@ -21,15 +22,15 @@ def create_rayleigh_client():
 
 
 class MockedImportRayleighTests(TestCase):
-    @patch('ep_rayleigh_importer.controllers.rayleigh_client.requests')
+    @patch('ep_rayleigh_importer.controllers.rayleigh_client.get_session')
     def import_devices(self, mock):
         """
         Helper Function: imports Rayleigh Connect devices into test database. Uses data from data_tests.py
 
-        :param mock: A mock requests object for stubbing the API results
+        :param mock: A mock session getter for stubbing the API results
         """
-        mock.get.return_value.status_code = 200
-        mock.get.return_value.content = json.dumps(devices_data_resp)
+        mock.return_value.get.return_value.status_code = 200
+        mock.return_value.get.return_value.content = json.dumps(devices_data_resp)
 
         client = create_rayleigh_client()
 
@@ -45,7 +46,7 @@ class MockedImportRayleighTests(TestCase):
         """
         Test: tests that the devices are imported correctly. Uses data from data_tests.py
 
-        :param mock: A mock requests object for stubbing the API results
+        :param mock: A mock session getter for stubbing the API results
         """
 
         # The data, sensor_data_resp, contains one node (the name of which is stored in `data_tests.device_id`) to
@@ -56,17 +57,17 @@ class MockedImportRayleighTests(TestCase):
         self.assertTrue(new_node_count == old_node_count + 1)
 
     @patch('ep_rayleigh_importer.controllers.rayleigh_client.DPMeasurements.add')
-    @patch('ep_rayleigh_importer.controllers.rayleigh_client.requests')
+    @patch('ep_rayleigh_importer.controllers.rayleigh_client.get_session')
     def test_import_sensors(self, mock, mock_ts):
         """
         Test: tests that the sensors are imported correctly. Requires test_import_devices to be run first.
         Uses data from data_tests.py
 
-        :param mock: A mock requests object for stubbing the API results
+        :param mock: A mock session getter for stubbing the API results
         :param mock_ts: A mock DPMeasurements object to avoid populating the timeseries database
         """
-        mock.get.return_value.status_code = 200
-        mock.get.return_value.content = json.dumps(sensor_data_resp)
+        mock.return_value.get.return_value.status_code = 200
+        mock.return_value.get.return_value.content = json.dumps(sensor_data_resp)
 
         self.import_devices()
 
@@ -99,3 +100,78 @@ class MockedImportRayleighTests(TestCase):
                          v3p_device_parameter_count +
                          i3p_device_parameter_count)
                         )
+        # readings are imported separately, the sensor sync does not write measurements
+        mock_ts.assert_not_called()
+
+    @patch('ep_rayleigh_importer.controllers.rayleigh_client.get_session')
+    def test_unchanged_sensor_metadata_is_not_synced(self, mock):
+        """
+        Test: a poll that only brings new values makes no metadata writes, a metadata change is synced.
+        """
+        mock.return_value.get.return_value.status_code = 200
+        mock.return_value.get.return_value.content = json.dumps(sensor_data_resp)
+
+        self.import_devices()
+        client = create_rayleigh_client()
+        device = Node.objects.get(external_id=device_id)
+        client.retrieve_sensors(device)
+
+        resp = copy.deepcopy(sensor_data_resp)
+        resp[device_id]['e1.kwh']['last_value'] = 69530.0
+        resp[device_id]['e1.kwh']['last_call'] = 1467799764954
+        mock.return_value.get.return_value.content = json.dumps(resp)
+        with patch.object(client, 'sync_sensors') as sync_mock, self.assertNumQueries(1):
+            client.retrieve_sensors(device)
+        sync_mock.assert_not_called()
+
+        resp[device_id]['e1']['name'] = 'Chiller 2'
+        mock.return_value.get.return_value.content = json.dumps(resp)
+        with patch.object(client, 'sync_sensors') as sync_mock:
+            client.retrieve_sensors(device)
+        sync_mock.assert_called_once_with(device, resp[device_id])
+        self.assertEqual(device.properties.get(key='sensors_hash').value, client.sensor_metadata_hash(resp[device_id]))
+
+    @patch('ep_rayleigh_importer.controllers.rayleigh_client.create_client')
+    @patch('ep_rayleigh_importer.controllers.rayleigh_client.DPMeasurements.add')
+    @patch('ep_rayleigh_importer.controllers.rayleigh_client.get_session')
+    def test_import_new_sensor_readings(self, mock, mock_ts, mock_client):
+        """
+        Test: readings are written in one batch per device, one point per phase, and the next poll only requests
+        readings after the most recent one.
+        """
+        mock.return_value.get.return_value.status_code = 200
+        mock.return_value.get.return_value.content = json.dumps(sensor_data_resp)
+
+        self.import_devices()
+        client = create_rayleigh_client()
+        device = Node.objects.get(external_id=device_id)
+        sensors = client.retrieve_sensors(device)
+
+        readings_resp = {device_id: {
+            'e1.kwh': [[1467799704954, 69525.0], [1467799764954, 69526.0]],
+            'e1.v3p': [[1467799704954, [225.5, 226.6, 227.7]]],
+            'e1': [[1467799704954, 0.0]],
+        }}
+        mock.return_value.get.return_value.content = json.dumps(readings_resp)
+
+        count = client.import_new_sensor_readings(device, sensors, 1467799800000, 1467799700000)
+
+        self.assertEqual(count, 5)
+        self.assertEqual(mock_client.return_value.request.call_count, 1)
+        kwargs = mock_client.return_value.request.call_args[1]
+        self.assertEqual(kwargs['params']['precision'], 'ms')
+        lines = kwargs['data'].decode('utf-8').splitlines()
+
+        power = DeviceParameter.objects.get(device__node=device, type__code='POWER')
+        voltage = DeviceParameter.objects.get(device__node=device, type__code='VOLTAGE (2 of 3)')
+        measurement = DPMeasurements.INFLUX_DEVICE_PARAMETER_MEASUREMENT_NAME
+        self.assertIn('{},dp={},type=POWER value=69526.0 1467799764954'.format(measurement, power.id), lines)
+        self.assertIn('{},dp={},type=VOLTAGE\\ (2\\ of\\ 3) value=226.6 1467799704954'
+                      .format(measurement, voltage.id), lines)
+        self.assertIn('from=1467799700000', mock.return_value.get.call_args[0][0])
+        self.assertEqual(client.get_readings_high_water_mark(device), 1467799764954)
+
+        mock.return_value.get.return_value.content = json.dumps({device_id: {}})
+        client.import_new_sensor_readings(device, sensors, 1467799900000, 1467799700000)
+        self.assertIn('from=1467799764955', mock.return_value.get.call_args[0][0])
+        self.assertEqual(client.get_readings_high_water_mark(device), 1467799764954)
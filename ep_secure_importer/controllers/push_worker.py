@@ -0,0 +1,120 @@
+import logging
+import queue
+import threading
+import time
+
+from django.db import close_old_connections
+
+from ep.timeseries import flush_writes
+
+__author__ = 'schien'
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class PushDataWorkerPool(object):
+    """
+    Processes push messages received over the websocket on worker threads, so that the reactor thread only parses
+    frames and answers pings.
+
+    Each worker drains its own bounded queue. Messages are assigned to a worker by key (the gateway MAC), so the
+    messages of a gateway are processed in the order they were received.
+
+    When a queue is full, :func:`submit` drops the message rather than block the reactor. The counters in :func:`stats`
+    show how close the pool is to its limits.
+    """
+
+    def __init__(self, process_func, workers=4, queue_size=1000):
+        """
+        :param process_func: called with each submitted message
+        :param workers: number of worker threads
+        :param queue_size: maximum number of messages waiting per worker
+        """
+        self.process_func = process_func
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+
+        self._lock = threading.Lock()
+        self.submitted_count = 0
+        self.processed_count = 0
+        self.failed_count = 0
+        self.dropped_count = 0
+        self.max_depth = 0
+        self.processing_time = 0.
+
+        self.threads = []
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(target=self._run, args=(q,), name='secure-push-worker-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, message):
+        """
+        Queue a message for processing.
+
+        :return: False if the message was dropped because the queue was full
+        """
+        q = self.queues[hash(key) % len(self.queues)]
+        try:
+            q.put_nowait(message)
+        except queue.Full:
+            with self._lock:
+                self.dropped_count += 1
+            logger.error('Push data queue full, dropping message for {}'.format(key))
+            return False
+
+        with self._lock:
+            self.submitted_count += 1
+            self.max_depth = max(self.max_depth, q.qsize())
+        return True
+
+    def _run(self, q):
+        while True:
+            message = q.get()
+            if message is _STOP:
+                return
+
+            start = time.time()
+            # worker threads hold their own DB connection, discard it if it has become unusable
+            close_old_connections()
+            try:
+                self.process_func(message)
+            except Exception:
+                with self._lock:
+                    self.failed_count += 1
+                logger.exception('Error processing push data')
+            else:
+                with self._lock:
+                    self.processed_count += 1
+            finally:
+                close_old_connections()
+                with self._lock:
+                    self.processing_time += time.time() - start
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': self.depth(),
+                'max_depth': self.max_depth,
+                'submitted': self.submitted_count,
+                'processed': self.processed_count,
+                'failed': self.failed_count,
+                'dropped': self.dropped_count,
+                'mean_processing_time': self.processing_time / max(self.processed_count + self.failed_count, 1),
+            }
+
+    def close(self, timeout=30.):
+        """
+        Process the queued messages, stop the workers and write any buffered points.
+        """
+        for q in self.queues:
+            q.put(_STOP)
+        deadline = time.time() + timeout
+        for thread in self.threads:
+            thread.join(max(deadline - time.time(), 0))
+        flush_writes()
@@ -0,0 +1,82 @@
+import logging
+import threading
+
+from ep.models import DeviceParameter
+
+__author__ = 'schien'
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceParameterRegistry(object):
+    """
+    Per process map of the identifiers in secure push messages to model instances, so that the push path does not
+    have to query the database.
+
+    - devices are looked up by (gateway MAC, DRefID)
+    - device parameters are looked up by (device id, DPRefID)
+
+    All device parameters of a vendor's gateways are loaded with a single query on first access, including the related
+    objects the importer reads (type, device type, node, gateway and site). Objects created later are added with
+    :func:`add_device` and :func:`add_device_parameter`, or picked up by reloading after :func:`invalidate`.
+    """
+
+    def __init__(self, vendor_name):
+        self.vendor_name = vendor_name
+        self._devices = {}
+        self._parameters = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        queryset = DeviceParameter.objects.filter(device__node__gateway__vendor__name=self.vendor_name) \
+            .select_related('type', 'device__type', 'device__node__gateway__site')
+
+        devices = {}
+        parameters = {}
+        for device_parameter in queryset:
+            device = device_parameter.device
+            # share a single device instance between the parameters of a device
+            device = devices.setdefault((device.node.gateway.external_id, device.external_id), device)
+            device_parameter.device = device
+            parameters[(device.id, device_parameter.type.code)] = device_parameter
+
+        with self._lock:
+            self._devices = devices
+            self._parameters = parameters
+            self._loaded = True
+        logger.info('Loaded {} devices and {} device parameters of vendor {}'.format(
+            len(devices), len(parameters), self.vendor_name))
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def get_device(self, gateway_mac, d_ref_id):
+        """
+        :return: the :class:`Device` or None if it is not known
+        """
+        self._ensure_loaded()
+        return self._devices.get((str(gateway_mac), str(d_ref_id)))
+
+    def get_device_parameter(self, device, dp_ref_id):
+        """
+        :return: the :class:`DeviceParameter` or None if it is not known
+        """
+        self._ensure_loaded()
+        return self._parameters.get((device.id, str(dp_ref_id)))
+
+    def add_device(self, device):
+        with self._lock:
+            self._devices[(device.node.gateway.external_id, device.external_id)] = device
+
+    def add_device_parameter(self, device_parameter):
+        with self._lock:
+            self._parameters[(device_parameter.device_id, device_parameter.type.code)] = device_parameter
+
+    def invalidate(self):
+        """
+        Reload the registry on next access.
+        """
+        with self._lock:
+            self._loaded = False
@@ -3,11 +3,13 @@ import datetime
 import hashlib
 import hmac
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 
 import pylibmc
 import pytz
-import requests
 import simplejson as json
 from django.conf import settings
 from django.utils import timezone
@@ -17,13 +19,37 @@ from ep.models import DeviceParameter, StateChangeEvent, DeviceType, Vendor, \
     DeviceParameterType
 from ep.models import Site, Gateway, Node, Device, SECURE_SERVER_NAME, GatewayProperty, \
     GCSMeasurements
+from ep.http_sessions import get_session
+from ep.response_cache import bump_generation
+from ep.timeseries import flush_writes
 
 import ep_secure_importer.models
+from ep_secure_importer.controllers.registry import DeviceParameterRegistry
 
 # import SecureDeviceType, device_parameter_type_description_map, unit_map, \
 #     device_to_deviceparameter_type_map, devicetype_description_map, dtype_map, SecureDeviceParameterActions
 
-mc = pylibmc.Client([settings.MEMCACHE_HOST], binary=True, behaviors={"tcp_nodelay": True, "ketama": True})
+
+class ThreadLocalMemcacheClient(threading.local):
+    """
+    pylibmc clients must not be shared between threads. Gives every thread its own clone of the client.
+    """
+
+    def __init__(self, client):
+        self.client = client.clone()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def __contains__(self, key):
+        return key in self.client
+
+    def __getitem__(self, key):
+        return self.client[key]
+
+
+mc = ThreadLocalMemcacheClient(
+    pylibmc.Client([settings.MEMCACHE_HOST], binary=True, behaviors={"tcp_nodelay": True, "ketama": True}))
 logger = logging.getLogger(__name__)
 
 secure_vendor_name = 'secure'
@@ -31,12 +57,20 @@ secure_site_name = 'secure_testsite'
 
 MAX_CAPABILITY_PUSH_REQUESTS = 10
 
+device_registry = DeviceParameterRegistry(secure_vendor_name)
+
+# only one thread logs in when the auth tokens are missing
+login_lock = threading.Lock()
+
 
 class SecureClient(object):
     def __init__(self, secure_server_name):
         self.secure_server_name = secure_server_name
         self.headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
-        self.capability_push_request_count = 0
+
+    @property
+    def session(self):
+        return get_session(secure_vendor_name)
 
     def change_secure_device_state(self, device_parameter, target_value):
         data = {'GatewayMacId': device_parameter.device.node.gateway.external_id,
@@ -66,52 +100,83 @@ class SecureClient(object):
         return res['GDDO']['GCS'] == SecureClient.SECURE_GCS_CONNECTED
 
     def check_gateways_online(self, last_update_time):
+        """
+        Request the data of all gateways concurrently (up to `SECURE_GATEWAY_CHECK_WORKERS` at a time) and record
+        their online status.
 
+        :return: whether all gateways are online and a dict of gateway MAC -> online
+        """
         res, status_code = self.get_gateway_list()
 
         if status_code != 200:
             logger.warn('Unable to retrieve list of gateways from {}'.format(self.secure_server_name))
-            return False
+            return False, {}
 
-        healthy = True
-        map = {}
+        def check(gmacid):
+            # a gateway that can not be checked (e.g. its request timed out) counts as offline
+            try:
+                return self.check_gateway_online(gmacid, last_update_time)
+            except Exception:
+                logger.exception('Checking gateway {} failed'.format(gmacid))
+                return False
 
-        for gateway in res:
-            gmacid = gateway['GMACID']
+        gmacids = [gateway['GMACID'] for gateway in res]
+        with ThreadPoolExecutor(max_workers=settings.SECURE_GATEWAY_CHECK_WORKERS) as executor:
+            map = OrderedDict(zip(gmacids, executor.map(check, gmacids)))
 
-            this_healthy = self.check_gateway_online(gmacid, last_update_time)
-            map[gmacid] = this_healthy
+        healthy = True
+        for gmacid, this_healthy in map.items():
             if this_healthy:
                 logger.info('Gateway {} is online'.format(gmacid))
             else:
                 logger.warn('Gateway {} is offline'.format(gmacid))
                 healthy = False
 
-            # update meta data
-            # @todo duplicated property value and measurement in TS
-            try:
-                gateway_object = Gateway.objects.filter(external_id=gmacid).get()
-            except Gateway.DoesNotExist:
-                logger.warn('Gateway {} not present in metadata'.format(gmacid))
-                continue
+        self.store_gateways_online(map)
+        return healthy, map
 
-            online_property_name = 'online'
-            online_property, created = GatewayProperty.objects.get_or_create(gateway=gateway_object,
-                                                                             key=online_property_name)
-            if created:
-                logger.debug('Added new property \'{}\' to gateway {}'.format(online_property_name, gmacid))
-            online_property.value = str(this_healthy)
-            online_property.save()
+    @staticmethod
+    def store_gateways_online(map):
+        """
+        Record the online status of gateways in their 'online' property and as GCS measurement.
 
-            # update TS data
-            GCSMeasurements(gateway_object).add(timezone.now(), this_healthy)
-        return healthy, map
+        :param map: dict of gateway MAC -> online
+        """
+        now = timezone.now()
+        online = {str(gmacid): this_healthy for gmacid, this_healthy in map.items()}
+
+        gateways = {gateway.external_id: gateway for gateway in Gateway.objects.filter(external_id__in=online.keys())}
+        for gmacid in online:
+            if gmacid not in gateways:
+                logger.warn('Gateway {} not present in metadata'.format(gmacid))
 
-    def perform_get_request(self, path):
+        # update meta data
+        # @todo duplicated property value and measurement in TS
+        online_property_name = 'online'
+        properties = {online_property.gateway_id: online_property for online_property in
+                      GatewayProperty.objects.filter(gateway__in=gateways.values(), key=online_property_name)}
+        new_properties = [GatewayProperty(gateway=gateway, key=online_property_name, value=str(online[gmacid]))
+                          for gmacid, gateway in gateways.items() if gateway.id not in properties]
+        if new_properties:
+            logger.debug('Adding property \'{}\' to {} gateways'.format(online_property_name, len(new_properties)))
+            GatewayProperty.objects.bulk_create(new_properties)
+        for value in (True, False):
+            ids = [properties[gateway.id].id for gmacid, gateway in gateways.items()
+                   if gateway.id in properties and online[gmacid] == value]
+            if ids:
+                GatewayProperty.objects.filter(id__in=ids).update(value=str(value))
+
+        # update TS data, written as one batch
+        for gmacid, gateway in gateways.items():
+            GCSMeasurements(gateway).add(now, online[gmacid])
+        flush_writes()
+
+    def perform_get_request(self, path, attempt=0):
         """
         Performs a GET request to the specified path, first setting the necessary authorization headers.
 
         :param path: The request path, appended to the server's HOST
+        :param attempt: number of previous requests rejected due to a capability push
         :returns: The response and the HTTP status code of the request
         """
         url = 'http://{server_address}{path}'.format(
@@ -121,21 +186,18 @@ class SecureClient(object):
         naked_path = path.split('?', 1)[0]
 
         ak, ak_id = self.get_auth_tokens()
-        self.headers.update(SecureClient.get_extra_headers(ak=ak, ak_id=ak_id, path=naked_path))
+        headers = dict(self.headers, **SecureClient.get_extra_headers(ak=ak, ak_id=ak_id, path=naked_path))
         logger.debug("Calling {path}".format(path=path))
-        r = requests.get(url, headers=self.headers)
+        r = self.session.get(url, headers=headers)
 
         res = json.loads(r.content)
 
         if self.is_capability_push(r, res):
-            if self.capability_push_request_count < MAX_CAPABILITY_PUSH_REQUESTS:
-                self.capability_push_request_count += 1
-                return self.perform_get_request(path)
+            if attempt < MAX_CAPABILITY_PUSH_REQUESTS:
+                return self.perform_get_request(path, attempt + 1)
             else:
                 logger.error('Timed out due to capability push count exceeding the maximum ({})'.format(
                     MAX_CAPABILITY_PUSH_REQUESTS))
-        else:
-            self.capability_push_request_count = 0
 
         logger.debug(
             'Call to http://{server_address}{path} from secure server got response [HTTP Code {code}]'.format(
@@ -161,10 +223,10 @@ class SecureClient(object):
             server_address=settings.SECURE_SERVERS[self.secure_server_name]['HOST'], path=path)
 
         ak, ak_id = self.get_auth_tokens()
-        self.headers.update(SecureClient.get_extra_headers(ak=ak, ak_id=ak_id, path=path, data_str=data_str))
+        headers = dict(self.headers, **SecureClient.get_extra_headers(ak=ak, ak_id=ak_id, path=path, data_str=data_str))
         logger.info("Requesting device parameter change",
                     extra={'data': data_str, 'device_parameter': device_parameter.id})
-        r = requests.post(url, data=data_str, headers=self.headers)
+        r = self.session.post(url, data=data_str, headers=headers)
 
         try:
             res = r.json()
@@ -199,7 +261,7 @@ class SecureClient(object):
 
         url = 'http://{server_address}/user/{command}'.format(
             server_address=settings.SECURE_SERVERS[self.secure_server_name]['HOST'], command='login')
-        r = requests.post(url, data=data)
+        r = self.session.post(url, data=data)
 
         if r.status_code is not 200:
             raise Exception('HTTP [%s] Error on backend: %s' % (r.status_code, r.content))
@@ -225,8 +287,12 @@ class SecureClient(object):
             ak = mc[auth_key]
             ak_id = mc['secure_ak_id_%s' % self.secure_server_name]
         else:
-            ak, ak_id, res = self.login()
-            self.process_login_data(res)
+            with login_lock:
+                # another thread may have logged in while this one was waiting
+                if auth_key in mc:
+                    return mc[auth_key], mc['secure_ak_id_%s' % self.secure_server_name]
+                ak, ak_id, res = self.login()
+                self.process_login_data(res)
 
         return ak, ak_id
 
@@ -235,17 +301,24 @@ class SecureClient(object):
         On login, the server returns the server state - including the configuration of all gateways and connected devices.
         This is the opportunity to update configuration data.
 
-        1.
+        The payload is indexed once and compared to a snapshot of the existing gateways, nodes, devices and device
+        parameters. Missing rows are created in bulk, so that a relogin takes a handful of queries.
         :return:
         """
         # Concept of site does not exist for secure -> for new gateway, add them to a "holding" site
         site, _ = Site.objects.get_or_create(name=secure_site_name)
+        vendor, _ = Vendor.objects.get_or_create(name=secure_vendor_name)
 
         # @todo Send email if site mapping does not contain entry for this gateway
 
-        # import from all gateways
+        # the GW name is submitted separately
+        gateway_names = {str(GWUDO['GMACID']): GWUDO['GN'] for GWUDO in res['GWUDO']}
+        gateway_data = {str(GD['GMACID']): GD for GD in res['GD']}
+
+        # (gateway MAC, DRefID) -> (DDDO, device type code)
+        device_entries = OrderedDict()
         for GDDO in res['GDDO']:
-            gw_mac = GDDO['GMACID']
+            gw_mac = str(GDDO['GMACID'])
             logger.info('Processing login data for gateway %s' % gw_mac, extra={'gw_mac': gw_mac})
             logger.debug('Login message data for gateway %s' % gw_mac,
                          extra={'gw_mac': gw_mac, 'GDDO': json.dumps(GDDO)})
@@ -253,73 +326,175 @@ class SecureClient(object):
             if GDDO['GCS'] is not SecureClient.SECURE_GCS_CONNECTED:
                 logger.warn('gateway %s not connected, ignoring message' % gw_mac, extra={'gw_mac': gw_mac})
 
-            # the GW name is submitted separately
-            gw_name = [GWUDO for GWUDO in res['GWUDO'] if GWUDO['GMACID'] == gw_mac][0]['GN']
-            gw_data = [GD for GD in res['GD'] if GD['GMACID'] == gw_mac][0]
-            gw_serial = gw_data['GSN']
-
-            gateway_created = False
-            gateway_set = Gateway.objects.filter(external_id=gw_mac)
-            vendor, _ = Vendor.objects.get_or_create(name=secure_vendor_name)
-            if not gateway_set.exists():
-                gateway = Gateway(external_id=gw_mac, site=site, vendor=vendor)
-                gateway.save()
-                gateway_created = True
+            zones = {zone['ZID']: zone for zone in gateway_data[gw_mac]['ZNS']}
+            for zone in GDDO['ZNDS']:
+                devices_data = {str(dev['DRefID']): dev for dev in zones[zone['ZID']]['DVS']}
+                for DDDO in zone['DDDO']:
+                    dRefID = str(DDDO['DRefID'])
+                    device_entries[(gw_mac, dRefID)] = (DDDO, SecureClient.get_device_type_code(devices_data[dRefID]))
+
+        gw_macs = [str(GDDO['GMACID']) for GDDO in res['GDDO']]
+        gateways, gateways_created = self.sync_gateways(gw_macs, gateway_names, gateway_data, site, vendor)
+        # Node does not exist for secure
+        # on initial import all devices are on the same node
+        # later, device can be moved to other nodes @todo support
+        nodes, nodes_created = SecureClient.sync_nodes(gateways, vendor)
+        devices, devices_created = SecureClient.sync_devices(device_entries, gateways, nodes, vendor)
+        parameters_created = SecureClient.sync_device_parameters(device_entries, devices)
+
+        if gateways_created or nodes_created or devices_created or parameters_created:
+            device_registry.invalidate()
+            # bulk_create sends no post_save signals, invalidate the cached API responses here
+            bump_generation()
+
+        for key, (DDDO, _) in device_entries.items():
+            SecureClient.store_device_state_from_DPDO(DDDO, devices[key])
+
+    @staticmethod
+    def get_device_type_code(device_data):
+        device_type_str = ep_secure_importer.models.dtype_map[device_data['DTID']]
+
+        # distinguish SSP302 and SIR321 by parameters
+        if device_type_str == ep_secure_importer.models.SecureDeviceType.RELAY:
+            instantaneous_power_parameters = [param for param in device_data['DPDO'] if param['DPRefID'] == 102]
+            if any(instantaneous_power_parameters):
+                device_type_str = ep_secure_importer.models.SecureDeviceType.SIR321
             else:
-                gateway = gateway_set.first()
+                device_type_str = ep_secure_importer.models.SecureDeviceType.SSP302
+        return device_type_str
 
-            if not gateway.properties.filter(key='GN').exists():
-                gateway.properties.create(key='GN', value=gw_name)
-            if not gateway.properties.filter(key='GSN').exists():
-                gateway.properties.create(key='GSN', value=gw_serial)
+    def sync_gateways(self, gw_macs, gateway_names, gateway_data, site, vendor):
+        """
+        :return: dict of gateway MAC -> :class:`Gateway` and whether gateways were created
+        """
+        gateways = {gateway.external_id: gateway for gateway in Gateway.objects.filter(external_id__in=gw_macs)}
+
+        new_macs = [gw_mac for gw_mac in gw_macs if gw_mac not in gateways]
+        if new_macs:
+            logger.info('Creating gateways {}'.format(', '.join(new_macs)))
+            Gateway.objects.bulk_create([Gateway(external_id=gw_mac, site=site, vendor=vendor) for gw_mac in new_macs])
+            # bulk_create does not set primary keys, read the new rows back
+            for gateway in Gateway.objects.filter(external_id__in=new_macs):
+                gateways[gateway.external_id] = gateway
+
+        existing_properties = set(GatewayProperty.objects.filter(gateway__in=gateways.values(), key__in=['GN', 'GSN'])
+                                  .values_list('gateway_id', 'key'))
+        properties = []
+        for gw_mac, gateway in gateways.items():
+            if (gateway.id, 'GN') not in existing_properties:
+                properties.append(GatewayProperty(gateway=gateway, key='GN', value=gateway_names[gw_mac]))
+            if (gateway.id, 'GSN') not in existing_properties:
+                properties.append(GatewayProperty(gateway=gateway, key='GSN', value=gateway_data[gw_mac]['GSN']))
+        for gw_mac in new_macs:
+            properties.append(GatewayProperty(gateway=gateways[gw_mac], key=SECURE_SERVER_NAME,
+                                              value=self.secure_server_name))
+        if properties:
+            GatewayProperty.objects.bulk_create(properties)
+
+        return gateways, bool(new_macs)
 
-            if gateway_created:
-                gateway.properties.create(key=SECURE_SERVER_NAME, value=self.secure_server_name)
+    @staticmethod
+    def sync_nodes(gateways, vendor):
+        """
+        :return: dict of gateway id -> :class:`Node` and whether nodes were created
+        """
+        nodes = {}
+        for node in Node.objects.filter(gateway__in=gateways.values(), vendor=vendor).order_by('id'):
+            nodes.setdefault(node.gateway_id, node)
 
-            # Node does not exist for secure
-            # on initial import all devices are on the same node
-            # later, device can be moved to other nodes @todo support
-            node, node_created = Node.objects.get_or_create(gateway=gateway, vendor=vendor)
+        missing = [gateway for gateway in gateways.values() if gateway.id not in nodes]
+        if missing:
+            Node.objects.bulk_create([Node(gateway=gateway, vendor=vendor) for gateway in missing])
+            for node in Node.objects.filter(gateway__in=missing, vendor=vendor).order_by('id'):
+                nodes.setdefault(node.gateway_id, node)
 
-            # import all device data
-            for zone in GDDO['ZNDS']:
-                zone_id = zone['ZID']
-                zone_data = [zone for zone in gw_data['ZNS'] if zone['ZID'] == zone_id][0]
+        return nodes, bool(missing)
 
-                # iterate over all device data
-                for DDDO in zone['DDDO']:
-                    dRefID = DDDO['DRefID']
-
-                    device_data = [dev for dev in zone_data['DVS'] if dev['DRefID'] == dRefID][0]
-                    device_type_str = ep_secure_importer.models.dtype_map[device_data['DTID']]
-                    #             print('{}: {}'.format(dRefID,device_type))
-
-                    # distinguish SSP302 and SIR321 by parameters
-                    if device_type_str == ep_secure_importer.models.SecureDeviceType.RELAY:
-                        instantaneous_power_parameters = [param for param in device_data['DPDO'] if
-                                                          param['DPRefID'] == 102]
-                        if any(instantaneous_power_parameters):
-                            device_type_str = ep_secure_importer.models.SecureDeviceType.SIR321
-                        else:
-                            device_type_str = ep_secure_importer.models.SecureDeviceType.SSP302
-
-                    device_type, created = DeviceType.objects.get_or_create(code=device_type_str)
-                    if created:
-                        if device_type_str in ep_secure_importer.models.devicetype_description_map:
-                            device_type.description = ep_secure_importer.models.devicetype_description_map[
-                                device_type_str]
-                            device_type.save()
-                        logger.info('Created DeviceType: {}'.format(device_type))
+    @staticmethod
+    def sync_devices(device_entries, gateways, nodes, vendor):
+        """
+        :param device_entries: dict of (gateway MAC, DRefID) -> (DDDO, device type code)
+        :return: dict of (gateway MAC, DRefID) -> :class:`Device` and whether devices were created
+        """
+        devices = {}
+        queryset = Device.objects.select_related('type', 'node__gateway__site')
+        for device in queryset.filter(node__gateway__in=gateways.values()).order_by('id'):
+            devices.setdefault((device.node.gateway.external_id, device.external_id), device)
+
+        missing = [key for key in device_entries if key not in devices]
+        if missing:
+            device_types = SecureClient.get_or_create_types(DeviceType, {device_entries[key][1] for key in missing},
+                                                            ep_secure_importer.models.devicetype_description_map)
+            logger.info("Creating new devices with external ids %s" % ', '.join(dRefID for _, dRefID in missing))
+            Device.objects.bulk_create([
+                Device(node=nodes[gateways[gw_mac].id], type=device_types[device_entries[(gw_mac, dRefID)][1]],
+                       vendor=vendor, external_id=dRefID)
+                for gw_mac, dRefID in missing])
+            new_nodes = {nodes[gateways[gw_mac].id] for gw_mac, _ in missing}
+            for device in queryset.filter(node__in=new_nodes, external_id__in=[dRefID for _, dRefID in missing]):
+                devices.setdefault((device.node.gateway.external_id, device.external_id), device)
+
+        return devices, bool(missing)
 
-                    try:
-                        device = Device.objects.get(external_id=dRefID, node__gateway=gateway)
-                    except Device.DoesNotExist:
-                        # use the factory method, because we want to have device parameters created as well
-                        logger.info("Creating new device with external id %s" % dRefID)
-                        device = Device(node=node, type=device_type, vendor=vendor, external_id=dRefID)
-                        device.save()
+    @staticmethod
+    def sync_device_parameters(device_entries, devices):
+        """
+        Create the device parameters the importer stores values for, if they do not exist yet.
+
+        :return: whether device parameters were created
+        """
+        # device -> codes of the parameters to store
+        wanted = []
+        for key, (DDDO, _) in device_entries.items():
+            device = devices[key]
+            device_parameter_map = ep_secure_importer.models.device_to_deviceparameter_type_map.get(device.type.code)
+            if device_parameter_map is None:
+                continue
+            codes = [str(DPDO['DPRefID']) for DPDO in DDDO['DPDO'] if str(DPDO['DPRefID']) in device_parameter_map]
+            wanted.append((device, codes))
+
+        existing = set(DeviceParameter.objects.filter(device__in=[device for device, _ in wanted])
+                       .values_list('device_id', 'type__code'))
+        missing = [(device, code) for device, codes in wanted for code in codes if (device.id, code) not in existing]
+        if not missing:
+            return False
 
-                    SecureClient.store_device_state_from_DPDO(DDDO, device)
+        parameter_types = SecureClient.get_or_create_types(
+            DeviceParameterType, {code for _, code in missing},
+            ep_secure_importer.models.device_parameter_type_description_map)
+
+        device_parameters = []
+        for device, code in missing:
+            logger.info('Creating new DP with type %s' % parameter_types[code])
+            unit = ep_secure_importer.models.unit_map.get(code)
+            if unit is None:
+                logger.warn("Could not find unit mapping for new device parameter.")
+            # actions need a primary key for the generic relation, so they can not be created in bulk
+            actions = ep_secure_importer.models.SecureDeviceParameterActions()
+            actions.save()
+            device_parameters.append(DeviceParameter(device=device, type=parameter_types[code], unit=unit,
+                                                     actions=actions))
+        DeviceParameter.objects.bulk_create(device_parameters)
+        return True
+
+    @staticmethod
+    def get_or_create_types(model, codes, description_map):
+        """
+        Look up :class:`DeviceType` or :class:`DeviceParameterType` objects by code, creating the missing ones.
+
+        :return: dict of code -> type
+        """
+        types = {}
+        for type_ in model.objects.filter(code__in=codes).order_by('id'):
+            types.setdefault(type_.code, type_)
+
+        missing = [code for code in codes if code not in types]
+        if missing:
+            model.objects.bulk_create([model(code=code, description=description_map.get(code)) for code in missing])
+            for type_ in model.objects.filter(code__in=missing).order_by('id'):
+                types.setdefault(type_.code, type_)
+            logger.info('Created {}: {}'.format(model.__name__, ', '.join(missing)))
+        return types
 
     @staticmethod
     def process_push_data(res):
@@ -334,7 +509,6 @@ class SecureClient(object):
         gw_mac = GDDO['GMACID']
         logger.info("Processing push data from gateway %s" % gw_mac,
                     extra={'data': json.dumps(GDDO), 'gateway': gw_mac})
-        gateway = Gateway.objects.get(external_id=gw_mac)
 
         # import all device data
         for zone in GDDO['ZNDS']:
@@ -343,11 +517,15 @@ class SecureClient(object):
             for DDDO in zone['DDDO']:
                 dRefID = DDDO['DRefID']
 
-                try:
-                    device = Device.objects.get(external_id=dRefID, node__gateway=gateway)
-                except Device.DoesNotExist as e:
-                    logger.error(e)
-                    continue
+                device = device_registry.get_device(gw_mac, dRefID)
+                if device is None:
+                    try:
+                        device = Device.objects.select_related('type', 'node__gateway__site') \
+                            .get(external_id=dRefID, node__gateway__external_id=gw_mac)
+                    except Device.DoesNotExist as e:
+                        logger.error(e)
+                        continue
+                    device_registry.add_device(device)
 
                 SecureClient.store_device_state_from_DPDO(DDDO, device)
 
@@ -371,30 +549,46 @@ class SecureClient(object):
                 logger.info("Ignoring device parameter in push message: {}".format(param_type_str))
                 continue
 
-            parameter_type, created = DeviceParameterType.objects.get_or_create(code=param_type_str)
-            if created:
-                if param_type_str in ep_secure_importer.models.device_parameter_type_description_map:
-                    parameter_type.description = ep_secure_importer.models.device_parameter_type_description_map[
-                        param_type_str]
-                    parameter_type.save()
-                logger.info('Created new DP Type: {}'.format(parameter_type))
+            device_parameter = device_registry.get_device_parameter(device, param_type_str)
+            if device_parameter is None:
+                device_parameter = SecureClient.get_or_create_device_parameter(device, param_type_str)
+                device_registry.add_device_parameter(device_parameter)
 
-            try:
-                SecureClient.store_device_state_info(DPDO, device, parameter_type)
+            SecureClient.store_device_state_info(DPDO, device_parameter)
 
-            except DeviceParameter.DoesNotExist as e:
-                logger.info('Creating new DP with type %s' % parameter_type)
+    @staticmethod
+    def get_or_create_device_parameter(device, param_type_str):
+        """
+        Look up the device parameter of a type, creating the type and the parameter if they do not exist yet.
+        """
+        parameter_type, created = DeviceParameterType.objects.get_or_create(code=param_type_str)
+        if created:
+            if param_type_str in ep_secure_importer.models.device_parameter_type_description_map:
+                parameter_type.description = ep_secure_importer.models.device_parameter_type_description_map[
+                    param_type_str]
+                parameter_type.save()
+            logger.info('Created new DP Type: {}'.format(parameter_type))
+
+        try:
+            device_parameter = DeviceParameter.objects.get(device=device, type=parameter_type)
 
-                if param_type_str in ep_secure_importer.models.unit_map:
-                    unit = ep_secure_importer.models.unit_map[param_type_str]
-                else:
-                    unit = None
-                    logger.warn("Could not find unit mapping for new device parameter.")
+        except DeviceParameter.DoesNotExist:
+            logger.info('Creating new DP with type %s' % parameter_type)
 
-                actions = ep_secure_importer.models.SecureDeviceParameterActions()
-                actions.save()
-                DeviceParameter(device=device, type=parameter_type, unit=unit, actions=actions).save()
-                SecureClient.store_device_state_info(DPDO, device, parameter_type)
+            if param_type_str in ep_secure_importer.models.unit_map:
+                unit = ep_secure_importer.models.unit_map[param_type_str]
+            else:
+                unit = None
+                logger.warn("Could not find unit mapping for new device parameter.")
+
+            actions = ep_secure_importer.models.SecureDeviceParameterActions()
+            actions.save()
+            device_parameter = DeviceParameter(device=device, type=parameter_type, unit=unit, actions=actions)
+            device_parameter.save()
+
+        # reuse the device instance, its related objects are loaded already
+        device_parameter.device = device
+        return device_parameter
 
     @staticmethod
     def parse_value(DPDO):
@@ -409,8 +603,8 @@ class SecureClient(object):
         return value
 
     @staticmethod
-    def store_device_state_info(DPDO, device, param_type):
-        device_parameter = DeviceParameter.objects.get(device=device, type=param_type)
+    def store_device_state_info(DPDO, device_parameter):
+        device = device_parameter.device
 
         # @todo test if the correct measurement is found and if the LUT is correctly compared
         value = SecureClient.parse_value(DPDO)
@@ -420,12 +614,10 @@ class SecureClient(object):
         ts_loc = pytz.timezone('Europe/London').localize(lut_dt)
         lut_utc = ts_loc.astimezone(pytz.UTC)
 
-        latest = device_parameter.measurements.latest()
+        latest = device_parameter.measurements.last_value()
 
         if latest:
-            latest_ts = parse_datetime(latest['time'])
-
-            if not lut_utc > latest_ts:
+            if not lut_utc > latest.time:
                 logger.info(
                     "Ignoring old device parameter state (not changed from most recent value) [%s]" % device_parameter.id,
                     extra={'site': secure_site_name, 'device': device, 'type': device_parameter.type,
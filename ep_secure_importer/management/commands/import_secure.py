@@ -3,9 +3,14 @@ import logging
 from functools import partial
 
 import simplejson as json
+from django.conf import settings
 from django.core.management import BaseCommand
+from twisted.internet import reactor, task
 
-from ep_secure_importer.controllers.secure_client import SecureClient
+from ep.http_sessions import get_session
+from ep.models import DPMeasurements
+from ep_secure_importer.controllers.push_worker import PushDataWorkerPool
+from ep_secure_importer.controllers.secure_client import SecureClient, secure_vendor_name
 from ep_secure_importer.controllers.websocket_client import run
 
 __author__ = 'schien'
@@ -18,16 +23,21 @@ class ConnectionException(Exception):
     pass
 
 
-def websocket_message_processing_callback(message, secure_server_name=None):
+def websocket_message_processing_callback(message, secure_server_name=None, worker_pool=None):
     """
     Callback to pass to the websocket protocol
+
+    :param worker_pool: a :class:`PushDataWorkerPool` to hand push data to. If None, push data is processed inline.
     :return:
     """
 
     res = json.loads(message)
     logger.debug("Received push message from websocket")
     if res['DataType'] == 0:
-        SecureClient.process_push_data(res['Data'])
+        if worker_pool is None:
+            SecureClient.process_push_data(res['Data'])
+        else:
+            worker_pool.submit(res['Data']['GDDO']['GMACID'], res['Data'])
         return True
     else:
         logger.info("Received error from websocket", extra={'data': json.dumps(res), "server": secure_server_name})
@@ -50,9 +60,19 @@ class Command(BaseCommand):
 
         if options['reset_mc']:
             SecureClient.delete_auth_tokens(self.secure_server_name)
+
+        # load the most recent value of all device parameters up front, rather than querying them one by one
+        DPMeasurements.last_value_cache().warm()
+
+        self.worker_pool = PushDataWorkerPool(SecureClient.process_push_data,
+                                              workers=settings.SECURE_PUSH_WORKERS,
+                                              queue_size=settings.SECURE_PUSH_QUEUE_SIZE)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.worker_pool.close)
+        task.LoopingCall(self.log_stats).start(settings.SECURE_PUSH_STATS_INTERVAL, now=False)
         try:
             websocket_message_callback = partial(websocket_message_processing_callback,
-                                                 secure_server_name=self.secure_server_name)
+                                                 secure_server_name=self.secure_server_name,
+                                                 worker_pool=self.worker_pool)
 
             websocket_login_func = partial(Command.get_ws_url, secure_server_name=self.secure_server_name)
 
@@ -63,6 +83,13 @@ class Command(BaseCommand):
             error_email_logger.exception('Exception in %s secure importer' % self.secure_server_name)
             logger.info('sleeping for remote recovery')
 
+    def log_stats(self):
+        stats = self.worker_pool.stats()
+        logger.info('Push worker pool: {depth} queued (max {max_depth}), {processed} processed, {failed} failed, '
+                    '{dropped} dropped'.format(**stats),
+                    extra=dict(stats, server=self.secure_server_name))
+        get_session(secure_vendor_name).log_latency_stats()
+
     @staticmethod
     def get_ws_url(secure_server_name='default'):
         ak, ak_id = SecureClient(secure_server_name).get_auth_tokens(reset=True)
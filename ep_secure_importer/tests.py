@@ -13,7 +13,9 @@ from celery import current_app
 from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, SimpleTestCase
+from django.test.utils import CaptureQueriesContext
 from django.test import override_settings
 from django.utils import timezone
 from rest_framework.authtoken.models import Token
@@ -21,7 +23,8 @@ from rest_framework.test import APIClient
 
 from ep.apiviews import uob_estates_group, ebe_group
 from ep.tests.factories import SiteFactory, DeviceFactory
-from ep_secure_importer.controllers.secure_client import SecureClient
+from ep_secure_importer.controllers.push_worker import PushDataWorkerPool
+from ep_secure_importer.controllers.secure_client import SecureClient, device_registry
 from ep_secure_importer.management.commands.import_secure import Command
 from ep.models import Device, DeviceParameter, Gateway, Site, GCSMeasurements, Node, SECURE_SERVER_NAME
 from ep.tests.test_standalone import email  # , SiteFactory
@@ -31,6 +34,8 @@ __author__ = 'schien'
 logger = logging.getLogger(__name__)
 
 
+# responses cached by one test would outlive the rollback of its data
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
 class SecureAPITests(TestCase):
     site_name = 'test'
     gw_mac_id = 123
@@ -66,6 +71,8 @@ class SecureAPITests(TestCase):
         dp.actions = actions
         dp.save()
 
+    def setUp(self):
+        device_registry.invalidate()
 
     def test_factories(self):
         site = Site.objects.first()
@@ -113,6 +120,53 @@ class SecureAPITests(TestCase):
         self.assertTrue(response.status_code == 200)
         self.assertTrue(len(response.data) >= 2)
 
+    @patch('amqpstorm.Connection')
+    def test_push_data_resolved_without_queries(self, mock_amqp):
+        device = DeviceFactory(node=Node.objects.first(), external_id='456', type__code=SecureDeviceType.SRT321,
+                               device_param__type__code=SecureDeviceParameterType.MEASURED_TEMPERATURE)
+        now_loc = datetime.datetime.now(bst)
+        ts_str = (now_loc - datetime.timedelta(seconds=30)).strftime('%Y-%m-%dT%H:%M:%S')
+
+        data = self.create_secure_server_push_data(device.external_id, ts_str)
+        SecureClient.process_push_data(data)
+
+        data = self.create_secure_server_push_data(device.external_id, now_loc.strftime('%Y-%m-%dT%H:%M:%S'),
+                                                   value="23.5")
+        with self.assertNumQueries(0):
+            SecureClient.process_push_data(data)
+
+        self.assertEqual(device.parameters.first().measurements.last_value().value, Decimal('23.5'))
+
+    @patch('ep_secure_importer.controllers.secure_client.bump_generation')
+    @patch('amqpstorm.Connection')
+    def test_process_login_data(self, mock_amqp, bump_mock):
+        now_str = datetime.datetime.now(bst).strftime('%Y-%m-%dT%H:%M:%S')
+        gw_mac = 'AA:BB'
+        parameters = [{'DPRefID': int(SecureDeviceParameterType.MEASURED_TEMPERATURE), 'CV': '20.5', 'LUT': now_str}]
+        devices = [{'DRefID': str(i), 'DTID': 2, 'DPDO': parameters} for i in range(5)]
+        res = {
+            'GDDO': [{'GMACID': gw_mac, 'GCS': '1', 'ZNDS': [{'ZID': 1, 'DDDO': devices}]}],
+            'GWUDO': [{'GMACID': gw_mac, 'GN': 'gateway'}],
+            'GD': [{'GMACID': gw_mac, 'GSN': 'serial', 'ZNS': [{'ZID': 1, 'DVS': devices}]}],
+        }
+
+        SecureClient('test').process_login_data(res)
+
+        gateway = Gateway.objects.get(external_id=gw_mac)
+        self.assertEqual(gateway.properties.get(key='GN').value, 'gateway')
+        self.assertEqual(gateway.properties.get(key=SECURE_SERVER_NAME).value, 'test')
+        self.assertEqual(Device.objects.filter(node__gateway=gateway).count(), 5)
+        self.assertEqual(DeviceParameter.objects.filter(device__node__gateway=gateway).count(), 5)
+        # the rows are created in bulk, without signals
+        bump_mock.assert_called_once_with()
+
+        # a relogin without changes takes a constant number of queries
+        with CaptureQueriesContext(connection) as queries:
+            SecureClient('test').process_login_data(res)
+        self.assertLessEqual(len(queries), 8)
+        self.assertEqual(Device.objects.filter(node__gateway=gateway).count(), 5)
+        self.assertEqual(bump_mock.call_count, 1)
+
     @staticmethod
     def create_secure_server_push_data(external_device_ref_id, timestamp_string, value="23.7",
                                        dp_type=SecureDeviceParameterType.MEASURED_TEMPERATURE):
@@ -222,7 +276,7 @@ class SecureAPITests(TestCase):
     @override_settings(
         SECURE_SERVERS={'test': {'HOST': 'test.com', 'WSHOST': 'test', 'USER': 'tester', 'PASSWORD': 'test'}})
     # need to patch requests to the secure server
-    @patch('ep_secure_importer.controllers.secure_client.requests')
+    @patch('ep_secure_importer.controllers.secure_client.get_session')
     # need to bypass login by pre-populating the memcache
     @patch('ep_secure_importer.controllers.secure_client.mc')
     def test_gcs(self, mc_mock, req_mock):
@@ -283,7 +337,7 @@ class SecureAPITests(TestCase):
 
             return mm
 
-        req_mock.get.side_effect = get_method_mock
+        req_mock.return_value.get.side_effect = get_method_mock
 
         site = Site.objects.first()
         gateway = Gateway.objects.filter(site=site).first()
@@ -327,3 +381,54 @@ class SecureAPITests(TestCase):
         mc_mock.__contains__.side_effect = lambda k: True
 
     mock_call_counter = 0
+
+
+class GatewayCheckTests(SimpleTestCase):
+    @patch.object(SecureClient, 'store_gateways_online')
+    @patch.object(SecureClient, 'get_gateway_list', return_value=([{'GMACID': 1}, {'GMACID': 2}], 200))
+    def test_failed_gateway_is_offline(self, gateway_list, store):
+        def check_gateway_online(gmacid, last_update_time):
+            if gmacid == 2:
+                raise IOError('read timed out')
+            return True
+
+        client = SecureClient('test')
+        with patch.object(client, 'check_gateway_online', side_effect=check_gateway_online):
+            healthy, online = client.check_gateways_online('2016-07-06T10:08:24')
+
+        self.assertFalse(healthy)
+        self.assertEqual(online, {1: True, 2: False})
+        store.assert_called_once_with(online)
+
+
+class PushDataWorkerPoolTests(SimpleTestCase):
+    def test_messages_of_a_gateway_keep_their_order(self):
+        processed = []
+        pool = PushDataWorkerPool(processed.append, workers=3)
+        for i in range(20):
+            pool.submit('gw', i)
+        pool.close()
+
+        self.assertEqual(processed, list(range(20)))
+        self.assertEqual(pool.stats()['processed'], 20)
+
+    def test_drop_when_full(self):
+        def block(message):
+            time.sleep(0.2)
+
+        pool = PushDataWorkerPool(block, workers=1, queue_size=1)
+        results = [pool.submit('gw', i) for i in range(4)]
+        pool.close()
+
+        self.assertFalse(all(results))
+        self.assertEqual(pool.stats()['dropped'], results.count(False))
+
+    def test_failures_are_counted(self):
+        def fail(message):
+            raise ValueError(message)
+
+        pool = PushDataWorkerPool(fail, workers=1)
+        pool.submit('gw', 1)
+        pool.close()
+
+        self.assertEqual(pool.stats()['failed'], 1)
@@ -56,13 +56,13 @@ DATABASES = {
     }
 }
 
-# CACHES = {
-#     'default': {
-#         'BACKEND': 'django.core.cache.backends.memcached.PyLibMCCache',
-#         'LOCATION': MEMCACHE_HOST,
-#         'TIMEOUT': 30,
-#     }
-# }
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.PyLibMCCache',
+        'LOCATION': MEMCACHE_HOST,
+        'TIMEOUT': 30,
+    }
+}
 
 INSTALLED_APPS = (
     'django.contrib.admin',
@@ -179,3 +179,85 @@ AUTH_PASSWORD_VALIDATORS = [
         'NAME': 'django.contrib.auth.password_validation.NumericPasswordValidator',
     },
 ]
+
+# InfluxDB write-behind buffer, see ep.timeseries.WriteBuffer
+# Number of points that triggers a write
+INFLUX_WRITE_BUFFER_SIZE = 500
+# Seconds a point may wait in the buffer before it is written
+INFLUX_WRITE_BUFFER_MAX_AGE = 1.
+# Points kept for a retry if writes fail
+INFLUX_WRITE_BUFFER_MAX_PENDING = 10000
+# Seconds an InfluxDB request may take before it fails
+INFLUXDB_TIMEOUT = 30
+
+# Retention policies of the TS DB. The first entry is the policy raw points are written to (the default policy of the
+# database, `influxdb_rollups` does not change it), the others hold rollups that continuous queries compute from the
+# raw points. Run `manage.py influxdb_rollups` after changing these.
+# (The default retention policy is called 'default' before InfluxDB 1.0)
+INFLUX_RETENTION_POLICIES = [
+    {'name': 'autogen', 'interval': None, 'duration': 'INF'},
+    {'name': 'rollup_1m', 'interval': '1m', 'duration': '30d'},
+    {'name': 'rollup_15m', 'interval': '15m', 'duration': '365d'},
+    {'name': 'rollup_1h', 'interval': '1h', 'duration': 'INF'},
+    {'name': 'rollup_1d', 'interval': '1d', 'duration': 'INF'},
+]
+# Measurements (without INFLUX_MEASUREMENT_SUFFIX) that are rolled up and the tag that identifies their series
+INFLUX_ROLLUP_MEASUREMENTS = {'device_parameters': 'dp', 'gateway_online': 'external_id'}
+# How late points may arrive (e.g. from polling importers) and still be rolled up. The continuous queries recompute
+# the buckets of this period on every run, older points are only rolled up by `influxdb_rollups --backfill`.
+INFLUX_ROLLUP_LATENESS = '1h'
+# Length of the time windows `influxdb_rollups --backfill` reads per query, rounded up to a multiple of the rollup
+# interval. Each query must finish within INFLUXDB_TIMEOUT.
+INFLUX_ROLLUP_BACKFILL_WINDOW = '1d'
+# Serve aggregation queries from the coarsest suitable rollup. Enable once the rollups have been created.
+INFLUX_ROLLUPS_ENABLED = False
+
+# Push messages of the secure websocket are processed on worker threads. Messages waiting per worker, further messages
+# are dropped.
+SECURE_PUSH_WORKERS = 4
+SECURE_PUSH_QUEUE_SIZE = 1000
+# Seconds between log messages with the push worker and HTTP latency statistics
+SECURE_PUSH_STATS_INTERVAL = 300
+# Number of gateways the secure health check requests concurrently
+SECURE_GATEWAY_CHECK_WORKERS = 8
+
+# Connection pool and timeouts (seconds) of the HTTP sessions of the vendor API clients, see ep.http_sessions
+VENDOR_HTTP_SESSIONS = {
+    'default': {'CONNECT_TIMEOUT': 5., 'READ_TIMEOUT': 30., 'POOL_SIZE': 10},
+    'secure': {'POOL_SIZE': SECURE_GATEWAY_CHECK_WORKERS},
+}
+
+# Number of Prefect nodes imported concurrently
+PREFECT_IMPORT_WORKERS = 8
+
+# Number of Rayleigh devices imported concurrently
+RAYLEIGH_IMPORT_WORKERS = 4
+
+# Change records are published to the IODICUS exchange in batches, see ep.messaging. Seconds a message waits for a
+# batch to fill, maximum messages per batch, whether changes of a device parameter within a batch are merged, and
+# whether the broker confirms each batch.
+IODICUS_PUBLISH_LINGER = 0.05
+IODICUS_PUBLISH_MAX_BATCH = 100
+IODICUS_PUBLISH_COALESCE = False
+IODICUS_PUBLISH_CONFIRM = True
+# Attempts to connect to the messaging broker and the first and maximum seconds between them
+IODICUS_MESSAGING_CONNECT_ATTEMPTS = 5
+IODICUS_MESSAGING_BACKOFF = 0.5
+IODICUS_MESSAGING_MAX_BACKOFF = 30.
+
+# Seconds the group memberships of an API user are cached per process, see ep.groups. 0 disables the cache.
+API_GROUP_CACHE_TTL = 60
+
+# Seconds of measurements the export reads per query, and the maximum rows of an export in a columnar format, which
+# is built in memory
+MEASUREMENT_EXPORT_WINDOW = 24 * 60 * 60
+MEASUREMENT_EXPORT_MAX_ROWS = 100000
+
+# Cache of the metadata API responses, see ep.response_cache. Entries are invalidated when the metadata changes, the
+# timeout (seconds) only bounds the memory used.
+API_RESPONSE_CACHE = 'default'
+API_RESPONSE_CACHE_TIMEOUT = 60 * 60
+
+# Cache holding the most recent value of each device parameter for all processes, see ep.timeseries.LastValueCache.
+# None keeps the values per process.
+LAST_VALUE_CACHE = 'default'
@@ -22,6 +22,7 @@ ALLOWED_HOSTS.append(docker_vm_ip)
 # define the hostname of the common-services
 MEMCACHE_HOST = docker_vm_ip
 CELERY_RESULT_BACKEND = 'cache+memcached://{}:11211/'.format(MEMCACHE_HOST)
+CACHES['default']['LOCATION'] = MEMCACHE_HOST
 INFLUXDB_HOST = docker_vm_ip
 DB_HOST = docker_vm_ip
 IODICUS_MESSAGING_HOST = docker_vm_ip
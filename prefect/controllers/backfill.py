@@ -0,0 +1,204 @@
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from ep.http_sessions import get_session
+from ep.models import DeviceParameter, DPMeasurements, StateChangeEvent
+from ep.timeseries import create_client, encode_point, series_key, write_lines
+from prefect.controllers.prefect import node_addresses_site_format_url, history_days_ago_site_daysAgo_id_format_url, \
+    prefect_vendor_name
+from prefect.models import PrefectDeviceParameterType, PrefectBackfillCheckpoint
+
+__author__ = 'schien'
+
+logger = logging.getLogger(__name__)
+
+# device parameter type -> value of a NodeHistory entry. Types not in here (PIR, energy consumption) are not part of
+# the history.
+history_value_map = {
+    PrefectDeviceParameterType.SETPOINT_TEMP: lambda entry: entry['SetPointTemperature'],
+    PrefectDeviceParameterType.CURRENT_TEMP: lambda entry: entry['CurrentTemperature'],
+    PrefectDeviceParameterType.RELAY_ONE: lambda entry: int(bool(entry['L1On'])),
+    PrefectDeviceParameterType.RELAY_TWO: lambda entry: int(bool(entry['L2On'])),
+}
+
+
+class RateLimiter(object):
+    """
+    Spaces calls to :func:`wait` at least `1 / rate` seconds apart, across threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1. / rate if rate else 0.
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class PrefectBackfill(object):
+    """
+    Imports the NodeHistory of a Prefect site.
+
+    For each node the device parameters are resolved once. The days of a node are fetched concurrently, limited to
+    `rate` requests per second, and their points are written in chunks of `chunk_size` as the days arrive. Every
+    imported (node, day) before today is recorded as a :class:`PrefectBackfillCheckpoint`, days with a checkpoint are
+    skipped.
+    """
+
+    def __init__(self, site_name, headers, workers=4, rate=5., chunk_size=5000):
+        self.site_name = site_name
+        self.headers = headers
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate)
+        self.chunk_size = chunk_size
+        self.client = create_client()
+
+        self.points_written = 0
+        self.failed_days = []
+
+    def get_json(self, url):
+        self.rate_limiter.wait()
+        r = get_session(prefect_vendor_name).get(url, headers=self.headers)
+        r.raise_for_status()
+        return r.json()
+
+    def get_node_ids(self):
+        logger.info("Requesting node addresses.")
+        return self.get_json(node_addresses_site_format_url.format(site=self.site_name.upper()))
+
+    def get_parameter_map(self, node_id):
+        """
+        :return: list of (device parameter, function returning the parameter's value from a history entry)
+        """
+        device_parameters = DeviceParameter.objects \
+            .filter(device__node__gateway__site__name=self.site_name, device__node__external_id=node_id) \
+            .select_related('type')
+        return [(device_parameter, history_value_map[device_parameter.type.code])
+                for device_parameter in device_parameters if device_parameter.type.code in history_value_map]
+
+    def fetch_day(self, node_id, days_ago):
+        res = self.get_json(history_days_ago_site_daysAgo_id_format_url.format(
+            site=self.site_name.upper(), daysAgo=days_ago, id=node_id))
+        return res[0]['History'] if res else []
+
+    @staticmethod
+    def iter_points(history, parameter_map):
+        """
+        :param history: the entries of a NodeHistory response, e.g.
+            {'CurrentTemperature': 21.4, 'L1On': False, 'L2On': False, 'ProgramName': '', 'ReceivedAt': 1451605892,
+             'SetPointTemperature': -100.0}
+        :return: the points in the line protocol, tagged like the points of a live import
+        """
+        keys = [(series_key(DPMeasurements.INFLUX_DEVICE_PARAMETER_MEASUREMENT_NAME,
+                            {DPMeasurements.TAG: str(device_parameter.id), "type": device_parameter.type.code,
+                             "trigger": StateChangeEvent.ON_DEVICE}), value_func)
+                for device_parameter, value_func in parameter_map]
+        for entry in history:
+            for key, value_func in keys:
+                yield encode_point(key, value_func(entry), entry['ReceivedAt'])
+
+    def write_points(self, points):
+        """
+        Write an iterable of points in chunks.
+
+        :return: the number of points written
+        """
+        count = 0
+        chunk = []
+        for point in points:
+            chunk.append(point)
+            if len(chunk) >= self.chunk_size:
+                write_lines(self.client, chunk, precision='s')
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            write_lines(self.client, chunk, precision='s')
+            count += len(chunk)
+        return count
+
+    def fetch_days(self, node_id, days):
+        """
+        Fetch the history of the given days ago concurrently.
+
+        :return: generator of (days ago, future of the day's history) in the order the days arrive
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            days = iter(days)
+            pending = {}
+            while True:
+                # keep a bounded number of days in flight, so that memory does not grow with the backfill length
+                for days_ago in days:
+                    pending[executor.submit(self.fetch_day, node_id, days_ago)] = days_ago
+                    if len(pending) >= 2 * self.workers:
+                        break
+                if not pending:
+                    break
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    yield pending.pop(future), future
+
+    def import_day(self, node_id, date, future, parameter_map, checkpoint=True):
+        """
+        Write the points of a fetched day.
+
+        :param checkpoint: whether to record the day as imported
+        """
+        try:
+            count = self.write_points(self.iter_points(future.result(), parameter_map))
+        except Exception:
+            logger.exception("Importing node {} on {} failed".format(node_id, date))
+            self.failed_days.append((node_id, date))
+            return
+
+        if checkpoint:
+            PrefectBackfillCheckpoint.objects.update_or_create(
+                site=self.site_name, node_external_id=node_id, date=date, defaults={'points': count})
+        self.points_written += count
+        logger.info("Imported {} points of node {} on {}".format(count, node_id, date))
+
+    def import_node(self, node_id, days):
+        """
+        Import the history of a node for the given days ago, skipping days with a checkpoint.
+        """
+        node_id = str(node_id)
+        today = datetime.datetime.utcnow().date()
+        done = set(PrefectBackfillCheckpoint.objects.filter(site=self.site_name, node_external_id=node_id)
+                   .values_list('date', flat=True))
+        todo = [days_ago for days_ago in days if today - datetime.timedelta(days=days_ago) not in done]
+        if not todo:
+            logger.info("History of node {} already imported".format(node_id))
+            return
+
+        parameter_map = self.get_parameter_map(node_id)
+        if not parameter_map:
+            logger.warn("No device parameters found for node {} in site {}".format(node_id, self.site_name))
+            return
+
+        logger.info("Importing {} days of node {}".format(len(todo), node_id))
+        for days_ago, future in self.fetch_days(node_id, todo):
+            # today's history is still growing, it is imported again next time
+            self.import_day(node_id, today - datetime.timedelta(days=days_ago), future, parameter_map,
+                            checkpoint=days_ago > 0)
+
+    def run(self, days, node_ids=None):
+        """
+        :param days: number of days to import, counting back from today
+        :param node_ids: the nodes to import, all nodes of the site if None
+        """
+        if node_ids is None:
+            node_ids = self.get_node_ids()
+
+        # oldest first, like a live import
+        days = list(reversed(range(days)))
+        for node_id in node_ids:
+            self.import_node(node_id, days)
@@ -1,4 +1,10 @@
 from abc import abstractmethod, ABCMeta
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from ep.timeseries import flush_writes
 
 __author__ = 'schien'
 
@@ -15,11 +21,37 @@ class BaseController(object):
     __metaclass__ = ABCMeta
 
     def update(self, api_id=None):
+        """
+        Import the nodes returned by the API. Nodes are processed concurrently by up to `PREFECT_IMPORT_WORKERS`
+        threads and the measurements of all nodes are written to the TS DB in one batch at the end.
+        """
         api_data = self.get_api_data(api_id)
-        for node_controller in self.get_node_controllers(api_data):
-            node_controller.update_node()
-            for device_controller in node_controller.get_device_controllers():
-                device_controller.create_measurements()
+        node_controllers = self.get_node_controllers(api_data)
+        if node_controllers is None:
+            return
+
+        workers = settings.PREFECT_IMPORT_WORKERS
+        if workers > 1 and len(node_controllers) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # consume the results to raise the first exception of a node
+                list(executor.map(self.update_in_thread, node_controllers))
+        else:
+            for node_controller in node_controllers:
+                self.update_node(node_controller)
+        flush_writes()
+
+    @staticmethod
+    def update_node(node_controller):
+        node_controller.update_node()
+        for device_controller in node_controller.get_device_controllers():
+            device_controller.create_measurements()
+
+    def update_in_thread(self, node_controller):
+        try:
+            self.update_node(node_controller)
+        finally:
+            # the pool threads open their own DB connections
+            close_old_connections()
 
     @abstractmethod
     def get_api_data(self, api_id=None) -> []:
@@ -5,11 +5,11 @@ import logging
 from decimal import Decimal
 
 import pytz
-import requests
 import simplejson as json
 from django.conf import settings
 from prefect.controllers.common import BaseController, NodeController
 
+from ep.http_sessions import get_session
 from ep.models import StateChangeEvent, Node, Device, Site, GatewayProperty, DeviceType, Vendor, DeviceParameter, \
     DeviceParameterType, Gateway
 from prefect.models import PrefectDeviceParameterType, PrefectDeviceType, device_to_deviceparameter_type_map, \
@@ -81,10 +81,9 @@ class PrefectDeviceController(object):
 
                         # Compute power as the product of the configured consumption and the time difference,
                         # iff the line is enabled.
-                        latest = device_parameter.measurements.latest()
+                        latest = device_parameter.measurements.last_value()
                         if latest is not None:
-                            latest_time_since_unix_epoch = calendar.timegm(
-                                datetime.datetime.strptime(latest['time'], "%Y-%m-%dT%H:%M:%SZ").timetuple())
+                            latest_time_since_unix_epoch = calendar.timegm(latest.time.utctimetuple())
                             dt = last_received_time_since_epoch - latest_time_since_unix_epoch
                         else:
                             logger.debug('No previous measurement found')
@@ -108,24 +107,43 @@ class PrefectDeviceController(object):
 
 
 class PrefectNodeController(NodeController):
-    def __init__(self, json_data, site_name=None, headers=None):
-        self.node = None
+    def __init__(self, json_data, site_name=None, headers=None, vendor=None, site=None, gateway=None, node=None,
+                 device_types=None):
+        """
+        :param vendor, site, gateway: the models of the site, looked up if not given
+        :param node: the existing node of the data, looked up or created by :func:`update_node` if not given
+        :param device_types: the result of :func:`get_device_types`, used to create the devices of a new node
+        """
+        self.node = node
+        self.device_types = device_types
         self.headers = headers
 
         self.site_name = site_name
         self.data = json_data
 
-        self.vendor, created = Vendor.objects.get_or_create(name=prefect_vendor_name)
+        if gateway is None:
+            vendor, site, gateway = PrefectNodeController.get_site_models(site_name)
+        self.vendor = vendor
+        self.site = site
+        self.gateway = gateway
+
+    @staticmethod
+    def get_site_models(site_name):
+        """
+        :return: the vendor, site and gateway of a Prefect site, created if they do not exist yet
+        """
+        vendor, created = Vendor.objects.get_or_create(name=prefect_vendor_name)
         if created:
-            logger.info('Created Vendor: {}'.format(self.vendor))
+            logger.info('Created Vendor: {}'.format(vendor))
 
-        self.site, created = Site.objects.get_or_create(name=self.site_name)
+        site, created = Site.objects.get_or_create(name=site_name)
         if created:
-            logger.info('Created Site: {}'.format(self.site))
+            logger.info('Created Site: {}'.format(site))
 
-        self.gateway, created = Gateway.objects.get_or_create(site=self.site, vendor=self.vendor)
+        gateway, created = Gateway.objects.get_or_create(site=site, vendor=vendor)
         if created:
-            logger.info('Created Gateway: {}'.format(self.gateway))
+            logger.info('Created Gateway: {}'.format(gateway))
+        return vendor, site, gateway
 
     def update_node(self) -> Node:
         """
@@ -142,6 +160,9 @@ class PrefectNodeController(NodeController):
         # gateway = GatewayProperty.objects.filter(gateway__site=site, key='vendor', value=prefect_vendor_name)\
         #     .prefetch_related('gateway').get().gateway
 
+        if self.node is not None:
+            return self.node
+
         node, created = Node.objects.get_or_create(external_id=self.data['Address'],
                                                    vendor=self.vendor,
                                                    gateway=self.gateway)
@@ -177,32 +198,49 @@ class PrefectNodeController(NodeController):
             )
         dp_config.save()
 
-    def create_devices(self, node):
-        prefect_id = node.external_id
-        site = node.gateway.site
+    @staticmethod
+    def get_device_types():
+        """
+        Look the device types and device parameter types of Prefect devices up, creating missing ones. Their codes are
+        not unique, so this is done once before nodes are created concurrently rather than in every thread.
 
+        :return: tuple of dicts code -> DeviceType and code -> DeviceParameterType
+        """
+        device_types = {}
+        parameter_types = {}
         for device_type_str in [PrefectDeviceType.THERMOSTAT, PrefectDeviceType.PIR, PrefectDeviceType.RELAY]:
-
             device_type, device_type_created = DeviceType.objects.get_or_create(code=device_type_str)
             if device_type_created:
                 if device_type_str in devicetype_description_map:
                     device_type.description = devicetype_description_map[device_type_str]
                     device_type.save()
                 logger.info('Created DeviceType: {}'.format(device_type))
+            device_types[device_type_str] = device_type
 
+            for code in device_to_deviceparameter_type_map[device_type_str]:
+                device_parameter_type, parameter_type_created = DeviceParameterType.objects.get_or_create(code=code)
+                if parameter_type_created:
+                    if code in device_parameter_type_description_map:
+                        device_parameter_type.description = device_parameter_type_description_map[code]
+                        device_parameter_type.save()
+                    logger.info('Created DeviceParameterType: {}'.format(device_parameter_type))
+                parameter_types[code] = device_parameter_type
+        return device_types, parameter_types
+
+    def create_devices(self, node):
+        prefect_id = node.external_id
+        site = node.gateway.site
+
+        device_types, parameter_types = self.device_types or PrefectNodeController.get_device_types()
+
+        for device_type_str in [PrefectDeviceType.THERMOSTAT, PrefectDeviceType.PIR, PrefectDeviceType.RELAY]:
+            device_type = device_types[device_type_str]
             device, device_created = Device.objects.get_or_create(node=node, vendor=self.vendor, type=device_type)
             if device_created:
                 logger.info('Create Device: {}'.format(device))
 
             for device_parameter in device_to_deviceparameter_type_map[device_type_str]:
-                device_parameter_type, parameter_type_created = DeviceParameterType.objects.get_or_create(code=device_parameter)
-                if parameter_type_created:
-                    if device_parameter_type.code in device_parameter_type_description_map:
-                        device_parameter_type.description = \
-                            device_parameter_type_description_map[device_parameter_type.code]
-                        device_parameter_type.save()
-                    logger.info('Created DeviceParameterType: {}'.format(device_parameter_type))
-
+                device_parameter_type = parameter_types[device_parameter]
                 device_parameter, parameter_created = DeviceParameter.objects.get_or_create(device=device,
                                                                                   type=device_parameter_type)
                 if parameter_created:
@@ -216,7 +254,7 @@ class PrefectNodeController(NodeController):
 
             if device_type.code == PrefectDeviceType.RELAY:
                 url = url_node_configuration_site_id_format_string.format(site=site.name.upper(), id=prefect_id)
-                r = requests.get(url, headers=self.headers)
+                r = get_session(prefect_vendor_name).get(url, headers=self.headers)
                 if r.status_code == 200:
                     res = json.loads(r.content)
 
@@ -239,7 +277,8 @@ class PrefectNodeController(NodeController):
                         extra={'site': node.gateway.site, 'device': node.pk})
 
     def get_device_controllers(self) -> [PrefectDeviceController]:
-        return [PrefectDeviceController(self.data, device) for device in self.node.devices.all()]
+        devices = self.node.devices.select_related('type', 'node__gateway__site').prefetch_related('parameters__type')
+        return [PrefectDeviceController(self.data, device) for device in devices]
 
 
 class PrefectController(BaseController):
@@ -270,14 +309,14 @@ class PrefectController(BaseController):
         res = None
         if api_id:
             url = individual_node_status_url.format(site=self.site.upper(), id=api_id)
-            r = requests.get(url, headers=self.headers)
+            r = get_session(prefect_vendor_name).get(url, headers=self.headers)
             if r.status_code == 200:
                 res = r.json()
             else:
                 logger.warn('Call returned HTTP code: {}'.format(r.status_code))
         else:
             url = all_node_stati_url.format(site=self.site.upper())
-            r = requests.get(url, headers=self.headers)
+            r = get_session(prefect_vendor_name).get(url, headers=self.headers)
             if r.status_code == 200:
                 res = json.loads(r.content)
             else:
@@ -289,13 +328,26 @@ class PrefectController(BaseController):
         if api_data is None:
             logger.error('API call returned None. Check the authorization token.')
             return None
+
+        # look the site and its existing nodes up once, rather than for every node
+        vendor, site, gateway = PrefectNodeController.get_site_models(self.site)
+        nodes = {node.external_id: node for node in
+                 Node.objects.filter(gateway=gateway, vendor=vendor).select_related('gateway__site')}
+        # new nodes are created concurrently, their device types are resolved here once
+        device_types = None
+        if any(str(el['Address']) not in nodes for el in api_data):
+            device_types = PrefectNodeController.get_device_types()
+
         for el in api_data:
-            node_controllers.append(PrefectNodeController(el, site_name=self.site, headers=self.headers))
+            node_controllers.append(PrefectNodeController(el, site_name=self.site, headers=self.headers,
+                                                          vendor=vendor, site=site, gateway=gateway,
+                                                          node=nodes.get(str(el['Address'])),
+                                                          device_types=device_types))
         return node_controllers
 
     def get_node_status(self, node_id: int) -> json:
         url = individual_node_status_url.format(site=self.site.upper(), id=node_id)
         logger.debug('Calling {}'.format(url))
-        r = requests.get(url, headers=self.headers)
+        r = get_session(prefect_vendor_name).get(url, headers=self.headers)
         res = json.loads(r.content)
         return res[0]
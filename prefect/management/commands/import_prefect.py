@@ -1,17 +1,10 @@
-import datetime
 import logging
-from decimal import Decimal
 
-import pytz
-import requests
-from django.conf import settings
-from django.core.management import BaseCommand
-from influxdb import InfluxDBClient
+from django.core.management import BaseCommand, CommandError
 
-from ep.models import Device, DPMeasurements
-
-from prefect.models import PrefectDeviceParameterType
-from prefect.controllers.prefect import PrefectController, badock_site_name
+from prefect.controllers.backfill import PrefectBackfill
+from prefect.controllers.prefect import PrefectController
+from prefect.models import PrefectBackfillCheckpoint
 
 __author__ = 'schien'
 
@@ -24,6 +17,8 @@ class Command(BaseCommand):
     Import measurements from prefect sites.
     For example:
     `python manage.py import_prefect <site name>` to import today's readings
+    `python manage.py import_prefect <site name> -d 90` to import the history of the last 90 days. Days imported by a
+    previous (interrupted) run are skipped, unless `--restart` is given.
     """
     help = 'Import now'
 
@@ -33,99 +28,42 @@ class Command(BaseCommand):
                             help='How many days back to import')
         parser.add_argument('-n', '--node-id', dest='node_id', default=0,
                             help='Prefect specific node id to import for. Imports all nodes if not set')
+        parser.add_argument('-w', '--workers', dest='workers', default=4, type=int,
+                            help='Number of days of a node fetched concurrently')
+        parser.add_argument('-r', '--rate', dest='rate', default=5., type=float,
+                            help='Maximum number of API requests per second')
+        parser.add_argument('-c', '--chunk-size', dest='chunk_size', default=5000, type=int,
+                            help='Number of points per write to the TS DB')
+        parser.add_argument('--restart', action='store_true', dest='restart', default=False,
+                            help='Import days again that were imported by a previous run')
 
     def handle(self, *args, **options):
         site = options['site']
         options_days_ago_ = int(options['days_ago'])
+        options_node_id_ = int(options['node_id'])
+        c = PrefectController.by_site_name(site)
+
         if options_days_ago_ == -1:
             logger.info("Importing current values")
-            c = PrefectController.by_site_name(site)
             logger.debug('Importing from site: {}'.format(c.site))
 
-            c.update(options['node_id'] if 'node_id' in options else None)
+            c.update(options_node_id_ or None)
         else:
             logger.info("Importing historic values")
-            if site.lower() == badock_site_name:
-                headers = {'Authorization': 'Bearer %s' % settings.PREFECT_API_TOKEN_BADOCK}
-            else:
-                headers = {'Authorization': 'Bearer %s' % settings.settings.components.PREFECT_API_TOKEN_GOLDNEY}
-
-            options_node_id_ = int(options['node_id'])
-            if options_node_id_ != 0:
-                ids = [options_node_id_]
-            else:
-                logger.info("Requesting node addresses.")
-                url = 'https://pre2000.co.uk/apiv1/SiteApi/{site}/NodeAddresses'.format(site=site.upper())
-                r = requests.get(url, headers=headers)
-                ids = r.json()
-
-            myclient = InfluxDBClient(settings.INFLUXDB_HOST, settings.INFLUXDB_PORT, settings.INFLUXDB_USER,
-                                      settings.INFLUXDB_PASSWORD, settings.INFLUX_DB_NAME)
-
-            for id in ids:
-                logger.info("Importing for device {}".format(id))
-                for day in reversed(range(options_days_ago_)):
-                    logger.info("Importing day {}".format(day))
-                    __dp = None
-                    try:
-                        url = 'https://pre2000.co.uk/apiv1/SiteApi/{site}/NodeHistory/{daysAgo}/{id}'.format(
-                            site=site.upper(), daysAgo=day, id=id)
-                        r = requests.get(url, headers=headers)
-                        res = r.json()
-                        series = []
-                        for hist_entry in res[0]['History']:
-                            """
-                            {'CurrentTemperature': 21.4,
-                             'L1On': False,
-                             'L2On': False,
-                             'ProgramName': '',
-                             'ReceivedAt': 1451605892,
-                             'SetPointTemperature': -100.0}
-                            """
-                            node_devices = Device.objects.filter(node__gateway__site__name=site, node__external_id=id)
-                            if options['verbosity'] > 1:
-                                logger.info("Importing for node {}".format(id))
-                            for device in node_devices:
-                                epoch = hist_entry['ReceivedAt']
-                                localized_receive_time = pytz.utc.localize(datetime.datetime.utcfromtimestamp(epoch))
-                                measurement_time = localized_receive_time
-
-                                for device_parameter in device.parameters.all():
-                                    __dp = device_parameter.id
-                                    if options['verbosity'] > 1:
-                                        logger.info(
-                                            "Importing for device parameter {}, type {}".format(device_parameter.id,
-                                                                                                device_parameter.type.code))
-
-                                    if device_parameter.type.code == PrefectDeviceParameterType.SETPOINT_TEMP:
-                                        value = Decimal(str(hist_entry['SetPointTemperature']))
-                                    if device_parameter.type.code == PrefectDeviceParameterType.CURRENT_TEMP:
-                                        value = Decimal(str(hist_entry['CurrentTemperature']))
-                                    if device_parameter.type.code == PrefectDeviceParameterType.RELAY_ONE:
-                                        value = Decimal(bool(hist_entry['L1On']))
-                                    if device_parameter.type.code == PrefectDeviceParameterType.RELAY_TWO:
-                                        value = Decimal(bool(hist_entry['L2On']))
-                                    if device_parameter.type.code == PrefectDeviceParameterType.PIR:
-                                        # not currently in the API
-                                        # value = Decimal(bool(hist_entry['PresenceIsDetected']))
-                                        pass
-                                    if options['verbosity'] > 1:
-                                        logger.info("Storing {time} {value}".format(time=measurement_time, value=value))
-
-                                    point_values = {
-                                        "time": measurement_time,
-                                        "measurement": DPMeasurements.INFLUX_MEASUREMENT_NAME,
-                                        'fields': {
-                                            'value': value,
-                                        },
-                                        'tags': {
-                                            DPMeasurements.DP_TAG: int(device_parameter.id),
-                                        },
-                                    }
-                                    series.append(point_values)
-
-                        myclient.write_points(series)
-
-                    except Exception as e:
-                        print("exception during node {}, device param {}, day".format(id, __dp, day))
-                        print(e)
+            node_ids = [options_node_id_] if options_node_id_ != 0 else None
+
+            if options['restart']:
+                checkpoints = PrefectBackfillCheckpoint.objects.filter(site=c.site)
+                if node_ids is not None:
+                    checkpoints = checkpoints.filter(node_external_id__in=[str(i) for i in node_ids])
+                checkpoints.delete()
+
+            backfill = PrefectBackfill(c.site, c.headers, workers=options['workers'], rate=options['rate'],
+                                       chunk_size=options['chunk_size'])
+            backfill.run(options_days_ago_, node_ids)
+
+            logger.info("Imported {} points".format(backfill.points_written))
+            if backfill.failed_days:
+                raise CommandError('Import failed for {} days, run the command again to retry them: {}'.format(
+                    len(backfill.failed_days),
+                    ', '.join('node {} on {}'.format(node_id, date) for node_id, date in backfill.failed_days)))
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('prefect', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrefectBackfillCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('site', models.CharField(max_length=50)),
+                ('node_external_id', models.CharField(max_length=200)),
+                ('date', models.DateField()),
+                ('points', models.IntegerField(default=0)),
+                ('completed_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='prefectbackfillcheckpoint',
+            unique_together=set([('site', 'node_external_id', 'date')]),
+        ),
+    ]
@@ -61,3 +61,20 @@ class PrefectDeviceParameterConfiguration(models.Model):
 
     class Meta:
         verbose_name = 'Prefect Device Configuration'
+
+
+class PrefectBackfillCheckpoint(models.Model):
+    """
+    Records that the history of a node on a day has been imported, so that an interrupted backfill can resume.
+    """
+    site = models.CharField(max_length=50, null=False)
+    node_external_id = models.CharField(max_length=200, null=False)
+    date = models.DateField(null=False)
+    points = models.IntegerField(default=0)
+    completed_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "%s node %s on %s" % (self.site, self.node_external_id, self.date)
+
+    class Meta:
+        unique_together = ('site', 'node_external_id', 'date')
@@ -3,20 +3,22 @@ import json
 import logging
 from datetime import datetime
 from decimal import Decimal
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 
 import httpretty
 from celery import current_app
 from django.conf import settings
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase, override_settings
 
 
 from ep.tests.factories import SiteFactory
+from prefect.controllers.backfill import PrefectBackfill
+from prefect.controllers.common import BaseController
 from prefect.controllers.prefect import PrefectController, node_addresses_site_format_url, individual_node_status_url, \
     url_node_configuration_site_id_format_string, all_node_stati_url, badock_site_name
 
 from ep.models import Node, Device, DeviceParameter, DeviceType, DeviceParameterType
-from prefect.models import PrefectDeviceType, PrefectDeviceParameterType
+from prefect.models import PrefectDeviceType, PrefectDeviceParameterType, PrefectBackfillCheckpoint
 from prefect.tasks import import_from_site
 
 __author__ = 'schien'
@@ -67,6 +69,8 @@ actual_node_config_6002 = [{'Address': 6002,
                             'RoomName': 'L Stairwell First'}]
 
 
+# the data of a TestCase is not visible to the DB connections of import threads
+@override_settings(PREFECT_IMPORT_WORKERS=1)
 class MockCeleryImportPrefectTest(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -171,6 +175,8 @@ def set_up_http_mocks():
                            content_type="application/json")
 
 
+# the data of a TestCase is not visible to the DB connections of import threads
+@override_settings(PREFECT_IMPORT_WORKERS=1)
 class MockedImportPrefectTests(TestCase):
     @staticmethod
     def mock_api_request_basic_node_state_json():
@@ -185,9 +191,10 @@ class MockedImportPrefectTests(TestCase):
         return json.dumps(updated_node_state)
 
     @patch('amqpstorm.basic.Basic.publish')
-    @patch('prefect.controllers.prefect.requests')
-    def test_detect_setpoint_change(self, mock_req, mock_amqp):
+    @patch('prefect.controllers.prefect.get_session')
+    def test_detect_setpoint_change(self, mock_session, mock_amqp):
         logger.info('Start')
+        mock_req = mock_session.return_value
 
         mock_req.get.return_value.status_code = 200
         mock_req.get.return_value.json = self.mock_api_request_basic_node_state_json
@@ -295,3 +302,76 @@ actual_node_statii = [{'Address': 190,
                        'SetPointTemperature': 59.0,
                        'TemperatureAdjustment': 9.0}
                       ]
+
+
+class FakeController(BaseController):
+    def __init__(self, node_controllers):
+        self.node_controllers = node_controllers
+
+    def get_api_data(self, api_id=None):
+        return []
+
+    def get_node_controllers(self, api_data):
+        return self.node_controllers
+
+    def get_device_controllers(self, node_data):
+        return []
+
+
+class ConcurrentUpdateTests(SimpleTestCase):
+    @override_settings(PREFECT_IMPORT_WORKERS=4)
+    @patch('prefect.controllers.common.close_old_connections')
+    @patch('prefect.controllers.common.flush_writes')
+    def test_update_processes_all_nodes_and_flushes_once(self, flush_mock, close_mock):
+        device_controller = MagicMock()
+        node_controllers = [MagicMock(**{'get_device_controllers.return_value': [device_controller]})
+                            for _ in range(10)]
+
+        FakeController(node_controllers).update()
+
+        for node_controller in node_controllers:
+            node_controller.update_node.assert_called_once_with()
+        self.assertEqual(device_controller.create_measurements.call_count, 10)
+        self.assertEqual(flush_mock.call_count, 1)
+
+
+class PrefectNodeControllersTests(TestCase):
+    def test_device_types_are_resolved_once(self):
+        controller = PrefectController.for_site('types test', 'token')
+        api_data = [{'Address': 1}, {'Address': 2}]
+
+        node_controllers = controller.get_node_controllers(api_data)
+
+        self.assertIs(node_controllers[0].device_types, node_controllers[1].device_types)
+        device_types, parameter_types = node_controllers[0].device_types
+        self.assertEqual(DeviceType.objects.filter(code=PrefectDeviceType.RELAY).count(), 1)
+        self.assertEqual(device_types[PrefectDeviceType.RELAY].code, PrefectDeviceType.RELAY)
+        self.assertEqual(DeviceParameterType.objects.filter(code=PrefectDeviceParameterType.RELAY_ONE).count(), 1)
+        self.assertIn(PrefectDeviceParameterType.RELAY_ONE, parameter_types)
+
+
+class PrefectBackfillTests(TestCase):
+    history = [{'CurrentTemperature': 21.4, 'L1On': False, 'L2On': False, 'ProgramName': '', 'ReceivedAt': 1451605892,
+                'SetPointTemperature': 20.0}]
+
+    @patch('amqpstorm.Connection')
+    @patch('prefect.controllers.backfill.create_client')
+    def test_backfill_resumes_from_checkpoints(self, client_mock, connection_mock):
+        SiteFactory(name='backfill', gateway__node__external_id='7',
+                    gateway__node__device__device_param__type__code=PrefectDeviceParameterType.SETPOINT_TEMP)
+        backfill = PrefectBackfill('backfill', {}, workers=2, rate=0, chunk_size=2)
+
+        with patch.object(backfill, 'get_json', return_value=[{'History': self.history * 3}]) as get_json_mock:
+            backfill.run(3, node_ids=[7])
+
+        self.assertEqual(get_json_mock.call_count, 3)
+        self.assertEqual(backfill.points_written, 9)
+        # 3 points per day in chunks of 2
+        self.assertEqual(client_mock.return_value.request.call_count, 6)
+        self.assertIn(b'trigger=OD', client_mock.return_value.request.call_args[1]['data'])
+        # today is not checkpointed
+        self.assertEqual(PrefectBackfillCheckpoint.objects.filter(site='backfill', node_external_id='7').count(), 2)
+
+        with patch.object(backfill, 'get_json', return_value=[{'History': self.history}]) as get_json_mock:
+            backfill.run(3, node_ids=[7])
+        self.assertEqual(get_json_mock.call_count, 1)